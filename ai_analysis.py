@@ -0,0 +1,198 @@
+import concurrent.futures
+import contextvars
+import hashlib
+import json as pyjson
+import os
+import time
+
+from cache import get_analysis_cache
+from circuit_breaker import CircuitBreaker
+from cost_meter import get_cost_meter
+from metrics import METRICS
+from prompt_builder import count_tokens
+from structured_output import ANALYSIS_RESPONSE_FORMAT, StreamingJSONValidator, parse_analysis
+
+PRIMARY_MODEL = 'o3-2025-04-16'
+FALLBACK_MODEL = 'gpt-4o'
+MODELS = [PRIMARY_MODEL, FALLBACK_MODEL]
+
+# Extra completion parameters per model (o3 does not accept temperature/max_tokens)
+MODEL_PARAMS = {
+    PRIMARY_MODEL: {'max_completion_tokens': 2000},
+    FALLBACK_MODEL: {'max_tokens': 2000, 'temperature': 0.3}
+}
+
+# Stream replies through the incremental validator (AI_STREAM=0 waits for the full reply)
+AI_STREAM = os.getenv('AI_STREAM', '1').lower() not in ('0', 'false', 'no')
+
+# Hedged mode fires the fallback when the primary has not answered by its p95 latency
+AI_HEDGE = os.getenv('AI_HEDGE', '').lower() in ('1', 'true', 'yes')
+HEDGE_DEFAULT_DEADLINE = float(os.getenv('AI_HEDGE_DEADLINE', '90'))
+# Primary calls slower than this count against the breaker like failures
+PRIMARY_SLOW_CALL_SECONDS = float(os.getenv('AI_PRIMARY_SLOW_SECONDS', '150'))
+
+BREAKERS = {
+    PRIMARY_MODEL: CircuitBreaker(PRIMARY_MODEL, slow_call_seconds=PRIMARY_SLOW_CALL_SECONDS),
+    FALLBACK_MODEL: CircuitBreaker(FALLBACK_MODEL)
+}
+
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=16, thread_name_prefix='ai-hedge')
+
+def model_health():
+    """Breaker state, call counts and latency percentiles per model"""
+    return {model: breaker.snapshot() for model, breaker in BREAKERS.items()}
+
+def hedge_deadline():
+    """p95 latency of the primary model once there are enough samples, else the configured default"""
+    breaker = BREAKERS[PRIMARY_MODEL]
+    return breaker.latency_percentile(95, min_samples=breaker.min_calls) or HEDGE_DEFAULT_DEADLINE
+
+def analysis_cache_key(model, prompt_version, key_data):
+    """Content hash of everything that determines a model's answer"""
+    canonical = pyjson.dumps(
+        {'model': model, 'prompt_version': prompt_version, 'data': key_data},
+        sort_keys=True,
+        separators=(',', ':'),
+        ensure_ascii=False,
+        default=str
+    )
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def request_analysis(client, model, system_message, user_message):
+    """One schema-constrained completion, validated while it streams so bad output aborts early"""
+    params = dict(
+        model=model,
+        messages=[
+            {"role": "system", "content": system_message},
+            {"role": "user", "content": user_message}
+        ],
+        response_format=ANALYSIS_RESPONSE_FORMAT,
+        **MODEL_PARAMS.get(model, {})
+    )
+    if not AI_STREAM:
+        response = client.chat.completions.create(**params)
+        get_cost_meter().record(model, response.usage)
+        return parse_analysis(response.choices[0].message.content or '')
+
+    validator = StreamingJSONValidator()
+    # The usage arrives in a final chunk with no choices; an aborted stream never reports it
+    stream = client.chat.completions.create(stream=True, stream_options={'include_usage': True}, **params)
+    usage = None
+    streamed = []
+    try:
+        for chunk in stream:
+            if getattr(chunk, 'usage', None):
+                usage = chunk.usage
+            if chunk.choices and chunk.choices[0].delta.content:
+                streamed.append(chunk.choices[0].delta.content)
+                validator.feed(chunk.choices[0].delta.content)
+    finally:
+        # Closing early stops the download (and generation) of a reply that is already invalid
+        stream.close()
+        if usage is None:
+            # Cut short (invalid output, timeout, lost connection) but still billed: estimate it so
+            # budgets don't undercount. Hidden reasoning tokens can't be seen, so this is a lower bound.
+            usage = {'prompt_tokens': count_tokens(system_message) + count_tokens(user_message),
+                     'completion_tokens': count_tokens(''.join(streamed))}
+            METRICS.count('llm_usage_estimated', model=model)
+        get_cost_meter().record(model, usage)
+    return validator.finish()
+
+def timed_request(client, model, system_message, user_message):
+    """request_analysis that reports its outcome and latency to the model's breaker"""
+    started = time.perf_counter()
+    try:
+        ai_data = request_analysis(client, model, system_message, user_message)
+    except Exception:
+        BREAKERS[model].record(False, time.perf_counter() - started)
+        METRICS.observe('llm_attempt', time.perf_counter() - started, model=model, outcome='error')
+        raise
+    BREAKERS[model].record(True, time.perf_counter() - started)
+    METRICS.observe('llm_attempt', time.perf_counter() - started, model=model, outcome='ok')
+    return ai_data
+
+def _sequential_request(client, system_message, user_message):
+    if BREAKERS[PRIMARY_MODEL].allow():
+        try:
+            return timed_request(client, PRIMARY_MODEL, system_message, user_message), PRIMARY_MODEL
+        except Exception as e:
+            primary_error = e
+    else:
+        primary_error = f"circuit open for {PRIMARY_MODEL}"
+    try:
+        return timed_request(client, FALLBACK_MODEL, system_message, user_message), FALLBACK_MODEL
+    except Exception as e2:
+        raise Exception(f"AI analysis failed: {primary_error}, Fallback also failed: {e2}")
+
+def _hedged_request(client, system_message, user_message):
+    errors = {}
+    pending = {}
+    if BREAKERS[PRIMARY_MODEL].allow():
+        # Run in a copy of this context so token usage is still attributed to the listing
+        future = _hedge_executor.submit(
+            contextvars.copy_context().run, timed_request, client, PRIMARY_MODEL, system_message, user_message
+        )
+        pending[future] = PRIMARY_MODEL
+        concurrent.futures.wait([future], timeout=hedge_deadline())
+    else:
+        errors[PRIMARY_MODEL] = f"circuit open for {PRIMARY_MODEL}"
+
+    # Answer from the primary if it already finished successfully, else race both models
+    fallback_started = False
+    while True:
+        for future in [f for f in pending if f.done()]:
+            model = pending.pop(future)
+            try:
+                return future.result(), model
+            except Exception as e:
+                errors[model] = e
+        if not fallback_started:
+            future = _hedge_executor.submit(
+                contextvars.copy_context().run, timed_request, client, FALLBACK_MODEL, system_message, user_message
+            )
+            pending[future] = FALLBACK_MODEL
+            fallback_started = True
+        if not pending:
+            raise Exception(
+                f"AI analysis failed: {errors.get(PRIMARY_MODEL)}, Fallback also failed: {errors.get(FALLBACK_MODEL)}"
+            )
+        concurrent.futures.wait(list(pending), return_when=concurrent.futures.FIRST_COMPLETED)
+
+def lookup_cached_analysis(prompt_version, key_data):
+    """Return a cached analysis from any of the models, or None"""
+    cache = get_analysis_cache()
+    for model in MODELS:
+        cached = cache.get(analysis_cache_key(model, prompt_version, key_data))
+        if cached is not None:
+            METRICS.count('analysis_cache', outcome='hit')
+            return cached
+    METRICS.count('analysis_cache', outcome='miss')
+    return None
+
+def store_analysis(model, prompt_version, key_data, ai_data):
+    get_analysis_cache().set(analysis_cache_key(model, prompt_version, key_data), ai_data)
+
+def analyze_with_fallback(client, system_message, user_message, prompt_version, key_data, use_cache=True, hedge=None):
+    """Ask the primary model for the analysis JSON, falling back to the secondary model.
+
+    Results are cached under a hash of the model, prompt version and key_data (the
+    filtered payload, extracted fields and reform table), so an unchanged listing is
+    answered from the cache by whichever model answered it last time. While the
+    primary's breaker is open, requests go straight to the fallback; with hedge (default
+    AI_HEDGE) the fallback is also fired once the primary passes its p95 latency.
+    """
+    if use_cache:
+        cached = lookup_cached_analysis(prompt_version, key_data)
+        if cached is not None:
+            return cached
+
+    # Slows down near a budget and raises BudgetExceeded once one is used up
+    get_cost_meter().wait_for_budget()
+    if AI_HEDGE if hedge is None else hedge:
+        ai_data, model = _hedged_request(client, system_message, user_message)
+    else:
+        ai_data, model = _sequential_request(client, system_message, user_message)
+
+    if use_cache:
+        store_analysis(model, prompt_version, key_data, ai_data)
+    return ai_data
@@ -0,0 +1,96 @@
+import functools
+import json as pyjson
+import re
+
+# Keys containing any of these are dropped with their whole value: media, long texts,
+# contact and marketing data. Keys are lowercased before matching, so the entries with
+# capitals never match (has3DTour and virtualTour are kept); they stay as they were so
+# filtered payloads, and the analysis cache keys built from them, don't change.
+EXCLUDED_KEY_PARTS = (
+    'multimedia', 'images', 'videos', 'photos', 'gallery', 'picture', 'image',
+    'description', 'comments', 'detailedDescription', 'longDescription',
+    'suggestedTexts', 'texts', 'content', 'htmlDescription',
+    'videoUrl', 'video', 'videoTour', 'virtualTour', '3dTour',
+    'plan', 'floorPlan', 'blueprint', 'layout',
+    'contact', 'agency', 'agent', 'phone', 'email', 'website',
+    'advertisement', 'marketing', 'promotion', 'featured',
+    'metadata', 'tracking', 'analytics', 'stats'
+)
+
+# Strings longer than this are dropped from objects, and strings this long or longer from lists
+MAX_VALUE_CHARS = 500
+MAX_LIST_ITEM_CHARS = 200
+
+def _size(value):
+    return len(pyjson.dumps(value, separators=(',', ':'), ensure_ascii=False, default=str).encode("utf-8"))
+
+class KeyFilter:
+    """Exclusion rules compiled into one regex, with a bounded memo of the keep/drop decision per key"""
+    def __init__(self, excluded_parts=EXCLUDED_KEY_PARTS, memo_size=4096):
+        self._search = re.compile('|'.join(re.escape(part) for part in excluded_parts)).search
+        self.keep = functools.lru_cache(maxsize=memo_size)(self._keep)
+
+    def _keep(self, key):
+        return self._search(key.lower()) is None
+
+DEFAULT_FILTER = KeyFilter()
+
+def filter_payload(data, key_filter=DEFAULT_FILTER, stats=None):
+    """Copy of an API payload without excluded keys, long strings or containers left empty.
+
+    Walks the payload with an explicit stack, so nesting depth is not limited by the
+    recursion limit. If stats is a dict, it gets 'removed_entries' and 'removed_bytes'
+    (compact JSON size of everything dropped).
+    """
+    if not isinstance(data, dict):
+        return data
+    keep = key_filter.keep
+    dropped = [] if stats is not None else None
+    root = {}
+    # Frames: (iterator over the source container, output container, parent output, key in parent)
+    stack = [(iter(data.items()), root, None, None)]
+    while stack:
+        items, out, parent, key = stack[-1]
+        descended = False
+        if type(out) is dict:
+            for name, value in items:
+                if not keep(name):
+                    if dropped is not None:
+                        dropped.append({name: value})
+                elif isinstance(value, dict):
+                    stack.append((iter(value.items()), {}, out, name))
+                    descended = True
+                    break
+                elif isinstance(value, list):
+                    stack.append((iter(value), [], out, name))
+                    descended = True
+                    break
+                elif isinstance(value, str) and len(value) > MAX_VALUE_CHARS:
+                    if dropped is not None:
+                        dropped.append({name: value})
+                else:
+                    out[name] = value
+        else:
+            for item in items:
+                if isinstance(item, dict):
+                    stack.append((iter(item.items()), {}, out, None))
+                    descended = True
+                    break
+                elif isinstance(item, str) and len(item) >= MAX_LIST_ITEM_CHARS:
+                    if dropped is not None:
+                        dropped.append(item)
+                else:
+                    out.append(item)
+        if descended:
+            continue
+        # The container is complete: attach it to its parent unless nothing was kept
+        stack.pop()
+        if parent is not None and out:
+            if type(parent) is dict:
+                parent[key] = out
+            else:
+                parent.append(out)
+    if stats is not None:
+        stats['removed_entries'] = len(dropped)
+        stats['removed_bytes'] = sum(_size(value) for value in dropped)
+    return root
@@ -0,0 +1,263 @@
+"""Offline bulk analysis through the OpenAI Batch API (JSONL in / JSONL out).
+
+Usage: python batch_analysis.py --batch shortlist.txt
+
+Point OPENAI_BATCH_BASE_URL at a local stand-in to run without the real API.
+"""
+import json as pyjson
+import os
+import sys
+import time
+import uuid
+
+from ai_analysis import MODEL_PARAMS, PRIMARY_MODEL, lookup_cached_analysis, store_analysis
+from cache import CACHE_DIR
+from cost_meter import get_cost_meter
+from metrics import METRICS
+from re_engine_core import (
+    COLUMNS, PROMPT_VERSION,
+    build_analysis_request, extract_all_idealista_fields, extract_property_code,
+    fetch_idealista_api, get_link_index, get_sheet_handle, get_sheet_replicator, load_reform_costs, merge_ai_data
+)
+from result_store import get_result_store
+from sheets import LinkIndex, appended_row_number
+from structured_output import ANALYSIS_RESPONSE_FORMAT, parse_analysis
+
+BATCH_DIR = os.path.join(CACHE_DIR, 'batches')
+BATCH_ENDPOINT = '/v1/chat/completions'
+POLL_INTERVAL = 60
+FINAL_STATUSES = {'completed', 'failed', 'expired', 'cancelled'}
+
+def get_batch_client():
+    import openai
+    return openai.OpenAI(
+        api_key=os.getenv('OPENAI_API_KEY'),
+        base_url=os.getenv('OPENAI_BATCH_BASE_URL') or None
+    )
+
+def batch_request_line(custom_id, request, model=PRIMARY_MODEL):
+    """One Batch API input line carrying the same messages ai_analyze_property sends"""
+    return {
+        'custom_id': custom_id,
+        'method': 'POST',
+        'url': BATCH_ENDPOINT,
+        'body': {
+            'model': model,
+            'messages': [
+                {"role": "system", "content": request['system_message']},
+                {"role": "user", "content": request['user_message']}
+            ],
+            'response_format': ANALYSIS_RESPONSE_FORMAT,
+            **MODEL_PARAMS.get(model, {})
+        }
+    }
+
+def write_batch_file(path, lines):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        for line in lines:
+            f.write(pyjson.dumps(line, ensure_ascii=False) + '\n')
+
+def submit_batch(client, path):
+    with open(path, 'rb') as f:
+        input_file = client.files.create(file=f, purpose='batch')
+    return client.batches.create(
+        input_file_id=input_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window='24h'
+    )
+
+def wait_for_batch(client, batch_id, poll_interval=POLL_INTERVAL, timeout=None):
+    """Poll until the batch reaches a final status and return it"""
+    started = time.monotonic()
+    while True:
+        batch = client.batches.retrieve(batch_id)
+        if batch.status in FINAL_STATUSES:
+            return batch
+        if timeout and time.monotonic() - started > timeout:
+            raise Exception(f"Batch {batch_id} still '{batch.status}' after {timeout}s")
+        counts = batch.request_counts
+        if counts:
+            print(f"[BATCH] {batch_id}: {batch.status} ({counts.completed}/{counts.total} done)")
+        time.sleep(poll_interval)
+
+def read_batch_output(client, batch, output_path=None, usage=None):
+    """Map custom_id -> parsed analysis JSON, or the error message for failed requests.
+
+    Token usage is billed to the cost meter at the Batch API rate; pass a dict as usage to
+    also get each request's totals by custom_id.
+    """
+    results = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        text = client.files.content(file_id).text
+        if output_path and file_id == batch.output_file_id:
+            with open(output_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        for raw_line in text.splitlines():
+            if not raw_line.strip():
+                continue
+            line = pyjson.loads(raw_line)
+            response = line.get('response') or {}
+            body = response.get('body') or {}
+            if isinstance(body, dict) and body.get('usage'):
+                meter = get_cost_meter()
+                with meter.track_listing(line['custom_id'].split('-', 1)[-1]) as totals:
+                    meter.record(body.get('model', PRIMARY_MODEL), body['usage'], batch=True)
+                if usage is not None:
+                    usage[line['custom_id']] = totals
+            if line.get('error') or response.get('status_code') != 200:
+                results[line['custom_id']] = f"Batch request failed: {line.get('error') or response.get('body')}"
+                continue
+            try:
+                content = response['body']['choices'][0]['message']['content']
+                results[line['custom_id']] = parse_analysis(content)
+            except Exception as e:
+                results[line['custom_id']] = f"Could not parse batch response: {e}"
+    return results
+
+def run_batch_analysis(urls, service_account_info=None, poll_interval=POLL_INTERVAL, client=None, worksheet=None):
+    """Fetch and extract every URL, analyse them all in one Batch API job and append the rows to the sheet.
+
+    Listings already in the sheet (or being processed elsewhere in this process) are skipped.
+    Every analysis is saved to the result store before the sheet call; if that call fails the
+    records stay pending and the sheet replicator sends them later.
+    """
+    client = client or get_batch_client()
+    summary = {'total': len(urls), 'cached': 0, 'skipped': 0, 'failed': {}, 'written': 0, 'pending': 0}
+    replicate = worksheet is None
+    if replicate:
+        worksheet = get_sheet_handle(service_account_info)
+        link_index = get_link_index(service_account_info)
+    else:
+        link_index = LinkIndex(worksheet)
+    claimed = []
+    try:
+        summary = _run_batch(urls, client, worksheet, link_index, claimed, summary, poll_interval)
+        if summary['pending'] and replicate:
+            # The replicator retries pending records on every pass (and in the next process)
+            get_sheet_replicator(service_account_info).notify()
+        return summary
+    finally:
+        # Listings that were not written may be tried again
+        for url in claimed:
+            link_index.release(url)
+
+def _run_batch(urls, client, worksheet, link_index, claimed, summary, poll_interval):
+    reform_costs = load_reform_costs()
+
+    # Prepare every listing; unchanged listings are answered from the analysis cache
+    prepared = {}
+    analyses = {}
+    lines = []
+    for i, url in enumerate(urls):
+        if not link_index.claim(url):
+            summary['skipped'] += 1
+            continue
+        claimed.append(url)
+        try:
+            property_code = extract_property_code(url)
+            api_data = fetch_idealista_api(property_code)
+            if not api_data:
+                raise Exception("Failed to fetch property data from Idealista API")
+            extracted_data = extract_all_idealista_fields(api_data, url)
+            request = build_analysis_request(api_data, extracted_data, reform_costs)
+        except Exception as e:
+            summary['failed'][url] = str(e)
+            continue
+        custom_id = f"{i}-{property_code}"
+        prepared[custom_id] = (url, request, api_data)
+        cached = lookup_cached_analysis(PROMPT_VERSION, request['key_data'])
+        if cached is not None:
+            analyses[custom_id] = cached
+            summary['cached'] += 1
+        else:
+            lines.append(batch_request_line(custom_id, request))
+
+    usage = {}
+    if lines:
+        # Refuse to submit a batch once a budget is used up; batches are not throttled
+        get_cost_meter().throttle_delay()
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        input_path = os.path.join(BATCH_DIR, f"batch-{stamp}-{uuid.uuid4().hex[:8]}.jsonl")
+        write_batch_file(input_path, lines)
+        batch = submit_batch(client, input_path)
+        print(f"[BATCH] Submitted {len(lines)} requests as {batch.id} ({input_path})")
+        batch = wait_for_batch(client, batch.id, poll_interval=poll_interval)
+        if batch.status != 'completed':
+            raise Exception(f"Batch {batch.id} ended with status '{batch.status}'")
+        output_path = input_path.replace('.jsonl', '.output.jsonl')
+        for custom_id, result in read_batch_output(client, batch, output_path, usage=usage).items():
+            if custom_id not in prepared:
+                continue
+            if isinstance(result, str):
+                summary['failed'][prepared[custom_id][0]] = result
+                continue
+            store_analysis(PRIMARY_MODEL, PROMPT_VERSION, prepared[custom_id][1]['key_data'], result)
+            analyses[custom_id] = result
+        for custom_id, (url, _, _) in prepared.items():
+            if custom_id not in analyses and url not in summary['failed']:
+                summary['failed'][url] = "No result returned by the batch"
+
+    rows = []
+    results = []
+    for custom_id, (url, request, api_data) in prepared.items():
+        if custom_id in analyses:
+            final_data = merge_ai_data(analyses[custom_id], request)
+            rows.append([final_data.get(col, 'Info Missing') for col in COLUMNS])
+            results.append((extract_property_code(url), url, final_data, api_data, usage.get(custom_id)))
+
+    if rows:
+        # The store is the system of record: save first, mark replicated once the sheet has the rows
+        store = get_result_store()
+        record_ids = [
+            store.save(property_code, url, final_data, api_data, PROMPT_VERSION, usage=listing_usage)
+            for property_code, url, final_data, api_data, listing_usage in results
+        ]
+        try:
+            response = worksheet.append_rows(rows, value_input_option='USER_ENTERED')
+        except Exception as e:
+            summary['pending'] = len(record_ids)
+            summary['sheet_error'] = str(e)
+            # Still claimed: the records are pending in the store, so nothing here may write them again
+            for _, url, _, _, _ in results:
+                claimed.remove(url)
+            return summary
+        store.mark_replicated(record_ids)
+        first_row = appended_row_number(response)
+        for offset, (_, url, _, _, _) in enumerate(results):
+            link_index.add(url, first_row + offset if first_row is not None else None)
+            claimed.remove(url)
+        summary['written'] = len(rows)
+    return summary
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='RE Engine: overnight analysis through the OpenAI Batch API')
+    parser.add_argument('--batch', type=str, required=True, metavar='FILE', help="File with one listing URL per line ('-' reads stdin)")
+    parser.add_argument('--poll-interval', type=int, default=POLL_INTERVAL, help='Seconds between batch status checks')
+    args = parser.parse_args()
+    if args.batch == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(args.batch, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    urls = [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+    summary = run_batch_analysis(urls, poll_interval=args.poll_interval)
+    print(f"[DONE] {summary['written']}/{summary['total']} rows written ({summary['cached']} from the analysis cache, "
+          f"{summary['skipped']} already in the sheet)")
+    if summary['pending']:
+        print(f"[ERROR] Sheet write failed ({summary['sheet_error']}); {summary['pending']} analyses are saved "
+              f"in the result store and will be replicated to the sheet later")
+    for url, error in summary['failed'].items():
+        print(f"[ERROR] {url}: {error}")
+    run = get_cost_meter().snapshot()['run']
+    print(f"[COST] Batch: ${run['cost_usd']:.4f} for {run['calls']} requests "
+          f"({run['prompt_tokens']} prompt / {run['completion_tokens']} completion tokens, Batch API rate)")
+    for line in METRICS.report_lines():
+        print(f"[METRICS] {line}")
+    prom_path, json_path = METRICS.export(name='batch_analysis')
+    print(f"[METRICS] Written to {prom_path} and {json_path}")
@@ -0,0 +1,290 @@
+"""Benchmarks against local stand-ins for Idealista, OpenAI and Google Sheets.
+
+Nothing here calls a paid service: Idealista payloads are replayed from recordings
+(or synthetic ones), chat completions and the worksheet are served by the fakes in
+local_services.py, each with configurable latency and error injection. Reports
+throughput and latency percentiles of run_job and batch mode per concurrency level,
+micro-benchmarks of field extraction and API-data filtering, and the cold-start time
+and memory of importing the engine.
+
+    python benchmark.py --record fixtures/ --batch shortlist.txt   # record payloads once
+    python benchmark.py --fixtures fixtures/ --concurrency 1,4,16,64
+"""
+import contextlib
+import io
+import json as pyjson
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from circuit_breaker import percentile
+from local_services import (
+    Faults, FakeIdealistaServer, FakeOpenAIServer, FakeSheetsClient, FakeSpreadsheet, FakeWorksheet, sample_payload
+)
+
+# Credentials the stand-in worksheet is cached under; never sent anywhere
+BENCH_ACCOUNT = {'type': 'service_account', 'client_email': 'benchmark@stand-in', 'private_key_id': 'benchmark'}
+
+# Modules timed from a cold interpreter: the Streamlit app's engine and the CLI
+STARTUP_MODULES = ('re_engine_core', 're_engine')
+# Slow imports the engine should only load on first use
+HEAVY_MODULES = ('pandas', 'numpy', 'openai', 'gspread', 'google.auth')
+
+STARTUP_SCRIPT = '''
+import json, resource, sys, time
+started = time.perf_counter()
+import {module}
+print(json.dumps({{
+    'seconds': time.perf_counter() - started,
+    'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    'modules': len(sys.modules),
+    'heavy': [name for name in {heavy!r} if name in sys.modules]
+}}))
+'''
+
+# Synthetic payload sizes for the micro-benchmarks, by number of listing images
+SYNTHETIC_SIZES = {'small': 10, 'medium': 60, 'large': 400}
+
+def latency_stats(latencies):
+    return {
+        'p50_seconds': percentile(latencies, 50),
+        'p95_seconds': percentile(latencies, 95),
+        'p99_seconds': percentile(latencies, 99),
+        'max_seconds': max(latencies) if latencies else None
+    }
+
+def isolate(workdir, openai_url, idealista_url):
+    """Point every store, cache and service at the stand-ins before the engine is imported"""
+    os.environ.update({
+        'RE_ENGINE_CACHE_DIR': os.path.join(workdir, 'cache'),
+        'RESULT_STORE_PATH': os.path.join(workdir, 'results.sqlite3'),
+        'USAGE_DB_PATH': os.path.join(workdir, 'usage.sqlite3'),
+        'METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'OPENAI_BASE_URL': openai_url,
+        'OPENAI_API_KEY': 'stand-in',
+        'IDEALISTA_BASE_URL': idealista_url,
+        'IDEALISTA_API_KEY': 'stand-in',
+        'AI_RUN_BUDGET_USD': '0',
+        'AI_DAILY_BUDGET_USD': '0'
+    })
+    expected = dict(os.environ)
+    import cache, cost_meter, result_store, re_engine_core
+    # re_engine_core loads .env with override=True, which must not undo the isolation
+    for key in ('OPENAI_BASE_URL', 'IDEALISTA_BASE_URL'):
+        if os.environ.get(key) != expected[key]:
+            raise SystemExit(f"[FATAL] {key} from .env overrides the stand-in; remove it from .env to benchmark")
+    for name, path in (('cache', cache.CACHE_DIR), ('result store', result_store.RESULT_STORE_PATH),
+                       ('usage log', cost_meter.USAGE_DB_PATH)):
+        if not os.path.abspath(path).startswith(os.path.abspath(workdir)):
+            raise SystemExit(f"[FATAL] The {name} path {path} from .env would be written to; remove it from .env to benchmark")
+    return re_engine_core
+
+def bench_micro(core, payloads, repeat):
+    """Per-call time of extract_all_idealista_fields and filter_api_data_for_ai per payload"""
+    results = []
+    funcs = {
+        'extract_all_idealista_fields': lambda payload: core.extract_all_idealista_fields.__wrapped__(
+            payload, f"https://www.idealista.com/inmueble/{payload.get('propertyCode', '0')}/"),
+        'filter_api_data_for_ai': core.filter_api_data_for_ai.__wrapped__
+    }
+    for label, payload in payloads.items():
+        size = len(pyjson.dumps(payload, separators=(',', ':')).encode("utf-8"))
+        for name, func in funcs.items():
+            func(payload)
+            timings = []
+            for _ in range(repeat):
+                started = time.perf_counter()
+                func(payload)
+                timings.append(time.perf_counter() - started)
+            results.append(dict(
+                {'benchmark': name, 'payload': label, 'payload_bytes': size, 'calls': repeat,
+                 'mean_seconds': sum(timings) / len(timings)},
+                **latency_stats(timings)
+            ))
+    return results
+
+def bench_startup(core, repeat):
+    """Import time, peak RSS (KiB on Linux) and loaded modules of a cold import, median of repeat runs"""
+    # profiling imports cache, which reads RE_ENGINE_CACHE_DIR: only after isolate() has set it
+    from profiling import import_profile
+    results = []
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in STARTUP_MODULES:
+        runs = []
+        for _ in range(repeat):
+            proc = subprocess.run(
+                [sys.executable, '-c', STARTUP_SCRIPT.format(module=module, heavy=HEAVY_MODULES)],
+                capture_output=True, text=True, cwd=here, timeout=300
+            )
+            if proc.returncode != 0:
+                raise Exception(f"Importing {module} failed: {proc.stderr.strip().splitlines()[-1:]}")
+            runs.append(pyjson.loads(proc.stdout.strip().splitlines()[-1]))
+        runs.sort(key=lambda run: run['seconds'])
+        median = runs[len(runs) // 2]
+        slowest = sorted((row for row in import_profile((module,)) if row[3] != module), key=lambda row: row[1], reverse=True)
+        results.append(dict(median, module=module, runs=repeat,
+                            slowest_imports=[{'module': row[3], 'cumulative_seconds': row[1] / 1e6} for row in slowest[:5]]))
+    # First load parses reform_cost.csv, later ones are answered from the memo
+    load = core.load_reform_costs.__wrapped__
+    timings = []
+    for _ in range(3):
+        started = time.perf_counter()
+        load()
+        timings.append(time.perf_counter() - started)
+    results.append({'module': 'load_reform_costs', 'first_seconds': timings[0], 'memoized_seconds': min(timings[1:])})
+    return results
+
+def bench_run_job(core, urls, concurrency):
+    """run_job on a thread pool, as the Streamlit job queue runs it"""
+    def one(url):
+        started = time.perf_counter()
+        result = core.run_job(url, BENCH_ACCOUNT, use_cache=False, on_duplicate='append')
+        return result.get('success', False), time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        outcomes = list(executor.map(one, urls))
+    elapsed = time.perf_counter() - started
+    latencies = [seconds for ok, seconds in outcomes if ok]
+    return dict(
+        {'mode': 'run_job', 'concurrency': concurrency, 'listings': len(urls), 'succeeded': len(latencies),
+         'elapsed_seconds': elapsed, 'listings_per_second': len(latencies) / elapsed if elapsed else 0.0},
+        **latency_stats(latencies)
+    )
+
+def bench_batch(worksheet, urls, concurrency):
+    """re_engine.process_batch with `concurrency` fetch and AI workers"""
+    import re_engine
+    with contextlib.redirect_stdout(io.StringIO()):
+        summary = re_engine.process_batch(
+            urls, worksheet, fetch_workers=concurrency, ai_workers=concurrency, queue_size=max(8, concurrency),
+            use_cache=False, on_duplicate='append', job_id=f"benchmark-{concurrency}-{int(time.time())}"
+        )
+    latencies = [job['latency_seconds'] for job in summary['results'] if job.get('error') is None]
+    return dict(
+        {'mode': 'batch', 'concurrency': concurrency, 'listings': len(urls), 'succeeded': summary['succeeded'],
+         'elapsed_seconds': summary['elapsed_seconds'],
+         'listings_per_second': summary['succeeded'] / summary['elapsed_seconds'] if summary['elapsed_seconds'] else 0.0},
+        **latency_stats(latencies)
+    )
+
+def record(urls, directory):
+    """Save the Idealista payload of each listing as <property code>.json (served from the cache when fresh)"""
+    from re_engine_core import extract_property_code, fetch_idealista_api
+    os.makedirs(directory, exist_ok=True)
+    for url in urls:
+        property_code = extract_property_code(url)
+        payload = fetch_idealista_api(property_code)
+        if not payload:
+            print(f"[ERROR] {url}: no payload")
+            continue
+        with open(os.path.join(directory, f"{property_code}.json"), 'w', encoding='utf-8') as f:
+            pyjson.dump(payload, f, ensure_ascii=False, indent=1)
+        print(f"[RECORD] {property_code}")
+
+def main(args):
+    if args.record:
+        with open(args.batch, encoding='utf-8') as f:
+            urls = [line.strip() for line in f if line.strip() and not line.strip().startswith('#')]
+        record(urls, args.record)
+        return
+
+    faults = lambda latency: Faults(latency, args.jitter, args.error_rate, seed=args.seed)
+    if args.fixtures:
+        idealista = FakeIdealistaServer.from_directory(args.fixtures, faults=faults(args.idealista_latency)).start()
+    else:
+        payloads = {str(i): sample_payload(i, images=SYNTHETIC_SIZES['medium']) for i in range(8)}
+        idealista = FakeIdealistaServer(payloads, faults=faults(args.idealista_latency)).start()
+    openai_server = FakeOpenAIServer(faults=faults(args.openai_latency)).start()
+    worksheet = FakeWorksheet(faults=Faults(args.sheets_latency, seed=args.seed))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='re-engine-bench-')
+    try:
+        core = isolate(workdir, openai_server.base_url, idealista.base_url)
+        from sheets import get_cached_worksheet, service_account_identity
+        get_cached_worksheet(
+            service_account_identity(BENCH_ACCOUNT), lambda: FakeSheetsClient(FakeSpreadsheet(core.SHEET_NAME, [worksheet])),
+            core.SHEET_NAME, core.TAB_NAME
+        )
+        report = {'settings': vars(args), 'startup': [], 'micro': [], 'runs': []}
+
+        if 'startup' in args.modes:
+            for r in bench_startup(core, args.startup_runs):
+                report['startup'].append(r)
+                if r['module'] == 'load_reform_costs':
+                    print(f"[STARTUP] load_reform_costs: first {r['first_seconds'] * 1000:.2f}ms, "
+                          f"memoized {r['memoized_seconds'] * 1e6:.0f}us")
+                    continue
+                print(f"[STARTUP] import {r['module']}: {r['seconds'] * 1000:.0f}ms, max RSS {r['max_rss_kb'] / 1024:.0f} MiB, "
+                      f"{r['modules']} modules, heavy: {', '.join(r['heavy']) or 'none'}; slowest: "
+                      + ', '.join(f"{s['module']} {s['cumulative_seconds'] * 1000:.0f}ms" for s in r['slowest_imports']))
+
+        if 'micro' in args.modes:
+            payloads = {name: sample_payload(name, images=images, seed=0) for name, images in SYNTHETIC_SIZES.items()}
+            payloads.update({f"recorded {code}": idealista.payloads[code] for code in sorted(idealista.payloads)[:5]}
+                            if args.fixtures else {})
+            for r in bench_micro(core, payloads, args.repeat):
+                report['micro'].append(r)
+                print(f"[MICRO] {r['benchmark']} on {r['payload']} ({r['payload_bytes'] / 1024:.0f} KiB): "
+                      f"mean {r['mean_seconds'] * 1e6:.0f}us p50 {r['p50_seconds'] * 1e6:.0f}us "
+                      f"p95 {r['p95_seconds'] * 1e6:.0f}us")
+
+        runners = {'run_job': lambda urls, c: bench_run_job(core, urls, c),
+                   'batch': lambda urls, c: bench_batch(worksheet, urls, c)}
+        first_code = 1_000_000
+        for mode in [m for m in ('run_job', 'batch') if m in args.modes]:
+            for concurrency in args.concurrency:
+                # Fresh listing codes per run, so nothing is answered from an earlier run
+                urls = [f"https://www.idealista.com/inmueble/{first_code + i}/" for i in range(args.listings)]
+                first_code += args.listings
+                r = runners[mode](urls, concurrency)
+                report['runs'].append(r)
+                p = lambda key: f"{r[key]:.2f}s" if r[key] is not None else 'n/a'
+                print(f"[BENCH] {mode} c={concurrency}: {r['succeeded']}/{r['listings']} ok in {r['elapsed_seconds']:.1f}s, "
+                      f"{r['listings_per_second']:.2f} listings/s, p50 {p('p50_seconds')} p95 {p('p95_seconds')} "
+                      f"p99 {p('p99_seconds')}")
+
+        report['stand_ins'] = {
+            'idealista': {'calls': idealista.faults.calls, 'errors': idealista.faults.errors},
+            'openai': {'calls': openai_server.faults.calls, 'errors': openai_server.faults.errors},
+            'sheets': dict(worksheet.calls, rows=len(worksheet.rows) - 1)
+        }
+        print(f"[BENCH] Stand-ins: {pyjson.dumps(report['stand_ins'])}")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                pyjson.dump(report, f, indent=2)
+            print(f"[BENCH] Written to {args.json}")
+    finally:
+        idealista.stop()
+        openai_server.stop()
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='RE Engine: benchmarks against local stand-ins for the paid services')
+    parser.add_argument('--modes', type=lambda s: s.split(','), default=['startup', 'micro', 'run_job', 'batch'],
+                        help='Comma-separated benchmarks to run: startup, micro, run_job, batch')
+    parser.add_argument('--concurrency', type=lambda s: [int(c) for c in s.split(',')], default=[1, 4, 16, 64],
+                        help='Comma-separated concurrency levels')
+    parser.add_argument('--listings', type=int, default=64, help='Listings per run')
+    parser.add_argument('--repeat', type=int, default=200, help='Calls per micro-benchmark')
+    parser.add_argument('--startup-runs', type=int, default=5, help='Cold imports per module in the startup benchmark')
+    parser.add_argument('--fixtures', type=str, metavar='DIR', help='Recorded Idealista payloads to replay (default: synthetic)')
+    parser.add_argument('--idealista-latency', type=float, default=0.05, help='Seconds the Idealista stand-in takes per call')
+    parser.add_argument('--openai-latency', type=float, default=0.3, help='Seconds the OpenAI stand-in takes per completion')
+    parser.add_argument('--sheets-latency', type=float, default=0.02, help='Seconds the worksheet stand-in takes per call')
+    parser.add_argument('--jitter', type=float, default=0.0, help='Up to this many extra seconds per Idealista/OpenAI call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Share of Idealista/OpenAI calls that fail with HTTP 500')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for jitter and error injection')
+    parser.add_argument('--workdir', type=str, help='Keep caches, stores and metrics here instead of a temporary directory')
+    parser.add_argument('--json', type=str, metavar='FILE', help='Also write the results as JSON')
+    parser.add_argument('--record', type=str, metavar='DIR', help='Record the Idealista payloads of --batch listings to DIR and exit')
+    parser.add_argument('--batch', type=str, metavar='FILE', help='Listing URLs to record, one per line')
+    args = parser.parse_args()
+    if args.record and not args.batch:
+        parser.error('--record needs --batch')
+    main(args)
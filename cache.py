@@ -0,0 +1,136 @@
+import json as pyjson
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+CACHE_DIR = os.getenv('RE_ENGINE_CACHE_DIR', '.cache')
+
+# Idealista detail responses: re-fetch after a day, keep at most ~200MB on disk
+IDEALISTA_CACHE_TTL = float(os.getenv('IDEALISTA_CACHE_TTL', str(24 * 3600)))
+IDEALISTA_CACHE_MAX_MB = float(os.getenv('IDEALISTA_CACHE_MAX_MB', '200'))
+
+# LLM analyses are content-addressed, so they never go stale and only need a size cap
+ANALYSIS_CACHE_TTL = float(os.getenv('ANALYSIS_CACHE_TTL', '0'))
+ANALYSIS_CACHE_MAX_MB = float(os.getenv('ANALYSIS_CACHE_MAX_MB', '100'))
+
+class SQLiteCache:
+    """Key/value cache stored in a SQLite file, with optional TTL and size-based LRU eviction"""
+    def __init__(self, path, ttl_seconds=None, max_bytes=None):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed_at)")
+
+    def get(self, key):
+        """Return the cached value for key, or None on a miss or expired entry"""
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self._conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return pyjson.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def set(self, key, value):
+        blob = zlib.compress(pyjson.dumps(value, separators=(',', ':')).encode("utf-8"))
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, blob, len(blob), now, now)
+            )
+            if self.max_bytes:
+                self._evict()
+
+    def delete(self, key):
+        with self._lock:
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def items(self, batch_size=500):
+        """Every (key, value), in key order, without counting lookups or refreshing access times"""
+        last = None
+        while True:
+            with self._lock:
+                if last is None:
+                    rows = self._conn.execute(
+                        "SELECT key, value FROM entries ORDER BY key LIMIT ?", (batch_size,)
+                    ).fetchall()
+                else:
+                    rows = self._conn.execute(
+                        "SELECT key, value FROM entries WHERE key > ? ORDER BY key LIMIT ?", (last, batch_size)
+                    ).fetchall()
+            if not rows:
+                return
+            for key, blob in rows:
+                yield key, pyjson.loads(zlib.decompress(blob).decode("utf-8"))
+            last = rows[-1][0]
+
+    def _evict(self):
+        # Drop least recently used entries until the cache fits in max_bytes again
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute("SELECT key, size FROM entries ORDER BY accessed_at").fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self):
+        with self._lock:
+            entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': entries,
+            'bytes': size
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+def _get_cache(name, ttl_seconds, max_mb):
+    with _caches_lock:
+        if name not in _caches:
+            _caches[name] = SQLiteCache(
+                os.path.join(CACHE_DIR, f"{name}.sqlite3"),
+                ttl_seconds=ttl_seconds or None,
+                max_bytes=int(max_mb * 1024 * 1024) if max_mb else None
+            )
+        return _caches[name]
+
+def get_property_cache():
+    """Cache of Idealista detail responses keyed by property code"""
+    return _get_cache('idealista', IDEALISTA_CACHE_TTL, IDEALISTA_CACHE_MAX_MB)
+
+def get_analysis_cache():
+    """Cache of parsed LLM analyses keyed by a hash of their inputs"""
+    return _get_cache('analyses', ANALYSIS_CACHE_TTL, ANALYSIS_CACHE_MAX_MB)
@@ -0,0 +1,109 @@
+import collections
+import math
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers (None if empty)"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    # Multiplying first keeps whole ranks exact (0.07 * 100 is 7.000000000000001)
+    index = max(0, min(len(ordered) - 1, math.ceil(pct * len(ordered) / 100) - 1))
+    return ordered[index]
+
+class CircuitBreaker:
+    """Failure-rate and latency circuit breaker over a sliding window of recent calls.
+
+    The breaker opens when, over the last `window` calls (at least `min_calls`), the share
+    of failed or slow calls reaches `failure_threshold`. While open, calls are refused
+    until `cooldown` seconds have passed; then a single probe call is let through
+    (half-open) and its outcome closes or re-opens the breaker.
+    """
+    def __init__(self, name, window=20, min_calls=5, failure_threshold=0.5, slow_call_seconds=None, cooldown=60):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_threshold = failure_threshold
+        self.slow_call_seconds = slow_call_seconds
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = None
+        self.calls = 0
+        self.failures = 0
+        self.rejected = 0
+        self._outcomes = collections.deque(maxlen=window)
+        self._latencies = collections.deque(maxlen=window)
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow(self):
+        """Whether a call may go to this model right now"""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+            if self.state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record(self, success, latency):
+        with self._lock:
+            self.calls += 1
+            # Latency percentiles describe answered calls; fast failures would skew them down
+            if success:
+                self._latencies.append(latency)
+            slow = self.slow_call_seconds is not None and latency > self.slow_call_seconds
+            ok = success and not slow
+            if not success:
+                self.failures += 1
+            if self.state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                else:
+                    self._open()
+                return
+            self._outcomes.append(ok)
+            if len(self._outcomes) >= self.min_calls:
+                bad = self._outcomes.count(False) / len(self._outcomes)
+                if bad >= self.failure_threshold:
+                    self._open()
+
+    def abandon(self):
+        """A call that was let through ended without an outcome (e.g. it was cancelled)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+
+    def latency_percentile(self, pct, min_samples=1):
+        """Percentile of recent successful call latencies, None until min_samples are recorded"""
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            return percentile(list(self._latencies), pct)
+
+    def snapshot(self):
+        with self._lock:
+            latencies = list(self._latencies)
+            outcomes = list(self._outcomes)
+            return {
+                'state': self.state,
+                'calls': self.calls,
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'recent_failure_rate': outcomes.count(False) / len(outcomes) if outcomes else 0.0,
+                'latency_p50': percentile(latencies, 50),
+                'latency_p95': percentile(latencies, 95)
+            }
@@ -0,0 +1,26 @@
+# The only columns to fill, in order A-W:
+COLUMNS = [
+    'Location',
+    'Link',
+    'ChatGPT Business Case',
+    'Nota Simple',
+    'Priority',
+    'License Yes/No',
+    'Project purchase price',
+    'Seaview',
+    'Comments',
+    'Total surface (m2) Metros construidos',
+    'Plot size',
+    'Price m2',
+    'Reform cost (m2)',
+    'Aimed Sales Price without Real Estate Agent',
+    'Comparable Houses on the market 1',
+    'Comparable Houses on the market 2',
+    'Comparable Houses on the market 3',
+    'Macro location (1-10)',
+    'Micro location (1-10)',
+    'Sun direction',
+    'View',
+    'Building',
+    'Email Draft'
+]
@@ -0,0 +1,183 @@
+import contextlib
+import contextvars
+import os
+import sqlite3
+import threading
+import time
+
+from metrics import METRICS
+
+USAGE_DB_PATH = os.getenv('USAGE_DB_PATH', os.path.join('data', 'usage.sqlite3'))
+
+# USD per 1M tokens: (input, cached input, output). Reasoning tokens are billed as output.
+PRICES = {
+    'o3-2025-04-16': (2.00, 0.50, 8.00),
+    'gpt-4o': (2.50, 1.25, 10.00)
+}
+# The Batch API bills half the synchronous price
+BATCH_DISCOUNT = 0.5
+
+# Budgets in USD; 0 disables. A run is one process (a CLI batch, or the app since it started).
+AI_RUN_BUDGET_USD = float(os.getenv('AI_RUN_BUDGET_USD', '0'))
+AI_DAILY_BUDGET_USD = float(os.getenv('AI_DAILY_BUDGET_USD', '0'))
+# Past this share of a budget, new analyses are spaced out by AI_BUDGET_THROTTLE_SECONDS
+AI_BUDGET_SLOWDOWN_AT = float(os.getenv('AI_BUDGET_SLOWDOWN_AT', '0.8'))
+AI_BUDGET_THROTTLE_SECONDS = float(os.getenv('AI_BUDGET_THROTTLE_SECONDS', '30'))
+
+class BudgetExceeded(Exception):
+    """An AI budget is used up; no further analyses are started"""
+
+def _field(obj, name, default=None):
+    if obj is None:
+        return default
+    if isinstance(obj, dict):
+        return obj.get(name, default)
+    return getattr(obj, name, default)
+
+def normalize_usage(usage):
+    """Token counts from an SDK usage object or a raw usage dict (e.g. Batch API output)"""
+    prompt_details = _field(usage, 'prompt_tokens_details')
+    completion_details = _field(usage, 'completion_tokens_details')
+    return {
+        'prompt_tokens': _field(usage, 'prompt_tokens', 0) or 0,
+        'cached_tokens': _field(prompt_details, 'cached_tokens', 0) or 0,
+        'completion_tokens': _field(usage, 'completion_tokens', 0) or 0,
+        'reasoning_tokens': _field(completion_details, 'reasoning_tokens', 0) or 0
+    }
+
+def call_cost(model, tokens, batch=False):
+    """USD cost of one call from normalize_usage() counts (0 for models without a price)"""
+    input_price, cached_price, output_price = PRICES.get(model, (0.0, 0.0, 0.0))
+    uncached = tokens['prompt_tokens'] - tokens['cached_tokens']
+    cost = (uncached * input_price + tokens['cached_tokens'] * cached_price
+            + tokens['completion_tokens'] * output_price) / 1_000_000
+    return cost * BATCH_DISCOUNT if batch else cost
+
+def _empty_totals():
+    return {'calls': 0, 'prompt_tokens': 0, 'cached_tokens': 0, 'completion_tokens': 0, 'reasoning_tokens': 0,
+            'cost_usd': 0.0}
+
+def _add(totals, tokens, cost):
+    totals['calls'] += 1
+    for key, value in tokens.items():
+        totals[key] += value
+    totals['cost_usd'] += cost
+
+# Usage of the listing being analysed in the current thread or asyncio task
+_current_listing = contextvars.ContextVar('current_listing', default=None)
+
+class CostMeter:
+    """Token and cost accounting per call, aggregated per listing, per run and per day.
+
+    Every call is also appended to a SQLite log, so daily totals survive restarts and are
+    shared between the CLI and the app. throttle_delay() enforces the budgets.
+    """
+    def __init__(self, path=USAGE_DB_PATH, run_budget=AI_RUN_BUDGET_USD, daily_budget=AI_DAILY_BUDGET_USD):
+        self.run_budget = run_budget
+        self.daily_budget = daily_budget
+        self.run = _empty_totals()
+        self.by_model = {}
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS calls ("
+            "ts REAL NOT NULL, day TEXT NOT NULL, model TEXT NOT NULL, listing TEXT, batch INTEGER NOT NULL, "
+            "prompt_tokens INTEGER, cached_tokens INTEGER, completion_tokens INTEGER, reasoning_tokens INTEGER, "
+            "cost_usd REAL NOT NULL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS calls_day ON calls (day)")
+
+    def record(self, model, usage, batch=False, listing=None):
+        """Account one completed call; returns its cost in USD"""
+        if usage is None:
+            return 0.0
+        tokens = normalize_usage(usage)
+        cost = call_cost(model, tokens, batch=batch)
+        current = _current_listing.get()
+        if current is not None:
+            with self._lock:
+                _add(current, tokens, cost)
+            listing = listing or current.get('listing')
+        now = time.time()
+        with self._lock:
+            _add(self.run, tokens, cost)
+            _add(self.by_model.setdefault(model, _empty_totals()), tokens, cost)
+            self._conn.execute(
+                "INSERT INTO calls VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (now, time.strftime('%Y-%m-%d', time.localtime(now)), model, listing, int(batch),
+                 tokens['prompt_tokens'], tokens['cached_tokens'], tokens['completion_tokens'],
+                 tokens['reasoning_tokens'], cost)
+            )
+        METRICS.count('llm_tokens', tokens['prompt_tokens'], model=model, kind='prompt')
+        METRICS.count('llm_tokens', tokens['completion_tokens'], model=model, kind='completion')
+        return cost
+
+    @contextlib.contextmanager
+    def track_listing(self, listing=None):
+        """Collect the usage of every call made inside the block (same thread or task)"""
+        totals = dict(_empty_totals(), listing=listing)
+        token = _current_listing.set(totals)
+        try:
+            yield totals
+        finally:
+            _current_listing.reset(token)
+
+    def day_totals(self, day=None):
+        day = day or time.strftime('%Y-%m-%d')
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(prompt_tokens), 0), COALESCE(SUM(cached_tokens), 0), "
+                "COALESCE(SUM(completion_tokens), 0), COALESCE(SUM(reasoning_tokens), 0), COALESCE(SUM(cost_usd), 0) "
+                "FROM calls WHERE day = ?", (day,)
+            ).fetchone()
+        return dict(zip(('calls', 'prompt_tokens', 'cached_tokens', 'completion_tokens', 'reasoning_tokens',
+                         'cost_usd'), row))
+
+    def budget_usage(self):
+        """Share of each configured budget spent so far (1.0 = used up)"""
+        usage = {}
+        if self.run_budget:
+            usage['run'] = self.run['cost_usd'] / self.run_budget
+        if self.daily_budget:
+            usage['daily'] = self.day_totals()['cost_usd'] / self.daily_budget
+        return usage
+
+    def throttle_delay(self):
+        """Seconds to wait before starting another analysis; raises BudgetExceeded when a budget is used up"""
+        usage = self.budget_usage()
+        for name, share in usage.items():
+            if share >= 1:
+                raise BudgetExceeded(f"AI {name} budget exhausted ({share:.0%} used)")
+        if usage and max(usage.values()) >= AI_BUDGET_SLOWDOWN_AT:
+            return AI_BUDGET_THROTTLE_SECONDS
+        return 0.0
+
+    def wait_for_budget(self):
+        delay = self.throttle_delay()
+        if delay:
+            time.sleep(delay)
+
+    def snapshot(self):
+        with self._lock:
+            run = dict(self.run)
+            by_model = {model: dict(totals) for model, totals in self.by_model.items()}
+        return {'run': run, 'by_model': by_model, 'today': self.day_totals(), 'budget_usage': self.budget_usage()}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+_meter = None
+_meter_lock = threading.Lock()
+
+def get_cost_meter():
+    """The process-wide CostMeter"""
+    global _meter
+    with _meter_lock:
+        if _meter is None:
+            _meter = CostMeter()
+        return _meter
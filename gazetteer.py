@@ -0,0 +1,199 @@
+import collections
+import functools
+import math
+import threading
+import unicodedata
+
+# Canonical Location -> (names it goes by, (latitude, longitude) of its centre, radius in km).
+# Places without a centre are only matched by name.
+PLACES = {
+    'Calvià': (('calvia',), (39.566, 2.506), 3.0),
+    'Santa Ponsa': (('santa ponsa', 'santa ponca'), (39.509, 2.477), 2.5),
+    'Camp de Mar': (('camp de mar',), (39.538, 2.423), 1.5),
+    'Port Andratx': (('port andratx', "port d'andratx", 'puerto andratx', 'puerto de andratx'), (39.543, 2.386), 2.0),
+    'Andratx': (('andratx',), (39.575, 2.420), 3.0),
+    'Portals': (('portals',), None, 0.0),
+    'Bendinat': (('bendinat',), (39.543, 2.580), 1.5),
+    'Son Vida': (('son vida',), (39.595, 2.617), 1.5),
+    'Palma': (('palma', 'palma de mallorca'), (39.570, 2.650), 6.0),
+    'Sóller': (('soller',), (39.767, 2.715), 3.0),
+    'Deià': (('deia',), (39.748, 2.648), 2.0),
+    'Valldemossa': (('valldemossa',), (39.710, 2.622), 3.0),
+    "Costa d'en Blanes": (("costa d'en blanes", 'costa den blanes'), (39.535, 2.558), 1.0),
+    'Puerto Portals': (('puerto portals', 'port portals'), (39.531, 2.567), 0.8),
+    'Palmanova': (('palmanova', 'palma nova'), (39.522, 2.538), 1.5),
+    'Magaluf': (('magaluf',), (39.507, 2.535), 1.5),
+    'Sol de Mallorca': (('sol de mallorca',), (39.487, 2.549), 1.2),
+    'Portals Nous': (('portals nous',), (39.532, 2.569), 1.5),
+    'Illetes': (('illetes', 'illetas'), (39.542, 2.596), 1.2),
+    'Cas Català': (('cas catala',), (39.548, 2.600), 1.0),
+    'Génova': (('genova',), (39.578, 2.607), 1.0),
+    'Son Espanyolet': (('son espanyolet',), (39.580, 2.627), 0.8),
+    'Sa Ràpita': (('sa rapita',), (39.366, 2.958), 2.0),
+    'Es Trenc': (('es trenc',), (39.345, 2.985), 2.0),
+    'Santanyí': (('santanyi',), (39.354, 3.128), 3.0),
+    "Cala d'Or": (("cala d'or", 'cala dor'), (39.372, 3.231), 2.0),
+    'Porto Cristo': (('porto cristo',), (39.541, 3.333), 2.0),
+    'Cala Millor': (('cala millor',), (39.597, 3.385), 2.0),
+    'Alcúdia': (('alcudia',), (39.853, 3.121), 4.0),
+    'Pollença': (('pollensa', 'pollenca'), (39.877, 3.016), 3.0),
+    'Puerto Pollença': (('puerto pollensa', 'port de pollenca', 'puerto de pollensa'), (39.906, 3.083), 2.0),
+    'Formentor': (('formentor',), (39.957, 3.205), 4.0)
+}
+
+# Idealista location fields, most specific first
+TEXT_FIELDS = ('neighborhood', 'district', 'municipality', 'address')
+# Values that say nothing about where on the island a listing is
+VAGUE_NAMES = {'mallorca', 'majorca', 'baleares', 'illes balears', 'islas baleares', 'balearic islands', 'spain', 'espana'}
+
+# Grid cell of the spatial index, in degrees (about 5.5 km of latitude)
+GRID_DEGREES = 0.05
+KM_PER_DEGREE = 111.32
+
+def fold(text):
+    """Lowercase text without accents and with plain apostrophes, so 'Sóller' and 'soller' compare equal"""
+    text = unicodedata.normalize('NFKD', str(text or '')).replace('’', "'").replace('`', "'")
+    return ''.join(ch for ch in text if not unicodedata.combining(ch)).lower()
+
+def _coordinate(value):
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        return None
+    return number if math.isfinite(number) else None
+
+class Gazetteer:
+    """Place names compiled into an Aho-Corasick automaton, plus a grid index of place centres.
+
+    match() finds every name in one pass over the text and returns the place of the
+    longest one ('puerto pollensa' beats 'pollensa'), leftmost on ties. Names only match
+    whole words. nearest() returns the place whose centre is closest to a point relative
+    to its radius. Both are memoized, so bulk runs over many listings repeat little work.
+    """
+    def __init__(self, places=PLACES, memo_size=65536):
+        self._goto = [{}]
+        self._fail = [0]
+        self._out = [()]
+        for place, (names, _, _) in places.items():
+            for name in names:
+                self._add(fold(name), place)
+        self._link()
+        self._cells = collections.defaultdict(list)
+        for place, (_, centre, radius) in places.items():
+            if centre:
+                self._index(place, centre, radius)
+        self.match = functools.lru_cache(maxsize=memo_size)(self._match)
+
+    def _add(self, name, place):
+        node = 0
+        for ch in name:
+            child = self._goto[node].get(ch)
+            if child is None:
+                child = len(self._goto)
+                self._goto[node][ch] = child
+                self._goto.append({})
+                self._fail.append(0)
+                self._out.append(())
+            node = child
+        self._out[node] = ((len(name), place),)
+
+    def _link(self):
+        # Breadth first, so every node's failure target is linked before its children need it
+        queue = collections.deque(self._goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for ch, child in self._goto[node].items():
+                target = self._fail[node]
+                while target and ch not in self._goto[target]:
+                    target = self._fail[target]
+                self._fail[child] = self._goto[target].get(ch, 0)
+                self._out[child] += self._out[self._fail[child]]
+                queue.append(child)
+
+    def _match(self, text):
+        text = fold(text)
+        goto, fail, out = self._goto, self._fail, self._out
+        best = None
+        node = 0
+        for end, ch in enumerate(text, 1):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            for length, place in out[node]:
+                start = end - length
+                if (start and text[start - 1].isalnum()) or (end < len(text) and text[end].isalnum()):
+                    continue
+                if best is None or length > best[0] or (length == best[0] and start < best[1]):
+                    best = (length, start, place)
+        return best[2] if best else None
+
+    def _index(self, place, centre, radius):
+        lat, lon = centre
+        reach_lat = radius / KM_PER_DEGREE
+        reach_lon = radius / (KM_PER_DEGREE * math.cos(math.radians(lat)))
+        for row in range(math.floor((lat - reach_lat) / GRID_DEGREES), math.floor((lat + reach_lat) / GRID_DEGREES) + 1):
+            for col in range(math.floor((lon - reach_lon) / GRID_DEGREES), math.floor((lon + reach_lon) / GRID_DEGREES) + 1):
+                self._cells[(row, col)].append((place, lat, lon, radius))
+
+    def nearest(self, latitude, longitude):
+        """Place whose area covers the point, closest to its centre relative to its radius; None outside all"""
+        lat, lon = _coordinate(latitude), _coordinate(longitude)
+        if lat is None or lon is None:
+            return None
+        best = None
+        for place, centre_lat, centre_lon, radius in self._cells.get((math.floor(lat / GRID_DEGREES), math.floor(lon / GRID_DEGREES)), ()):
+            # Equirectangular distance: accurate to well under 1% over a few km
+            dx = (lon - centre_lon) * math.cos(math.radians(centre_lat))
+            km = KM_PER_DEGREE * math.hypot(lat - centre_lat, dx)
+            if km <= radius and (best is None or km / radius < best[0]):
+                best = (km / radius, place)
+        return best[1] if best else None
+
+    def resolve(self, api_data):
+        """Location of an Idealista payload.
+
+        The most specific text field wins when it names a known place; otherwise it is kept
+        as-is unless it is only an address or a vague name like 'Mallorca'. Then the other
+        text fields are tried, then the coordinates.
+        """
+        field, text = next(((f, api_data[f]) for f in TEXT_FIELDS if api_data.get(f)), (None, ''))
+        place = self.match(text)
+        if place:
+            return place
+        if text and field != 'address' and fold(text).strip() not in VAGUE_NAMES:
+            return text
+        for other in TEXT_FIELDS:
+            if other != field and api_data.get(other):
+                place = self.match(api_data[other])
+                if place:
+                    return place
+        place = self.nearest(api_data.get('latitude'), api_data.get('longitude'))
+        return place or text or 'Info Missing'
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+def get_gazetteer():
+    """The process-wide Gazetteer over PLACES"""
+    global _gazetteer
+    with _gazetteer_lock:
+        if _gazetteer is None:
+            _gazetteer = Gazetteer()
+        return _gazetteer
+
+def resolve_location(api_data):
+    return get_gazetteer().resolve(api_data)
+
+def renormalize_cached_locations(cache=None):
+    """Location of every listing in the Idealista cache, by property code"""
+    if cache is None:
+        from cache import get_property_cache
+        cache = get_property_cache()
+    gazetteer = get_gazetteer()
+    return {code: gazetteer.resolve(payload) for code, payload in cache.items() if isinstance(payload, dict)}
+
+if __name__ == '__main__':
+    locations = renormalize_cached_locations()
+    print(f"[LOCATION] {len(locations)} cached listings")
+    for location, count in collections.Counter(locations.values()).most_common():
+        print(f"[LOCATION] {count:6d}  {location}")
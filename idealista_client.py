@@ -0,0 +1,172 @@
+import gzip
+import http.client
+import json as pyjson
+import os
+import queue
+import threading
+import time
+import zlib
+from urllib.parse import urlsplit
+
+IDEALISTA_API_HOST = 'idealista2.p.rapidapi.com'
+CONNECT_TIMEOUT = float(os.getenv('IDEALISTA_CONNECT_TIMEOUT', '5'))
+READ_TIMEOUT = float(os.getenv('IDEALISTA_READ_TIMEOUT', '30'))
+MAX_IDLE_CONNECTIONS = 8
+
+# Errors that mean a pooled keep-alive connection was closed by the server
+_STALE_CONNECTION_ERRORS = (
+    http.client.RemoteDisconnected,
+    http.client.CannotSendRequest,
+    http.client.BadStatusLine,
+    BrokenPipeError,
+    ConnectionResetError
+)
+
+class IdealistaClient:
+    """Reusable Idealista API client with keep-alive TLS connections, gzip and timeouts"""
+    def __init__(self, api_key, host=IDEALISTA_API_HOST, connect_timeout=CONNECT_TIMEOUT,
+                 read_timeout=READ_TIMEOUT, max_idle_connections=MAX_IDLE_CONNECTIONS,
+                 port=None, use_tls=True):
+        self.api_key = api_key
+        self.host = host
+        self.port = port
+        self.use_tls = use_tls
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._idle = queue.LifoQueue(maxsize=max_idle_connections)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self.totals = {
+            'calls': 0,
+            'connections_opened': 0,
+            'bytes_transferred': 0,
+            'bytes_decoded': 0,
+            'ttfb_seconds': 0.0
+        }
+
+    @property
+    def last_call(self):
+        """Stats of the last request made from the calling thread"""
+        return getattr(self._local, 'last_call', None)
+
+    def _connect(self):
+        # Plain HTTP is only meant for local stand-in servers
+        connection_class = http.client.HTTPSConnection if self.use_tls else http.client.HTTPConnection
+        conn = connection_class(self.host, self.port, timeout=self.connect_timeout)
+        conn.connect()
+        # The connect timeout only covers the handshake, reads get their own limit
+        conn.sock.settimeout(self.read_timeout)
+        with self._lock:
+            self.totals['connections_opened'] += 1
+        return conn
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn, response):
+        if response.will_close:
+            conn.close()
+            return
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _send(self, conn, path):
+        headers = {
+            'x-rapidapi-key': self.api_key,
+            'x-rapidapi-host': self.host,
+            'Accept-Encoding': 'gzip, deflate',
+            'Connection': 'keep-alive'
+        }
+        started = time.perf_counter()
+        conn.request("GET", path, headers=headers)
+        res = conn.getresponse()
+        ttfb = time.perf_counter() - started
+        raw = res.read()
+        return res, raw, ttfb, time.perf_counter() - started
+
+    def get(self, path):
+        """GET a path and return the decoded body bytes"""
+        conn, reused = self._acquire()
+        try:
+            res, raw, ttfb, total = self._send(conn, path)
+        except _STALE_CONNECTION_ERRORS:
+            conn.close()
+            if not reused:
+                raise
+            # The server dropped an idle connection, retry once on a fresh one
+            conn, reused = self._connect(), False
+            try:
+                res, raw, ttfb, total = self._send(conn, path)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        self._release(conn, res)
+
+        encoding = (res.getheader('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            body = gzip.decompress(raw)
+        elif encoding == 'deflate':
+            body = zlib.decompress(raw)
+        else:
+            body = raw
+
+        stats = {
+            'path': path,
+            'status': res.status,
+            'reused_connection': reused,
+            'content_encoding': encoding or 'identity',
+            'bytes_transferred': len(raw),
+            'bytes_decoded': len(body),
+            'ttfb_seconds': ttfb,
+            'total_seconds': total
+        }
+        self._local.last_call = stats
+        with self._lock:
+            self.totals['calls'] += 1
+            self.totals['bytes_transferred'] += len(raw)
+            self.totals['bytes_decoded'] += len(body)
+            self.totals['ttfb_seconds'] += ttfb
+        return body
+
+    def get_json(self, path):
+        return pyjson.loads(self.get(path).decode("utf-8"))
+
+    def fetch_property(self, property_code):
+        """Fetch the detail payload for one property code"""
+        return self.get_json(f"/properties/detail?country=es&propertyCode={property_code}")
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+def get_idealista_client(api_key, host=IDEALISTA_API_HOST):
+    """Return the process-wide client for an API key, creating it on first use.
+
+    IDEALISTA_BASE_URL (e.g. http://127.0.0.1:8099) sends requests to a local stand-in
+    server instead (see local_services.FakeIdealistaServer).
+    """
+    base_url = os.getenv('IDEALISTA_BASE_URL')
+    with _clients_lock:
+        client = _clients.get((api_key, host, base_url))
+        if client is None:
+            if base_url:
+                parts = urlsplit(base_url)
+                client = IdealistaClient(api_key, parts.hostname, port=parts.port, use_tls=parts.scheme == 'https')
+            else:
+                client = IdealistaClient(api_key, host)
+            _clients[(api_key, host, base_url)] = client
+        return client
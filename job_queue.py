@@ -0,0 +1,105 @@
+import itertools
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '8'))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+class JobQueue:
+    """Runs submitted jobs on a shared worker pool and keeps their status for polling.
+
+    submit() returns a job ID straight away. The job function is called with an
+    `on_stage` keyword so it can report which stage it is in; status() returns the
+    current state, stage, per-stage timings and, once finished, the result.
+    on_finish, if given, is called with the job's status after each job ends.
+    """
+    def __init__(self, func, workers=JOB_WORKERS, keep_finished=500, on_finish=None):
+        self.func = func
+        self.on_finish = on_finish
+        self.workers = workers
+        self.keep_finished = keep_finished
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._jobs = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, url, **kwargs):
+        job_id = f"job-{next(self._ids)}-{int(time.time())}"
+        with self._lock:
+            self._jobs[job_id] = {
+                'id': job_id,
+                'url': url,
+                'state': QUEUED,
+                'stage': None,
+                'stages': {},
+                'result': None,
+                'submitted_at': time.time(),
+                'started_at': None,
+                'finished_at': None
+            }
+            self._prune()
+        self._executor.submit(self._run, job_id, url, kwargs)
+        return job_id
+
+    def _set_stage(self, job_id, stage):
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            if job['stage']:
+                job['stages'][job['stage']]['seconds'] = now - job['stages'][job['stage']]['started_at']
+            job['stage'] = stage
+            job['stages'][stage] = {'started_at': now, 'seconds': None}
+
+    def _run(self, job_id, url, kwargs):
+        with self._lock:
+            self._jobs[job_id]['state'] = RUNNING
+            self._jobs[job_id]['started_at'] = time.time()
+        try:
+            result = self.func(url, on_stage=lambda stage: self._set_stage(job_id, stage), **kwargs)
+        except Exception as e:
+            result = {"success": False, "error": str(e)}
+        now = time.time()
+        with self._lock:
+            job = self._jobs[job_id]
+            if job['stage']:
+                job['stages'][job['stage']]['seconds'] = now - job['stages'][job['stage']]['started_at']
+            job['result'] = result
+            job['state'] = DONE if result.get('success') else FAILED
+            job['finished_at'] = now
+        if self.on_finish:
+            try:
+                self.on_finish(self.status(job_id))
+            except Exception:
+                # A failing hook must not take the worker down
+                pass
+
+    def _prune(self):
+        # Forget the oldest finished jobs so a long-running app doesn't grow without bound
+        finished = [j for j in self._jobs.values() if j['finished_at']]
+        for job in sorted(finished, key=lambda j: j['finished_at'])[:max(0, len(finished) - self.keep_finished)]:
+            del self._jobs[job['id']]
+
+    def status(self, job_id):
+        """Snapshot of one job, or None if the ID is unknown"""
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            return dict(job, stages={stage: dict(timing) for stage, timing in job['stages'].items()})
+
+    def statuses(self, job_ids):
+        return [status for status in (self.status(job_id) for job_id in job_ids) if status]
+
+    def stats(self):
+        with self._lock:
+            states = [job['state'] for job in self._jobs.values()]
+        return {state: states.count(state) for state in (QUEUED, RUNNING, DONE, FAILED)}
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,110 @@
+import json as pyjson
+import os
+import sqlite3
+import threading
+import time
+import uuid
+import zlib
+
+from cache import CACHE_DIR
+
+JOURNAL_PATH = os.path.join(CACHE_DIR, 'journal.sqlite3')
+# Jobs untouched for this long are dropped, finished or not; 0 keeps them forever
+JOURNAL_MAX_AGE_DAYS = float(os.getenv('JOURNAL_MAX_AGE_DAYS', '14'))
+
+# Batch stages in the order they complete
+STAGES = ('fetched', 'extracted', 'analysed', 'written')
+
+def new_job_id():
+    return f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+class BatchJournal:
+    """Per-job record of the stages each URL has completed, with each stage's output.
+
+    A rerun with the same job_id reads the journal back and skips every stage already
+    completed for a URL, so no Idealista fetch or AI call is paid for twice. Writes go
+    through SQLite in WAL mode, so worker threads (and other processes) can share a job.
+    """
+    def __init__(self, job_id, path=JOURNAL_PATH):
+        self.job_id = job_id
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS stages ("
+            "job_id TEXT NOT NULL, url TEXT NOT NULL, stage TEXT NOT NULL, output BLOB, "
+            "completed_at REAL NOT NULL, PRIMARY KEY (job_id, url, stage))"
+        )
+
+    def record(self, url, stage, output=None):
+        """Mark a stage as completed for url, keeping its output for a resume"""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage {stage!r}")
+        blob = zlib.compress(pyjson.dumps(output, separators=(',', ':'), default=str).encode("utf-8"))
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO stages (job_id, url, stage, output, completed_at) VALUES (?, ?, ?, ?, ?)",
+                (self.job_id, url, stage, blob, time.time())
+            )
+
+    def completed(self, url):
+        """Outputs of the stages already completed for url, by stage name"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, output FROM stages WHERE job_id = ? AND url = ?", (self.job_id, url)
+            ).fetchall()
+        return {stage: pyjson.loads(zlib.decompress(output).decode("utf-8")) for stage, output in rows}
+
+    def last_stage(self, url):
+        done = self.completed(url)
+        finished = [stage for stage in STAGES if stage in done]
+        return finished[-1] if finished else None
+
+    def progress(self):
+        """How many URLs of this job have completed each stage"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT stage, COUNT(*) FROM stages WHERE job_id = ? GROUP BY stage", (self.job_id,)
+            ).fetchall()
+        counts = dict(rows)
+        return {stage: counts.get(stage, 0) for stage in STAGES}
+
+    def ai_fallbacks(self):
+        """URLs written with only their extracted fields because the AI analysis failed"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT url, output FROM stages WHERE job_id = ? AND stage = 'written'", (self.job_id,)
+            ).fetchall()
+        urls = set()
+        for url, output in rows:
+            written = pyjson.loads(zlib.decompress(output).decode("utf-8"))
+            if isinstance(written, dict) and written.get('ai_fallback'):
+                urls.add(url)
+        return urls
+
+    def forget(self):
+        """Drop this job's entries once they are no longer needed"""
+        with self._lock:
+            self._conn.execute("DELETE FROM stages WHERE job_id = ?", (self.job_id,))
+
+    def prune(self, max_age_days=JOURNAL_MAX_AGE_DAYS):
+        """Drop every other job last touched more than max_age_days ago; returns how many"""
+        if not max_age_days:
+            return 0
+        cutoff = time.time() - max_age_days * 86400
+        with self._lock:
+            jobs = [row[0] for row in self._conn.execute(
+                "SELECT job_id FROM stages WHERE job_id != ? GROUP BY job_id HAVING MAX(completed_at) < ?",
+                (self.job_id, cutoff)
+            )]
+            self._conn.executemany("DELETE FROM stages WHERE job_id = ?", [(job,) for job in jobs])
+        return len(jobs)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,506 @@
+"""Local stand-ins for the paid services, for tests, dry runs and benchmarks.
+
+FakeOpenAIServer implements the parts of the OpenAI API the engine uses (chat
+completions, streamed or not, file upload and the Batch API) on localhost. Start it
+and point the client at it:
+
+    server = FakeOpenAIServer().start()
+    os.environ['OPENAI_BASE_URL'] = server.base_url        # chat completions
+    os.environ['OPENAI_BATCH_BASE_URL'] = server.base_url  # batch_analysis.py
+
+FakeIdealistaServer replays recorded Idealista detail payloads (IDEALISTA_BASE_URL),
+and FakeSheetsClient / FakeWorksheet keep the Business Cases tab in memory. Every
+stand-in takes a Faults for latency and error injection.
+"""
+import email.parser
+import glob
+import gzip
+import itertools
+import json as pyjson
+import os
+import random
+import re
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from columns import COLUMNS
+from structured_output import ANALYSIS_SCHEMA
+
+class Faults:
+    """Latency and error injection for a stand-in: every call waits latency plus up to
+    jitter seconds, and fails with error_status for a share error_rate of calls"""
+    def __init__(self, latency=0.0, jitter=0.0, error_rate=0.0, error_status=500, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.calls = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def apply(self):
+        """Wait out the injected latency; returns an HTTP status to fail with, or None"""
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0.0)
+            fail = self.error_rate > 0 and self._random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        if delay > 0:
+            time.sleep(delay)
+        return self.error_status if fail else None
+
+NO_FAULTS = Faults()
+
+def estimate_tokens(text):
+    # Roughly four characters per token, enough for cost figures in dry runs
+    return max(1, len(text) // 4)
+
+def default_responder(body):
+    """Answer every chat completion with an analysis that satisfies the response schema"""
+    answer = {}
+    for col, spec in ANALYSIS_SCHEMA['properties'].items():
+        answer[col] = spec['enum'][0] if 'enum' in spec else f"Stand-in {col}"
+    return pyjson.dumps(answer)
+
+def chat_completion(body, content):
+    return {
+        'id': f"chatcmpl-{int(time.time() * 1000)}",
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'stand-in'),
+        'choices': [{
+            'index': 0,
+            'message': {'role': 'assistant', 'content': content},
+            'finish_reason': 'stop'
+        }],
+        'usage': completion_usage(body, content)
+    }
+
+def completion_usage(body, content):
+    prompt_tokens = estimate_tokens(''.join(str(m.get('content', '')) for m in body.get('messages', [])))
+    completion_tokens = estimate_tokens(content)
+    return {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens}
+
+def chat_completion_chunks(body, content, pieces=8):
+    """The chunks of a streamed chat completion, ending with the usage chunk include_usage asks for"""
+    base = {
+        'id': f"chatcmpl-{int(time.time() * 1000)}",
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': body.get('model', 'stand-in')
+    }
+    size = max(1, -(-len(content) // pieces))
+    chunks = [dict(base, choices=[{'index': 0, 'delta': {'role': 'assistant', 'content': ''}, 'finish_reason': None}])]
+    for start in range(0, len(content), size):
+        chunks.append(dict(base, choices=[{'index': 0, 'delta': {'content': content[start:start + size]}, 'finish_reason': None}]))
+    chunks.append(dict(base, choices=[{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]))
+    if (body.get('stream_options') or {}).get('include_usage'):
+        chunks.append(dict(base, choices=[], usage=completion_usage(body, content)))
+    return chunks
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _send(self, status, payload, content_type='application/json'):
+        data = payload if isinstance(payload, bytes) else pyjson.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _send_events(self, events):
+        # Server-sent events over chunked transfer encoding, so the connection stays reusable
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for event in events + ['[DONE]']:
+            data = f"data: {event if isinstance(event, str) else pyjson.dumps(event)}\n\n".encode("utf-8")
+            self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _chat_completion(self):
+        owner = self.server.owner
+        body = pyjson.loads(self._read_body())
+        status = owner.faults.apply()
+        if status:
+            self._send(status, {'error': {'message': f"Injected error {status}", 'type': 'server_error'}})
+            return
+        content = owner.responder(body)
+        if body.get('stream'):
+            self._send_events(chat_completion_chunks(body, content))
+        else:
+            self._send(200, chat_completion(body, content))
+
+    def do_POST(self):
+        path = self.path.split('?')[0].rstrip('/')
+        if path.endswith('/chat/completions'):
+            self._chat_completion()
+        elif path.endswith('/files'):
+            self._send(200, self.server.owner.upload_file(self.headers.get('Content-Type', ''), self._read_body()))
+        elif path.endswith('/batches'):
+            self._send(200, self.server.owner.create_batch(pyjson.loads(self._read_body())))
+        else:
+            self._send(404, {'error': {'message': f"Unknown endpoint {self.path}"}})
+
+    def do_GET(self):
+        path = self.path.split('?')[0].rstrip('/')
+        parts = path.split('/')
+        owner = self.server.owner
+        if '/files/' in path and path.endswith('/content') and parts[-2] in owner.files:
+            self._send(200, owner.files[parts[-2]]['content'], 'application/octet-stream')
+        elif '/batches/' in path and parts[-1] in owner.batches:
+            self._send(200, owner.batches[parts[-1]])
+        else:
+            self._send(404, {'error': {'message': f"Unknown endpoint {self.path}"}})
+
+class _Server(ThreadingHTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients drop keep-alive connections (a hedged or timed-out call); not worth a traceback
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+class FakeOpenAIServer:
+    """In-process HTTP server answering chat completions, file uploads and batches like the OpenAI API.
+    faults applies to chat completions only."""
+    def __init__(self, responder=default_responder, host='127.0.0.1', port=0, faults=None):
+        self.responder = responder
+        self.faults = faults or NO_FAULTS
+        self.files = {}
+        self.batches = {}
+        self._ids = itertools.count(1)
+        self._httpd = _Server((host, port), _Handler)
+        self._httpd.owner = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-openai', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _store_file(self, filename, purpose, content):
+        file_id = f"file-{next(self._ids)}"
+        self.files[file_id] = {
+            'id': file_id,
+            'object': 'file',
+            'bytes': len(content),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+            'status': 'processed',
+            'content': content
+        }
+        return {k: v for k, v in self.files[file_id].items() if k != 'content'}
+
+    def upload_file(self, content_type, body):
+        # Parse the multipart/form-data upload with the stdlib email parser
+        message = email.parser.BytesParser().parsebytes(
+            b'Content-Type: ' + content_type.encode("utf-8") + b'\r\n\r\n' + body
+        )
+        fields = {}
+        filename = 'upload.jsonl'
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            fields[name] = part.get_payload(decode=True)
+            if name == 'file':
+                filename = part.get_filename() or filename
+        purpose = (fields.get('purpose') or b'batch').decode("utf-8")
+        return self._store_file(filename, purpose, fields.get('file') or b'')
+
+    def create_batch(self, params):
+        """Run every request of the input file right away and publish the output file"""
+        input_file = self.files[params['input_file_id']]
+        output_lines = []
+        for raw_line in input_file['content'].decode("utf-8").splitlines():
+            if not raw_line.strip():
+                continue
+            line = pyjson.loads(raw_line)
+            body = line['body']
+            output_lines.append({
+                'id': f"batch_req_{next(self._ids)}",
+                'custom_id': line['custom_id'],
+                'response': {'status_code': 200, 'request_id': '', 'body': chat_completion(body, self.responder(body))},
+                'error': None
+            })
+        output = self._store_file(
+            'batch_output.jsonl', 'batch_output',
+            ''.join(pyjson.dumps(line) + '\n' for line in output_lines).encode("utf-8")
+        )
+        batch_id = f"batch_{next(self._ids)}"
+        now = int(time.time())
+        self.batches[batch_id] = {
+            'id': batch_id,
+            'object': 'batch',
+            'endpoint': params.get('endpoint'),
+            'input_file_id': params['input_file_id'],
+            'completion_window': params.get('completion_window', '24h'),
+            'status': 'completed',
+            'created_at': now,
+            'completed_at': now,
+            'output_file_id': output['id'],
+            'error_file_id': None,
+            'request_counts': {'total': len(output_lines), 'completed': len(output_lines), 'failed': 0}
+        }
+        return self.batches[batch_id]
+
+def sample_payload(property_code, images=30, seed=None):
+    """Synthetic Idealista detail payload shaped like a recorded one; images scales its size"""
+    rng = random.Random(seed if seed is not None else property_code)
+    size = rng.randint(80, 900)
+    price = size * rng.randint(3000, 12000)
+    municipality = rng.choice(['Calvià', 'Andratx', 'Palma', 'Sóller', 'Santanyí', 'Pollença'])
+    return {
+        'propertyCode': str(property_code),
+        'price': price,
+        'priceInfo': {'price': {'amount': price, 'currencySuffix': '€'}},
+        'operation': 'sale',
+        'propertyType': 'chalet',
+        'extendedPropertyType': rng.choice(['independantHouse', 'villa', 'flat']),
+        'size': size,
+        'plotArea': size * rng.randint(2, 8),
+        'rooms': rng.randint(2, 8),
+        'bathrooms': rng.randint(1, 6),
+        'municipality': municipality,
+        'province': 'Balears (Illes)',
+        'country': 'es',
+        'latitude': round(39.5 + rng.random() * 0.4, 6),
+        'longitude': round(2.4 + rng.random() * 0.8, 6),
+        'hasSeaView': rng.random() < 0.4,
+        'hasPool': rng.random() < 0.6,
+        'hasTerrace': rng.random() < 0.7,
+        'hasGarden': rng.random() < 0.5,
+        'hasLift': False,
+        'condition': rng.choice(['good', 'renew', 'newdevelopment']),
+        'description': ' '.join(rng.choice(['Stunning', 'villa', 'with', 'sea', 'views', 'in', municipality, 'close',
+                                            'to', 'the', 'marina', 'and', 'beach.']) for _ in range(300)),
+        'moreCharacteristics': {
+            'communityCosts': rng.randint(0, 600),
+            'energyCertificationType': rng.choice(['a', 'b', 'e', 'g']),
+            'constructedArea': size,
+            'usableArea': int(size * 0.85),
+            'floor': str(rng.randint(0, 3))
+        },
+        'multimedia': {
+            'images': [
+                {'url': f"https://img.idealista.com/blur/WEB_DETAIL/0/id.pro.es.image.master/{property_code}/{i}.jpg",
+                 'tag': rng.choice(['livingRoom', 'kitchen', 'bedroom', 'pool', 'views', 'facade']),
+                 'localizedName': 'Imagen', 'multimediaId': i}
+                for i in range(images)
+            ],
+            'videos': []
+        },
+        'contactInfo': {'commercialName': 'Stand-in Estates', 'phone1': {'phoneNumber': '971000000'}},
+        'suggestedTexts': {'title': f"Villa in {municipality}", 'subtitle': municipality},
+        'detailedType': {'typology': 'chalet', 'subTypology': 'independantHouse'},
+        'tracking': {'listingId': str(property_code), 'source': 'stand-in'}
+    }
+
+class _IdealistaHandler(_Handler):
+    def do_GET(self):
+        owner = self.server.owner
+        parts = urlsplit(self.path)
+        if not parts.path.rstrip('/').endswith('/properties/detail'):
+            self._send(404, {'message': f"Unknown endpoint {self.path}"})
+            return
+        status = owner.faults.apply()
+        if status:
+            self._send(status, {'message': f"Injected error {status}"})
+            return
+        property_code = (parse_qs(parts.query).get('propertyCode') or [''])[0]
+        raw, compressed = owner.encoded_payload(property_code)
+        if 'gzip' in (self.headers.get('Accept-Encoding') or ''):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(compressed)))
+            self.end_headers()
+            self.wfile.write(compressed)
+        else:
+            self._send(200, raw)
+
+class FakeIdealistaServer:
+    """In-process HTTP server replaying recorded Idealista detail payloads.
+
+    payloads maps property codes to recorded responses; an unknown code is answered with
+    one of them (picked by the code), so any number of listings can be replayed from a
+    few recordings. Payloads are encoded and gzipped once, so serving them costs little
+    CPU in the process being measured.
+    """
+    def __init__(self, payloads=None, host='127.0.0.1', port=0, faults=None):
+        self.payloads = payloads or {'0': sample_payload('0')}
+        self.faults = faults or NO_FAULTS
+        self._codes = sorted(self.payloads)
+        self._encoded = {}
+        self._lock = threading.Lock()
+        self._httpd = _Server((host, port), _IdealistaHandler)
+        self._httpd.owner = self
+        self._thread = None
+
+    @classmethod
+    def from_directory(cls, directory, **kwargs):
+        """Load <property code>.json recordings (see benchmark.py --record)"""
+        payloads = {}
+        for path in sorted(glob.glob(os.path.join(directory, '*.json'))):
+            with open(path, encoding='utf-8') as f:
+                payloads[os.path.splitext(os.path.basename(path))[0]] = pyjson.load(f)
+        if not payloads:
+            raise ValueError(f"No recorded payloads (*.json) in {directory}")
+        return cls(payloads, **kwargs)
+
+    @property
+    def base_url(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def payload_code(self, property_code):
+        if property_code in self.payloads:
+            return property_code
+        index = int(property_code) if property_code.isdigit() else sum(property_code.encode("utf-8"))
+        return self._codes[index % len(self._codes)]
+
+    def encoded_payload(self, property_code):
+        code = self.payload_code(property_code)
+        with self._lock:
+            encoded = self._encoded.get(code)
+            if encoded is None:
+                raw = pyjson.dumps(self.payloads[code], ensure_ascii=False).encode("utf-8")
+                encoded = self._encoded[code] = (raw, gzip.compress(raw))
+            return encoded
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name='fake-idealista', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+def _a1_to_rowcol(label):
+    match = re.match(r'([A-Z]+)(\d+)$', label.split('!')[-1].replace('$', ''))
+    col = 0
+    for letter in match.group(1):
+        col = col * 26 + ord(letter) - ord('A') + 1
+    return int(match.group(2)), col
+
+def _col_letters(col):
+    letters = ''
+    while col:
+        col, rem = divmod(col - 1, 26)
+        letters = chr(ord('A') + rem) + letters
+    return letters
+
+class FakeWorksheet:
+    """In-memory worksheet answering the gspread calls the engine makes.
+    Starts with the header row; faults applies to every call."""
+    def __init__(self, title='Business Cases 2025', rows=None, faults=None):
+        self.title = title
+        self.id = 0
+        self.faults = faults or NO_FAULTS
+        self.rows = [list(COLUMNS)] + [list(row) for row in rows or []]
+        self.calls = {}
+        self._lock = threading.Lock()
+
+    def _call(self, name):
+        status = self.faults.apply()
+        with self._lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+        if status:
+            raise Exception(f"APIError: [{status}] Injected error")
+
+    def _updates(self, first, count, width):
+        return {'updates': {
+            'updatedRange': f"'{self.title}'!A{first}:{_col_letters(max(1, width))}{first + count - 1}",
+            'updatedRows': count
+        }}
+
+    def col_values(self, col):
+        self._call('col_values')
+        with self._lock:
+            values = [row[col - 1] if len(row) >= col else '' for row in self.rows]
+        while values and values[-1] == '':
+            values.pop()
+        return values
+
+    def row_values(self, row, **kwargs):
+        # Cells are stored as written, so every value_render_option reads the same
+        self._call('row_values')
+        with self._lock:
+            return list(self.rows[row - 1]) if row <= len(self.rows) else []
+
+    def get_all_values(self):
+        self._call('get_all_values')
+        with self._lock:
+            return [list(row) for row in self.rows]
+
+    def append_rows(self, values, value_input_option='RAW', **kwargs):
+        self._call('append_rows')
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.extend([list(row) for row in values])
+        return self._updates(first, len(values), max((len(row) for row in values), default=1))
+
+    def append_row(self, values, value_input_option='RAW', **kwargs):
+        self._call('append_row')
+        with self._lock:
+            first = len(self.rows) + 1
+            self.rows.append(list(values))
+        return self._updates(first, 1, len(values))
+
+    def batch_update(self, data, value_input_option='RAW', **kwargs):
+        self._call('batch_update')
+        with self._lock:
+            for update in data:
+                row, col = _a1_to_rowcol(update['range'].split(':')[0])
+                for r, values in enumerate(update['values'], start=row):
+                    while len(self.rows) < r:
+                        self.rows.append([])
+                    target = self.rows[r - 1]
+                    target.extend([''] * (col - 1 + len(values) - len(target)))
+                    target[col - 1:col - 1 + len(values)] = values
+        return {'totalUpdatedCells': sum(len(v) for update in data for v in update['values'])}
+
+class FakeSpreadsheet:
+    def __init__(self, title, worksheets):
+        self.title = title
+        self.id = f"stand-in-{title}"
+        self._worksheets = {ws.title: ws for ws in worksheets}
+
+    def worksheet(self, title):
+        if title not in self._worksheets:
+            raise Exception(f"WorksheetNotFound: {title}")
+        return self._worksheets[title]
+
+class FakeSheetsClient:
+    """gspread client stand-in serving one spreadsheet, opened by title or key"""
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+
+    def open(self, title):
+        return self.spreadsheet
+
+    def open_by_key(self, key):
+        return self.spreadsheet
@@ -0,0 +1,181 @@
+import collections
+import functools
+import json as pyjson
+import os
+import threading
+import time
+
+from cache import CACHE_DIR
+from circuit_breaker import percentile
+
+METRICS_DIR = os.getenv('METRICS_DIR', os.path.join(CACHE_DIR, 'metrics'))
+METRIC_PREFIX = 're_engine'
+
+# Histogram buckets in seconds, from cache hits to slow o3 calls
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Samples kept per series for percentiles; bucket counts, sum and count cover every observation
+RESERVOIR_SIZE = 2048
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Span:
+    """Times a block of work; labels can still be set inside the block (e.g. cache='hit')"""
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+        self.seconds = None
+
+    def __enter__(self):
+        self._started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.seconds = time.perf_counter() - self._started
+        if exc_type is not None and 'outcome' not in self.labels:
+            self.labels['outcome'] = 'error'
+        self.metrics.observe(self.name, self.seconds, **self.labels)
+        return False
+
+class _Series:
+    def __init__(self):
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+        self.samples = collections.deque(maxlen=RESERVOIR_SIZE)
+
+    def add(self, seconds):
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+        self.samples.append(seconds)
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+
+class Metrics:
+    """Latency histograms per span name and label set, plus simple counters.
+
+    summary() gives count, mean and p50/p95/p99 per series; prometheus_text() renders the
+    same data in the Prometheus text exposition format (for the node_exporter textfile
+    collector); export() writes both to METRICS_DIR.
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self._series = {}
+        self._counters = collections.Counter()
+        self._lock = threading.Lock()
+
+    def span(self, name, **labels):
+        return Span(self, name, labels)
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = _Series()
+            series.add(seconds)
+
+    def count(self, name, amount=1, **labels):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self._lock:
+            self._counters[key] += amount
+
+    def reset(self):
+        with self._lock:
+            self._series.clear()
+            self._counters.clear()
+            self.started_at = time.time()
+
+    def summary(self):
+        """One entry per span series, slowest total time first, plus counters"""
+        with self._lock:
+            series = [(name, dict(labels), s.count, s.sum, s.max, list(s.samples)) for (name, labels), s in self._series.items()]
+            counters = [(name, dict(labels), value) for (name, labels), value in self._counters.items()]
+        spans = []
+        for name, labels, count, total, longest, samples in series:
+            spans.append({
+                'span': name,
+                'labels': labels,
+                'count': count,
+                'total_seconds': total,
+                'mean_seconds': total / count if count else 0.0,
+                'p50_seconds': percentile(samples, 50),
+                'p95_seconds': percentile(samples, 95),
+                'p99_seconds': percentile(samples, 99),
+                'max_seconds': longest
+            })
+        spans.sort(key=lambda s: s['total_seconds'], reverse=True)
+        return {
+            'started_at': self.started_at,
+            'elapsed_seconds': time.time() - self.started_at,
+            'spans': spans,
+            'counters': [{'name': name, 'labels': labels, 'value': value} for name, labels, value in counters]
+        }
+
+    def prometheus_text(self):
+        def label_text(labels, extra=None):
+            pairs = list(labels) + ([extra] if extra else [])
+            if not pairs:
+                return ''
+            return '{' + ','.join(f'{k}="{_escape_label(v)}"' for k, v in pairs) + '}'
+
+        metric = f"{METRIC_PREFIX}_span_seconds"
+        lines = [f"# HELP {metric} Time spent per pipeline span", f"# TYPE {metric} histogram"]
+        with self._lock:
+            for (name, labels), s in sorted(self._series.items()):
+                base = (('span', name),) + labels
+                for bound, count in zip(BUCKETS, s.buckets):
+                    lines.append(f"{metric}_bucket{label_text(base, ('le', bound))} {count}")
+                lines.append(f"{metric}_bucket{label_text(base, ('le', '+Inf'))} {s.count}")
+                lines.append(f"{metric}_sum{label_text(base)} {s.sum:.6f}")
+                lines.append(f"{metric}_count{label_text(base)} {s.count}")
+            names = sorted({name for name, _ in self._counters})
+            for counter in names:
+                full = f"{METRIC_PREFIX}_{counter}_total"
+                lines.append(f"# TYPE {full} counter")
+                for (name, labels), value in sorted(self._counters.items()):
+                    if name == counter:
+                        lines.append(f"{full}{label_text(labels)} {value}")
+        return '\n'.join(lines) + '\n'
+
+    def export(self, directory=METRICS_DIR, name='re_engine'):
+        """Write <name>.prom and <name>.json; returns their paths"""
+        os.makedirs(directory, exist_ok=True)
+        prom_path = os.path.join(directory, f"{name}.prom")
+        json_path = os.path.join(directory, f"{name}.json")
+        # Write then rename, so a collector never reads a half-written file
+        for path, text in ((prom_path, self.prometheus_text()), (json_path, pyjson.dumps(self.summary(), indent=2))):
+            with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(path + '.tmp', path)
+        return prom_path, json_path
+
+    def report_lines(self):
+        """Human-readable p50/p95/p99 per span, for end-of-run console output"""
+        lines = []
+        for s in self.summary()['spans']:
+            labels = ' '.join(f"{k}={v}" for k, v in s['labels'].items())
+            lines.append(
+                f"{s['span']}{' [' + labels + ']' if labels else ''}: n={s['count']} "
+                f"p50 {s['p50_seconds']:.2f}s p95 {s['p95_seconds']:.2f}s p99 {s['p99_seconds']:.2f}s "
+                f"total {s['total_seconds']:.1f}s"
+            )
+        return lines
+
+METRICS = Metrics()
+span = METRICS.span
+
+def timed(name, **labels):
+    """Decorator recording every call of the function as a span"""
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with METRICS.span(name, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorate
@@ -0,0 +1,112 @@
+import queue
+import threading
+import time
+
+# Marks the end of the input stream on a stage queue
+_DONE = object()
+
+class Stage:
+    """A named pipeline step run by a fixed number of worker threads"""
+    def __init__(self, name, func, workers=1):
+        if workers < 1:
+            raise ValueError(f"Stage '{name}' needs at least one worker")
+        self.name = name
+        self.func = func
+        self.workers = workers
+
+def _stage_worker(stage, inbox, outbox, remaining, lock, next_workers, stats):
+    while True:
+        job = inbox.get()
+        if job is _DONE:
+            # The last worker of this stage closes the next queue
+            with lock:
+                remaining[stage.name] -= 1
+                last = remaining[stage.name] == 0
+            if last:
+                for _ in range(next_workers):
+                    outbox.put(_DONE)
+            return
+
+        # Jobs that already failed pass through untouched
+        if job.get('error') is None:
+            started = time.perf_counter()
+            job.setdefault('started_at', started)
+            try:
+                job = stage.func(job) or job
+            except Exception as e:
+                job['error'] = f"{stage.name}: {e}"
+                job['failed_stage'] = stage.name
+            elapsed = time.perf_counter() - started
+            with lock:
+                stats[stage.name]['processed'] += 1
+                stats[stage.name]['busy_seconds'] += elapsed
+        outbox.put(job)
+
+def run_pipeline(items, stages, queue_size=8, on_result=None):
+    """Run items through stages connected by bounded queues and return results plus throughput stats.
+
+    Each item becomes a job dict ({'item': item}) that every stage function receives
+    and returns; 'latency_seconds' is its time from entering the first stage to leaving
+    the last. A stage that raises marks the job with 'error' and the job skips the
+    remaining stages. on_result is called from the caller's thread for each finished job.
+    """
+    if not stages:
+        raise ValueError("run_pipeline needs at least one stage")
+
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    # The output queue only holds one end marker, from the last stage
+    queues.append(queue.Queue(maxsize=queue_size))
+    lock = threading.Lock()
+    remaining = {stage.name: stage.workers for stage in stages}
+    stats = {stage.name: {'workers': stage.workers, 'processed': 0, 'busy_seconds': 0.0} for stage in stages}
+
+    threads = []
+    for i, stage in enumerate(stages):
+        next_workers = stages[i + 1].workers if i + 1 < len(stages) else 1
+        for n in range(stage.workers):
+            t = threading.Thread(
+                target=_stage_worker,
+                args=(stage, queues[i], queues[i + 1], remaining, lock, next_workers, stats),
+                name=f"{stage.name}-{n}",
+                daemon=True
+            )
+            t.start()
+            threads.append(t)
+
+    started = time.perf_counter()
+
+    def feed():
+        for item in items:
+            queues[0].put({'item': item, 'error': None})
+        for _ in range(stages[0].workers):
+            queues[0].put(_DONE)
+
+    feeder = threading.Thread(target=feed, name='pipeline-feeder', daemon=True)
+    feeder.start()
+
+    results = []
+    while True:
+        job = queues[-1].get()
+        if job is _DONE:
+            break
+        if 'started_at' in job:
+            job['latency_seconds'] = time.perf_counter() - job['started_at']
+        results.append(job)
+        if on_result:
+            on_result(job)
+
+    elapsed = time.perf_counter() - started
+    feeder.join()
+    for t in threads:
+        t.join()
+
+    succeeded = sum(1 for job in results if job.get('error') is None)
+    return {
+        'results': results,
+        'total': len(results),
+        'succeeded': succeeded,
+        'failed': len(results) - succeeded,
+        'elapsed_seconds': elapsed,
+        'listings_per_minute': (succeeded / elapsed * 60) if elapsed > 0 else 0.0,
+        'stages': stats
+    }
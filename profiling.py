@@ -0,0 +1,263 @@
+import collections
+import contextlib
+import cProfile
+import functools
+import io
+import os
+import pstats
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+
+from cache import CACHE_DIR
+
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(CACHE_DIR, 'profiles'))
+# Profile every run_job call (e.g. in the Streamlit app) without passing profile=True
+RE_ENGINE_PROFILE = os.getenv('RE_ENGINE_PROFILE', '0') == '1'
+PROFILE_TOP_N = int(os.getenv('PROFILE_TOP_N', '25'))
+# Seconds between stack samples for the flamegraph
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+# Modules whose cold import is timed in a fresh interpreter
+PROFILE_IMPORTS = tuple(m for m in os.getenv('PROFILE_IMPORTS', 're_engine_core').split(',') if m.strip())
+# Functions always listed in the summary, whatever their rank
+PROFILE_FOCUS = os.getenv('PROFILE_FOCUS', 'filter_api_data_for_ai|extract_all_idealista_fields|load_reform_costs|load_reform_table')
+
+_tracing_users = 0
+_tracing_lock = threading.Lock()
+
+def _start_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        _tracing_users += 1
+
+def _stop_tracing():
+    global _tracing_users
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0:
+            tracemalloc.stop()
+
+def _frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+@functools.lru_cache(maxsize=None)
+def import_profile(modules=PROFILE_IMPORTS):
+    """Cold import times of modules, from `python -X importtime` in a fresh interpreter.
+
+    Returns (self_us, cumulative_us, depth, module) rows in the order Python reports them,
+    children before their parent. Cached: import costs don't change within a process.
+    """
+    if not modules:
+        return []
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', 'import ' + ', '.join(modules)],
+        capture_output=True, text=True, timeout=300
+    )
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|', 2)
+        module = name.rstrip()
+        depth = (len(module) - len(module.lstrip())) // 2
+        rows.append((int(self_us), int(cumulative_us), depth, module.strip()))
+    return rows
+
+class Profiler:
+    """CPU profiles, stack samples and allocation snapshots per pipeline stage.
+
+    Wrap each stage in `with profiler.stage(name):` (or wrap a stage function with
+    profiler.wrap). Stages may run concurrently in several threads and repeat: every
+    invocation adds to its stage's totals. write() produces, in PROFILE_DIR:
+
+    - <name>.<stage>.pstats: cProfile data (snakeviz, gprof2dot, pstats)
+    - <name>.folded: sampled stacks rooted at the stage name, in the collapsed format
+      flamegraph.pl, speedscope and inferno read
+    - <name>.imports.folded: cold import times of PROFILE_IMPORTS in microseconds
+    - <name>.txt: top-N functions and memory growth per stage, and the allocation sites
+      holding the most memory allocated since the profiler started
+
+    Traced memory is process-wide, so the memory figures of concurrent stages include each
+    other's; profile a single listing for exact per-stage memory. Allocation sites come from
+    one snapshot in write(), as snapshots take seconds on large heaps.
+    """
+    def __init__(self, name, directory=PROFILE_DIR, top_n=PROFILE_TOP_N, sample_interval=PROFILE_SAMPLE_INTERVAL,
+                 imports=PROFILE_IMPORTS):
+        self.name = f"{name}-{time.strftime('%Y%m%d-%H%M%S')}"
+        self.directory = directory
+        self.top_n = top_n
+        self.sample_interval = sample_interval
+        self.imports = tuple(imports)
+        self.summary_path = os.path.join(directory, f"{self.name}.txt")
+        self._profiles = collections.defaultdict(list)
+        self._timings = collections.defaultdict(lambda: {'calls': 0, 'seconds': 0.0, 'retained_bytes': 0, 'peak_bytes': 0})
+        self._allocations = []
+        self._samples = collections.Counter()
+        self._notes = {}
+        self._active = {}
+        self._lock = threading.Lock()
+        self._sampler = None
+        self._stopped = threading.Event()
+        _start_tracing()
+        self._tracing = True
+        self._baseline = tracemalloc.take_snapshot()
+
+    def note(self, key, value):
+        """Extra context for the summary, e.g. the size of the payload being processed"""
+        with self._lock:
+            self._notes[key] = value
+
+    def _sample(self):
+        # Runs on its own thread: record where every thread inside a stage currently is
+        while not self._stopped.wait(self.sample_interval):
+            with self._lock:
+                active = dict(self._active)
+            if not active:
+                continue
+            frames = sys._current_frames()
+            for ident, stage in active.items():
+                frame = frames.get(ident)
+                stack = []
+                while frame is not None:
+                    if frame.f_code.co_filename != __file__ and not frame.f_code.co_filename.endswith('contextlib.py'):
+                        stack.append(_frame_label(frame.f_code))
+                    frame = frame.f_back
+                if stack:
+                    self._samples[';'.join([stage] + stack[::-1])] += 1
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        ident = threading.get_ident()
+        with self._lock:
+            self._active[ident] = name
+            if self._sampler is None:
+                self._sampler = threading.Thread(target=self._sample, name='profile-sampler', daemon=True)
+                self._sampler.start()
+        traced_before = tracemalloc.get_traced_memory()[0]
+        tracemalloc.reset_peak()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ allows one active cProfile per process; concurrent stages only get samples
+            profile = None
+        started = time.perf_counter()
+        try:
+            yield self
+        finally:
+            seconds = time.perf_counter() - started
+            if profile is not None:
+                profile.disable()
+            traced, peak = tracemalloc.get_traced_memory()
+            with self._lock:
+                self._active.pop(ident, None)
+                if profile is not None:
+                    self._profiles[name].append(profile)
+                timing = self._timings[name]
+                timing['calls'] += 1
+                timing['seconds'] += seconds
+                timing['retained_bytes'] += traced - traced_before
+                timing['peak_bytes'] = max(timing['peak_bytes'], peak)
+
+    def wrap(self, name, func):
+        """func, profiled as stage name on every call"""
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+
+    def _stats(self, name):
+        profiles = self._profiles.get(name)
+        if not profiles:
+            return None
+        stats = pstats.Stats(profiles[0], stream=io.StringIO())
+        if len(profiles) > 1:
+            stats.add(*profiles[1:])
+        return stats
+
+    def _hottest(self, stats):
+        # Function with the most time spent in its own code
+        (filename, line, func), (_, _, tottime, _, _) = max(stats.stats.items(), key=lambda item: item[1][2])
+        return f"{func} ({os.path.basename(filename)}:{line}) {tottime:.3f}s"
+
+    def report_lines(self):
+        """One line per stage: time, memory and the hottest function"""
+        lines = []
+        with self._lock:
+            timings = {name: dict(timing) for name, timing in self._timings.items()}
+        for name, timing in timings.items():
+            stats = self._stats(name)
+            lines.append(
+                f"{name}: n={timing['calls']} {timing['seconds']:.2f}s, {timing['retained_bytes'] / 2**20:+.1f} MiB retained, "
+                f"peak {timing['peak_bytes'] / 2**20:.1f} MiB"
+                + (f", hottest {self._hottest(stats)}" if stats and stats.stats else '')
+            )
+        return lines
+
+    def _summary_text(self):
+        out = io.StringIO()
+        out.write(f"Profile {self.name}\n")
+        for key, value in self._notes.items():
+            out.write(f"{key}: {value}\n")
+        for name, timing in self._timings.items():
+            out.write(f"\n=== Stage {name}: {timing['calls']} calls, {timing['seconds']:.3f}s wall, "
+                      f"{timing['retained_bytes'] / 2**20:+.1f} MiB retained, "
+                      f"peak traced memory {timing['peak_bytes'] / 2**20:.1f} MiB ===\n")
+            stats = self._stats(name)
+            if stats is None:
+                out.write("No CPU profile (another profiler was active); see the sampled stacks.\n")
+            else:
+                stats.stream = out
+                out.write(f"\n--- Top {self.top_n} by cumulative time ---\n")
+                stats.sort_stats('cumulative').print_stats(self.top_n)
+                out.write(f"\n--- Top {self.top_n} by own time ---\n")
+                stats.sort_stats('tottime').print_stats(self.top_n)
+                if PROFILE_FOCUS:
+                    out.write(f"\n--- Functions matching {PROFILE_FOCUS!r} ---\n")
+                    stats.sort_stats('cumulative').print_stats(PROFILE_FOCUS)
+        out.write(f"\n=== Top {self.top_n} allocation sites by memory still held ===\n")
+        for stat in self._allocations:
+            out.write(f"{stat.size_diff / 1024:12.1f} KiB {stat.count_diff:8d} blocks  {stat.traceback[0]}\n")
+        if self.imports:
+            rows = import_profile(self.imports)
+            out.write(f"\n=== Cold import of {', '.join(self.imports)}: "
+                      f"{sum(r[1] for r in rows if r[2] == 0) / 1e6:.3f}s ===\n")
+            for self_us, cumulative_us, _, module in sorted(rows, key=lambda r: r[1], reverse=True)[:self.top_n]:
+                out.write(f"{cumulative_us / 1000:10.1f} ms cumulative {self_us / 1000:10.1f} ms self  {module}\n")
+        return out.getvalue()
+
+    def write(self):
+        """Stop sampling and write every report; returns the summary path"""
+        self._stopped.set()
+        if self._sampler is not None:
+            self._sampler.join()
+        if self._tracing:
+            # Leave out the profiler's own bookkeeping
+            growth = tracemalloc.take_snapshot().compare_to(self._baseline, 'lineno')
+            own = (tracemalloc.__file__, __file__)
+            self._allocations = [s for s in growth if s.size_diff > 0 and s.traceback[0].filename not in own][:self.top_n]
+            self._baseline = None
+            _stop_tracing()
+            self._tracing = False
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock:
+            for name in self._profiles:
+                self._stats(name).dump_stats(os.path.join(self.directory, f"{self.name}.{name}.pstats"))
+            with open(os.path.join(self.directory, f"{self.name}.folded"), 'w', encoding='utf-8') as f:
+                for stack, count in self._samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            if self.imports:
+                # -X importtime lists children before their parent; reversed, each parent comes first
+                with open(os.path.join(self.directory, f"{self.name}.imports.folded"), 'w', encoding='utf-8') as f:
+                    stack = []
+                    for self_us, _, depth, module in reversed(import_profile(self.imports)):
+                        stack = stack[:depth] + [module]
+                        f.write(f"{';'.join(['import'] + stack)} {self_us}\n")
+            with open(self.summary_path, 'w', encoding='utf-8') as f:
+                f.write(self._summary_text())
+        return self.summary_path
@@ -0,0 +1,146 @@
+import json as pyjson
+import os
+import re
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Upper bound for the user message; the lowest-priority sections are trimmed first
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '6000'))
+
+# Extracted fields that only repeat text filter_api_data_for_ai deliberately removes
+REDUNDANT_EXTRACTED_FIELDS = {'Comments'}
+REDUNDANT_FEATURES = {'suggestedTexts'}
+
+_encoding = None
+
+def count_tokens(text):
+    """Count tokens with tiktoken when installed, else estimate at ~4 characters per token"""
+    global _encoding
+    if tiktoken is None:
+        return (len(text) + 3) // 4
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding('o200k_base')
+    return len(_encoding.encode(text))
+
+def compact_json(data):
+    return pyjson.dumps(data, separators=(',', ':'), ensure_ascii=False, default=str)
+
+def lean_extracted_fields(extracted_data, filtered_api_data):
+    """Drop extracted fields the model already gets elsewhere or that carry no information"""
+    lean = {}
+    for key, value in extracted_data.items():
+        if key in REDUNDANT_EXTRACTED_FIELDS or value == 'Info Missing':
+            continue
+        if key == '_extracted_features':
+            features = {}
+            for name, feature in value.items():
+                if name in REDUNDANT_FEATURES or feature in ('', None, {}, []):
+                    continue
+                # Same key and value already present in the filtered API data
+                if name in filtered_api_data and filtered_api_data[name] == feature:
+                    continue
+                features[name] = feature
+            if features:
+                lean[key] = features
+            continue
+        lean[key] = value
+    return lean
+
+def _trim_section(data, tokens_to_free):
+    """Drop entries from a dict/list section until roughly tokens_to_free are gone.
+
+    Dicts lose their largest entries first, so scalar key metrics outlive nested blobs;
+    lists lose their trailing items.
+    """
+    if isinstance(data, dict):
+        sizes = {key: count_tokens(compact_json({key: value})) for key, value in data.items()}
+        dropped = set()
+        for key in sorted(sizes, key=sizes.get, reverse=True):
+            if tokens_to_free <= 0:
+                break
+            dropped.add(key)
+            tokens_to_free -= sizes[key]
+        return {key: value for key, value in data.items() if key not in dropped}
+    if isinstance(data, list):
+        items = list(data)
+        while items and tokens_to_free > 0:
+            tokens_to_free -= count_tokens(compact_json(items.pop()))
+        return items
+    return None
+
+def _render(intro, sections, closing):
+    parts = [intro]
+    for title, data, _ in sections:
+        parts.append(f"{title}:\n{compact_json(data)}")
+    parts.append(closing)
+    return "\n\n".join(parts)
+
+def build_user_message(intro, sections, closing, token_budget=PROMPT_TOKEN_BUDGET):
+    """Assemble a compact user message from (title, data, priority) sections.
+
+    While the message is over token_budget, the lowest-priority section is trimmed
+    entry by entry and dropped once empty. Returns the message and per-section token counts.
+    """
+    sections = [s for s in sections if s[1]]
+    message = _render(intro, sections, closing)
+    total = count_tokens(message)
+    trimmed = []
+
+    order = [title for title, _, _ in sorted(sections, key=lambda s: s[2])]
+    while token_budget and total > token_budget and order:
+        index = next(i for i, s in enumerate(sections) if s[0] == order[0])
+        title, data, priority = sections[index]
+        reduced = _trim_section(data, total - token_budget)
+        if reduced:
+            sections[index] = (title, reduced, priority)
+        else:
+            del sections[index]
+            order.pop(0)
+        if title not in trimmed:
+            trimmed.append(title)
+        message = _render(intro, sections, closing)
+        total = count_tokens(message)
+
+    stats = {
+        'total_tokens': total,
+        'sections': {title: count_tokens(compact_json(data)) for title, data, _ in sections},
+        'trimmed_sections': trimmed,
+        'over_budget': bool(token_budget) and total > token_budget
+    }
+    return message, stats
+
+REFORM_COST_SET_NOTE = "Reform cost (m2) has already been set from our reference table - return it unchanged."
+
+def drop_reform_cost_instructions(system_message, closing):
+    """Prompt texts for a listing whose reform cost was looked up locally: the instructions to derive it
+    from the CSV table (which is then left out of the prompt) become a note to return it unchanged"""
+    system_message = re.sub(r'^4\. Reform cost \(m2\):.*?(?=^5\. )', f"4. {REFORM_COST_SET_NOTE}\n",
+                            system_message, count=1, flags=re.MULTILINE | re.DOTALL)
+    closing = '\n'.join(line for line in closing.splitlines() if 'CSV' not in line)
+    return system_message, f"{REFORM_COST_SET_NOTE}\n{closing}"
+
+def build_analysis_prompt(intro, closing, filtered_api_data, extracted_data, reform_costs,
+                          token_budget=PROMPT_TOKEN_BUDGET, include_reform_costs=True):
+    """Build the property analysis user message and report the saving against the old pretty-printed prompt"""
+    sections = [
+        ("Filtered API data (key metrics only)", filtered_api_data, 1),
+        ("Extracted fields", lean_extracted_fields(extracted_data, filtered_api_data), 3)
+    ]
+    if include_reform_costs:
+        sections.append(("Reform cost reference data", reform_costs, 2))
+    message, stats = build_user_message(intro, sections, closing, token_budget)
+
+    # The prompt as it used to be sent: full extracted fields, indent=2
+    baseline = "\n\n".join([
+        intro,
+        f"Filtered API data (key metrics only):\n{pyjson.dumps(filtered_api_data, indent=2)}",
+        f"Extracted fields:\n{pyjson.dumps(extracted_data, indent=2)}",
+        f"Reform cost reference data:\n{pyjson.dumps(reform_costs, indent=2)}",
+        closing
+    ])
+    stats['baseline_tokens'] = count_tokens(baseline)
+    stats['saved_tokens'] = stats['baseline_tokens'] - stats['total_tokens']
+    return message, stats
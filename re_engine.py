@@ -1,46 +1,34 @@
 from dotenv import load_dotenv
 load_dotenv(override=True)
+import contextlib
 import os
-import openai
-import gspread
-import http.client
+import sys
 import json as pyjson
-import pandas as pd
+from ai_analysis import analyze_with_fallback, model_health
+from api_filter import filter_payload
+from cache import get_analysis_cache, get_property_cache
+from columns import COLUMNS
+from cost_meter import BudgetExceeded, get_cost_meter
+from gazetteer import resolve_location
+from idealista_client import IDEALISTA_API_HOST, get_idealista_client
+from journal import JOURNAL_MAX_AGE_DAYS, STAGES, BatchJournal, new_job_id
+from metrics import METRICS, span, timed
+from profiling import Profiler
+from prompt_builder import build_analysis_prompt, drop_reform_cost_instructions
+from reform_lookup import load_reform_table, lookup_reform_cost
+from result_store import get_result_store
+from sheets import LinkIndex, SheetSink, sheet_spill_path, upsert_row
+from pipeline import Stage, run_pipeline
 
 SHEET_NAME = 'Raphael Project Selection 2025'
 TAB_NAME = 'Business Cases 2025'
 SERVICE_ACCOUNT_FILE = 'service_account.json'
 REFORM_COST_CSV = 'reform_cost.csv'
 
-# The only columns to fill, in order A-W:
-COLUMNS = [
-    'Location',
-    'Link',
-    'ChatGPT Business Case',
-    'Nota Simple',
-    'Priority',
-    'License Yes/No',
-    'Project purchase price',
-    'Seaview',
-    'Comments',
-    'Total surface (m2) Metros construidos',
-    'Plot size',
-    'Price m2',
-    'Reform cost (m2)',
-    'Aimed Sales Price without Real Estate Agent',
-    'Comparable Houses on the market 1',
-    'Comparable Houses on the market 2',
-    'Comparable Houses on the market 3',
-    'Macro location (1-10)',
-    'Micro location (1-10)',
-    'Sun direction',
-    'View',
-    'Building',
-    'Email Draft'
-]
-
 IDEALISTA_API_KEY = os.getenv('IDEALISTA_API_KEY')
-IDEALISTA_API_HOST = 'idealista2.p.rapidapi.com'
+
+# Part of the analysis cache key - bump whenever the AI prompt changes
+PROMPT_VERSION = 'critical-2025-09'
 
 if not IDEALISTA_API_KEY:
     print("[FATAL] IDEALISTA_API_KEY is not set. Please add it to your .env file or export it in your shell.")
@@ -48,12 +36,12 @@ if not IDEALISTA_API_KEY:
 if not os.getenv('OPENAI_API_KEY'):
     print("[WARNING] OPENAI_API_KEY is not set. OpenAI completions will fail.")
 
+@timed('reform_costs')
 def load_reform_costs():
-    """Load reform costs from CSV file"""
+    """Load reform costs from CSV file (parsed once per process, re-read when the file changes)"""
     try:
         if os.path.exists(REFORM_COST_CSV):
-            reform_df = pd.read_csv(REFORM_COST_CSV)
-            return reform_df.to_dict('records')
+            return load_reform_table(REFORM_COST_CSV)
         else:
             print(f"[WARNING] {REFORM_COST_CSV} not found. Using default values.")
             return []
@@ -62,6 +50,8 @@ def load_reform_costs():
         return []
 
 def get_gsheet_client():
+    # Imported on first use: gspread and google-auth are slow to import
+    import gspread
     gc = gspread.service_account(filename=SERVICE_ACCOUNT_FILE)
     return gc
 
@@ -73,25 +63,33 @@ def get_worksheet(gc, sheet_name, tab_name):
 def extract_property_code(url):
     return url.rstrip('/').split('/')[-1]
 
-def fetch_idealista_api(property_code):
-    conn = http.client.HTTPSConnection(IDEALISTA_API_HOST)
-    headers = {
-        'x-rapidapi-key': IDEALISTA_API_KEY,
-        'x-rapidapi-host': IDEALISTA_API_HOST
-    }
-    endpoint = f"/properties/detail?country=es&propertyCode={property_code}"
-    conn.request("GET", endpoint, headers=headers)
-    res = conn.getresponse()
-    data = res.read()
+def fetch_idealista_api(property_code, use_cache=True):
+    cache = get_property_cache() if use_cache else None
+    if cache:
+        cached = cache.get(property_code)
+        if cached is not None:
+            print(f"[CACHE] {property_code}: served from local cache")
+            METRICS.count('idealista_cache', outcome='hit')
+            return cached
+        METRICS.count('idealista_cache', outcome='miss')
+    
+    client = get_idealista_client(IDEALISTA_API_KEY, IDEALISTA_API_HOST)
     try:
-        parsed = pyjson.loads(data.decode("utf-8"))
+        with span('idealista_fetch'):
+            parsed = client.fetch_property(property_code)
         # DEBUG: Uncomment next line to inspect full API response
         # print("[DEBUG] Idealista raw JSON:", pyjson.dumps(parsed, indent=2))
+        stats = client.last_call
+        print(f"[FETCH] {property_code}: {stats['bytes_transferred']} bytes ({stats['content_encoding']}), TTFB {stats['ttfb_seconds'] * 1000:.0f}ms")
+        # Only cache real detail payloads, not quota or error responses
+        if cache and parsed and stats['status'] == 200:
+            cache.set(property_code, parsed)
         return parsed
-    except Exception as e:
+    except ValueError as e:
         print(f"[ERROR] Could not parse Idealista API response: {e}")
         return {}
 
+@timed('extract')
 def extract_all_idealista_fields(api_data, url):
     """Extract every possible field from Idealista API response"""
     d = {col: 'Info Missing' for col in COLUMNS}
@@ -107,62 +105,8 @@ def extract_all_idealista_fields(api_data, url):
     else:
         d['Project purchase price'] = 'Info Missing'
     
-    # Location - extract neighborhood/municipality for area name
-    location_area = ''
-    if api_data.get('neighborhood'):
-        location_area = api_data['neighborhood']
-    elif api_data.get('district'):
-        location_area = api_data['district']
-    elif api_data.get('municipality'):
-        location_area = api_data['municipality']
-    elif api_data.get('address'):
-        # Try to extract area from address
-        location_area = api_data['address']
-    
-    # Clean up common Mallorca location names
-    location_map = {
-        'calvia': 'Calvià',
-        'santa ponsa': 'Santa Ponsa',
-        'camp de mar': 'Camp de Mar',
-        'port andratx': 'Port Andratx',
-        'andratx': 'Andratx',
-        'portals': 'Portals',
-        'bendinat': 'Bendinat',
-        'son vida': 'Son Vida',
-        'palma': 'Palma',
-        'soller': 'Sóller',
-        'deia': 'Deià',
-        'valldemossa': 'Valldemossa',
-        'costa d\'en blanes': 'Costa d\'en Blanes',
-        'puerto portals': 'Puerto Portals',
-        'palmanova': 'Palmanova',
-        'magaluf': 'Magaluf',
-        'sol de mallorca': 'Sol de Mallorca',
-        'portals nous': 'Portals Nous',
-        'illetes': 'Illetes',
-        'cas catala': 'Cas Català',
-        'genova': 'Génova',
-        'son Espanyolet': 'Son Espanyolet',
-        'sa rapita': 'Sa Ràpita',
-        'es trenc': 'Es Trenc',
-        'santanyi': 'Santanyí',
-        'cala d\'or': 'Cala d\'Or',
-        'porto cristo': 'Porto Cristo',
-        'cala millor': 'Cala Millor',
-        'alcudia': 'Alcúdia',
-        'pollensa': 'Pollença',
-        'puerto pollensa': 'Puerto Pollença',
-        'formentor': 'Formentor'
-    }
-    
-    # Normalize and map location
-    location_lower = location_area.lower()
-    for key, value in location_map.items():
-        if key in location_lower:
-            location_area = value
-            break
-    
-    d['Location'] = location_area if location_area else 'Info Missing'
+    # Location - known Mallorca place named in the location fields, else the listing's coordinates
+    d['Location'] = resolve_location(api_data)
     
     # Size fields
     size = api_data.get('size') or api_data.get('constructedArea') or api_data.get('surface')
@@ -238,67 +182,32 @@ def extract_all_idealista_fields(api_data, url):
     
     return d
 
-def filter_api_data_for_ai(api_data):
-    """Filter API data to remove unnecessary verbose fields before sending to AI"""
+@timed('filter')
+def filter_api_data_for_ai(api_data, stats=None):
+    """Filter API data to remove unnecessary verbose fields before sending to AI.
+    If stats is a dict, it gets the number of entries and bytes removed."""
     if not api_data:
         return {}
-    
-    # Fields to exclude - images, videos, comments, and other verbose data
-    exclude_fields = {
-        'multimedia', 'images', 'videos', 'photos', 'gallery', 'picture', 'image',
-        'description', 'comments', 'detailedDescription', 'longDescription',
-        'suggestedTexts', 'texts', 'content', 'htmlDescription',
-        'videoUrl', 'video', 'videoTour', 'virtualTour', '3dTour',
-        'plan', 'floorPlan', 'blueprint', 'layout',
-        'contact', 'agency', 'agent', 'phone', 'email', 'website',
-        'advertisement', 'marketing', 'promotion', 'featured',
-        'metadata', 'tracking', 'analytics', 'stats'
-    }
-    
-    def clean_dict(data):
-        if isinstance(data, dict):
-            cleaned = {}
-            for key, value in data.items():
-                # Skip fields that contain verbose data
-                if any(exclude in key.lower() for exclude in exclude_fields):
-                    continue
-                
-                # Recursively clean nested dictionaries
-                if isinstance(value, dict):
-                    cleaned_value = clean_dict(value)
-                    if cleaned_value:  # Only add if not empty
-                        cleaned[key] = cleaned_value
-                elif isinstance(value, list):
-                    # Clean lists but skip if they contain media/verbose content
-                    if not any(exclude in key.lower() for exclude in exclude_fields):
-                        cleaned_list = []
-                        for item in value:
-                            if isinstance(item, dict):
-                                cleaned_item = clean_dict(item)
-                                if cleaned_item:
-                                    cleaned_list.append(cleaned_item)
-                            elif isinstance(item, str) and len(item) < 200:  # Skip very long strings
-                                cleaned_list.append(item)
-                            elif not isinstance(item, str):
-                                cleaned_list.append(item)
-                        if cleaned_list:
-                            cleaned[key] = cleaned_list
-                else:
-                    # Keep simple values, but truncate very long strings
-                    if isinstance(value, str) and len(value) > 500:
-                        continue  # Skip very long text fields
-                    cleaned[key] = value
-            return cleaned
-        return data
-    
-    return clean_dict(api_data)
+    return filter_payload(api_data, stats=stats)
 
-def ai_analyze_property(api_data, extracted_data, reform_costs):
-    """Use AI to analyze property and fill remaining fields"""
+@timed('ai_analysis')
+def ai_analyze_property(api_data, extracted_data, reform_costs, use_cache=True, stats=None):
+    """Use AI to analyze property and fill remaining fields (prompt token counts go into stats if given).
+    If the model call fails, the extracted fields are returned and stats gets 'ai_error'."""
+    # Imported on first use, so startup doesn't pay for the SDK
+    import openai
     client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
     
     # Filter API data to remove verbose/unnecessary fields
-    filtered_api_data = filter_api_data_for_ai(api_data)
+    filter_stats = {}
+    filtered_api_data = filter_api_data_for_ai(api_data, stats=filter_stats)
+    METRICS.count('api_filter_bytes', filter_stats.get('removed_bytes', 0), kind='removed')
+    
+    # Reform cost comes from our own table whenever the listing maps onto a row
+    reform_cost = lookup_reform_cost(api_data, reform_costs)
+    if reform_cost:
+        extracted_data = dict(extracted_data)
+        extracted_data['Reform cost (m2)'] = reform_cost
     
     system_message = """You are a CRITICAL Mallorca real estate investment analyst. Your job is to evaluat the property objectively. Be harsh, realistic, and conservative in all estimates.
 
@@ -336,18 +245,9 @@ BE SKEPTICAL. Most properties are overpriced. Find the flaws. Don't sugarcoat.
 Return ONLY valid JSON with these exact keys in order:
 Location, Link, ChatGPT Business Case, Nota Simple, Priority, License Yes/No, Project purchase price, Seaview, Comments, Total surface (m2) Metros construidos, Plot size, Price m2, Reform cost (m2), Aimed Sales Price without Real Estate Agent, Comparable Houses on the market 1, Comparable Houses on the market 2, Comparable Houses on the market 3, Macro location (1-10), Micro location (1-10), Sun direction, View, Building, Email Draft"""
 
-    user_message = f"""Critically analyze this Mallorca property. Find the problems and risks:
-
-Filtered API data (key metrics only):
-{pyjson.dumps(filtered_api_data, indent=2)}
-
-Extracted fields:
-{pyjson.dumps(extracted_data, indent=2)}
+    intro = "Critically analyze this Mallorca property. Find the problems and risks:"
 
-Reform cost reference data:
-{pyjson.dumps(reform_costs, indent=2)}
-
-BE CRITICAL. Most properties are overpriced in Mallorca. Find what's wrong with this one.
+    closing = """BE CRITICAL. Most properties are overpriced in Mallorca. Find what's wrong with this one.
 Format all euro amounts as €NUMBER with no punctuation (€1500000 not €1,500,000).
 For Reform cost (m2), use the CSV data to determine cost PER SQUARE METER only (e.g., €4000), not total cost.
 Assume renovation will cost MORE than expected and take LONGER.
@@ -355,110 +255,368 @@ Be realistic about resale - who would actually buy this and why?
 
 Return ONLY the JSON object, no markdown, no extra text."""
 
+    if reform_cost:
+        system_message, closing = drop_reform_cost_instructions(system_message, closing)
+    
+    with span('prompt_build'):
+        user_message, prompt_stats = build_analysis_prompt(
+            intro, closing, filtered_api_data, extracted_data, reform_costs,
+            include_reform_costs=not reform_cost
+        )
+    if stats is not None:
+        stats['prompt'] = prompt_stats
+        stats['filter'] = filter_stats
+    print(f"[PROMPT] {prompt_stats['total_tokens']} input tokens ({prompt_stats['saved_tokens']} saved vs. the full prompt), "
+          f"{filter_stats.get('removed_bytes', 0)} bytes filtered from the API data")
+
     try:
-        response = client.chat.completions.create(
-            model="o3-2025-04-16",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            max_completion_tokens=2000
+        ai_data = analyze_with_fallback(
+            client,
+            system_message,
+            user_message,
+            PROMPT_VERSION,
+            {'filtered_api_data': filtered_api_data, 'extracted_data': extracted_data, 'reform_costs': reform_costs},
+            use_cache=use_cache
         )
-        
-        content = response.choices[0].message.content
-        # Clean potential markdown or extra text
-        if '```json' in content:
-            content = content.split('```json')[1].split('```')[0]
-        elif '```' in content:
-            content = content.split('```')[1].split('```')[0]
-        
-        ai_data = pyjson.loads(content.strip())
-        
-        # Merge with extracted data, preferring AI values for missing fields
-        final_data = {}
-        for col in COLUMNS:
-            if col in ai_data and ai_data[col] != 'Info Missing':
-                final_data[col] = ai_data[col]
-            else:
-                final_data[col] = extracted_data.get(col, 'Info Missing')
-        
-        return final_data
-        
+    except BudgetExceeded:
+        # Not a model failure: the run has to stop rather than write rows without analysis
+        raise
     except Exception as e:
-        print(f"[ERROR] AI analysis failed: {e}")
-        # Fallback: try with gpt-4o
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                max_tokens=2000,
-                temperature=0.3
-            )
-            content = response.choices[0].message.content
-            if '```json' in content:
-                content = content.split('```json')[1].split('```')[0]
-            elif '```' in content:
-                content = content.split('```')[1].split('```')[0]
-            
-            ai_data = pyjson.loads(content.strip())
-            
-            final_data = {}
-            for col in COLUMNS:
-                if col in ai_data and ai_data[col] != 'Info Missing':
-                    final_data[col] = ai_data[col]
-                else:
-                    final_data[col] = extracted_data.get(col, 'Info Missing')
-            
-            return final_data
-        except Exception as e2:
-            print(f"[ERROR] Fallback AI also failed: {e2}")
-            # Return extracted data as-is
-            return {col: extracted_data.get(col, 'Info Missing') for col in COLUMNS}
-
-def process_property(url, worksheet):
+        print(f"[ERROR] {e}")
+        if stats is not None:
+            stats['ai_error'] = str(e)
+        # Return extracted data as-is
+        return {col: extracted_data.get(col, 'Info Missing') for col in COLUMNS}
+    
+    # Merge with extracted data, preferring AI values for missing fields
+    final_data = {}
+    for col in COLUMNS:
+        if col in ai_data and ai_data[col] != 'Info Missing':
+            final_data[col] = ai_data[col]
+        else:
+            final_data[col] = extracted_data.get(col, 'Info Missing')
+    if reform_cost:
+        final_data['Reform cost (m2)'] = reform_cost
+    
+    return final_data
+
+@timed('listing')
+def process_property(url, worksheet, use_cache=True, sink=None, link_index=None, profiler=None):
     print(f"[1/5] Processing property: {url}")
+
+    def profiled(name):
+        return profiler.stage(name) if profiler else contextlib.nullcontext()
     
     # Load reform costs
     print(f"[2/5] Loading reform cost data...")
-    reform_costs = load_reform_costs()
+    with profiled('reform_costs'):
+        reform_costs = load_reform_costs()
     
     # Extract property code
     property_code = extract_property_code(url)
     print(f"[3/5] Fetching Idealista API data for property {property_code}...")
     
     # Fetch from API
-    api_data = fetch_idealista_api(property_code)
+    with profiled('fetch'):
+        api_data = fetch_idealista_api(property_code, use_cache=use_cache)
     if not api_data:
         print("[ERROR] Failed to fetch property data")
         return
+    if profiler:
+        profiler.note('api_payload_bytes', len(pyjson.dumps(api_data, separators=(',', ':'))))
     
     # Extract all available fields
     print(f"[4/5] Extracting fields from API response...")
-    extracted_data = extract_all_idealista_fields(api_data, url)
+    with profiled('extract'):
+        extracted_data = extract_all_idealista_fields(api_data, url)
     
     # Use AI to analyze and fill remaining fields
     print(f"[5/5] Running AI analysis to complete missing fields...")
-    final_data = ai_analyze_property(api_data, extracted_data, reform_costs)
+    with profiled('ai'), get_cost_meter().track_listing(property_code) as usage:
+        final_data = ai_analyze_property(api_data, extracted_data, reform_costs, use_cache=use_cache)
+    print(f"[COST] {usage['prompt_tokens']} prompt + {usage['completion_tokens']} completion tokens "
+          f"({usage['reasoning_tokens']} reasoning) - ${usage['cost_usd']:.4f}")
     
     # Build row in exact column order
     row = [final_data.get(col, 'Info Missing') for col in COLUMNS]
     
-    # Write to sheet
-    worksheet.append_row(row, value_input_option='USER_ENTERED')
-    print(f"[DONE] Row written to Google Sheet!")
+    with profiled('write'):
+        # Keep the result in the local store; the CLI writes the sheet itself and marks the
+        # record replicated only once the sheet has it
+        store = get_result_store()
+        record_id = store.save(property_code, url, final_data, api_data, PROMPT_VERSION, usage=usage)
+        
+        # Write to sheet; a listing the index already knows gets its row refreshed in place
+        if link_index and link_index.contains(url):
+            outcome = upsert_row(worksheet, link_index, url, row)
+            store.mark_replicated([record_id])
+            print(f"[DONE] Row {outcome['row']} {outcome['action']} in Google Sheet ({outcome['cells']} cells written)")
+        elif sink:
+            sink.append(row, record_id)
+            print(f"[DONE] Row queued for Google Sheet ({sink.pending()} waiting)")
+        else:
+            with span('sheet_write', op='append_row'):
+                worksheet.append_row(row, value_input_option='USER_ENTERED')
+            store.mark_replicated([record_id])
+            print(f"[DONE] Row written to Google Sheet!")
     
     # Print summary of filled fields
     filled_count = sum(1 for col in COLUMNS if final_data.get(col) != 'Info Missing')
     print(f"[STATS] Filled {filled_count}/{len(COLUMNS)} fields")
 
+def read_batch_urls(source):
+    """Read listing URLs from a file path, or from stdin when source is '-'"""
+    if source == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(source, encoding='utf-8') as f:
+            lines = f.read().splitlines()
+    return [line.strip() for line in lines if line.strip() and not line.strip().startswith('#')]
+
+def process_batch(urls, worksheet, fetch_workers=4, extract_workers=1, ai_workers=4, write_workers=1, queue_size=8,
+                  use_cache=True, on_duplicate='skip', job_id=None, profiler=None):
+    """Process many URLs with fetch, extract, AI and sheet write running as concurrent stages.
+
+    on_duplicate: 'skip' drops listings already in the sheet, 'update' refreshes their rows
+    in place, 'append' writes them again. Every completed stage is journalled under job_id;
+    running again with the same job_id resumes each URL after its last completed stage;
+    listings whose AI analysis failed are analysed again and their rows refreshed. The
+    journal entries are dropped once the job finishes with nothing left to retry.
+    With a profiler, every stage call is profiled and added to that stage's totals.
+    """
+    journal = BatchJournal(job_id or new_job_id())
+    pruned = journal.prune()
+    if pruned:
+        print(f"[JOURNAL] Dropped {pruned} jobs older than {JOURNAL_MAX_AGE_DAYS:g} days")
+    progress = journal.progress()
+    retry_ai = set()
+    if any(progress.values()):
+        retry_ai = journal.ai_fallbacks()
+        print(f"[JOURNAL] Resuming job {journal.job_id}: " + ', '.join(f"{n} {stage}" for stage, n in progress.items())
+              + (f", {len(retry_ai)} AI analyses to retry" if retry_ai else ''))
+    else:
+        print(f"[JOURNAL] Job {journal.job_id} (rerun with --job-id {journal.job_id} to resume)")
+
+    # One read of the Link column
+    link_index = LinkIndex(worksheet)
+    if on_duplicate != 'append':
+        fresh = []
+        seen = set()
+        for url in urls:
+            code = extract_property_code(url)
+            # This job's own rows written without an analysis are kept, to be refreshed
+            if code in seen or (on_duplicate == 'skip' and link_index.contains(url) and url not in retry_ai):
+                continue
+            seen.add(code)
+            fresh.append(url)
+        if len(fresh) < len(urls):
+            print(f"[SKIP] {len(urls) - len(fresh)} listings are already in the sheet or repeated in the batch")
+        urls = fresh
+    print(f"[BATCH] Processing {len(urls)} properties...")
+    reform_costs = profiler.wrap('reform_costs', load_reform_costs)() if profiler else load_reform_costs()
+
+    def report_flush(flush):
+        print(f"[SHEET] Flushed {flush['rows']} rows in {flush['seconds']:.2f}s")
+
+    store = get_result_store()
+    meter = get_cost_meter()
+    run_before = dict(meter.run)
+    # The job's own spill file: resuming this job recovers exactly the rows it had not flushed
+    sink = SheetSink(worksheet, spill_path=sheet_spill_path(journal.job_id), on_flush=report_flush, store=store)
+    if sink.recovered:
+        print(f"[SHEET] Recovered {sink.recovered} unflushed rows from {sink.spill_path}")
+
+    # The first BudgetExceeded seen; every later listing fails before its fetch
+    budget_exhausted = []
+
+    def fetch_stage(job):
+        job['url'] = job['item']
+        job['property_code'] = extract_property_code(job['url'])
+        job['done'] = journal.completed(job['url'])
+        if 'fetched' in job['done']:
+            job['api_data'] = job['done']['fetched']
+            return job
+        # No paid Idealista fetch for a listing the AI budget could not analyse anyway
+        if budget_exhausted:
+            raise budget_exhausted[0]
+        try:
+            meter.throttle_delay()
+        except BudgetExceeded as e:
+            budget_exhausted.append(e)
+            raise
+        job['api_data'] = fetch_idealista_api(job['property_code'], use_cache=use_cache)
+        if not job['api_data']:
+            raise Exception("Failed to fetch property data")
+        journal.record(job['url'], 'fetched', job['api_data'])
+        return job
+
+    def extract_stage(job):
+        if 'extracted' in job['done']:
+            job['extracted_data'] = job['done']['extracted']
+            return job
+        job['extracted_data'] = extract_all_idealista_fields(job['api_data'], job['url'])
+        journal.record(job['url'], 'extracted', job['extracted_data'])
+        return job
+
+    def ai_stage(job):
+        if 'analysed' in job['done']:
+            job['final_data'] = job['done']['analysed']
+            return job
+        analysis_stats = {}
+        try:
+            with meter.track_listing(job['property_code']) as usage:
+                job['final_data'] = ai_analyze_property(job['api_data'], job['extracted_data'], reform_costs,
+                                                        use_cache=use_cache, stats=analysis_stats)
+        except BudgetExceeded as e:
+            budget_exhausted.append(e)
+            raise
+        job['usage'] = usage
+        if 'ai_error' in analysis_stats:
+            # Only the extracted fields: not journalled, so a resume asks the model again
+            job['ai_fallback'] = True
+        else:
+            journal.record(job['url'], 'analysed', job['final_data'])
+        return job
+
+    def write_stage(job):
+        final_data = job['final_data']
+        job['filled_count'] = sum(1 for col in COLUMNS if final_data.get(col) != 'Info Missing')
+        written = job['done'].get('written')
+        refresh = isinstance(written, dict) and written.get('ai_fallback') and not job.get('ai_fallback')
+        if 'written' in job['done'] and not refresh:
+            return job
+        row = [final_data.get(col, 'Info Missing') for col in COLUMNS]
+        # Pending until the sheet has the row, so a failed write is left for the replicator
+        record_id = store.save(job['property_code'], job['url'], final_data, job['api_data'], PROMPT_VERSION,
+                               usage=job.get('usage'))
+        if refresh or (on_duplicate == 'update' and link_index.row_for(job['url']) is not None):
+            # A refresh replaces the row written earlier with only the extracted fields
+            job['upsert'] = upsert_row(worksheet, link_index, job['url'], row)
+            store.mark_replicated([record_id])
+        else:
+            # The sink's spill file keeps the row across a crash, so it counts as written;
+            # the sink marks the record replicated once it is flushed
+            sink.append(row, record_id)
+            link_index.add(job['url'])
+        journal.record(job['url'], 'written', {'upsert': job.get('upsert'), 'ai_fallback': bool(job.get('ai_fallback'))})
+        return job
+
+    def report(job):
+        if job['error']:
+            print(f"[ERROR] {job['item']}: {job['error']}")
+        else:
+            upsert = job.get('upsert')
+            where = f", row {upsert['row']} {upsert['action']}" if upsert else ''
+            if job['done']:
+                where += f", resumed after '{[stage for stage in STAGES if stage in job['done']][-1]}'"
+            print(f"[DONE] {job['url']} ({job['filled_count']}/{len(COLUMNS)} fields{where})")
+
+    stages = [
+        Stage('fetch', fetch_stage, fetch_workers),
+        Stage('extract', extract_stage, extract_workers),
+        Stage('ai', ai_stage, ai_workers),
+        Stage('write', write_stage, write_workers)
+    ]
+    if profiler:
+        stages = [Stage(s.name, profiler.wrap(s.name, s.func), s.workers) for s in stages]
+    summary = run_pipeline(urls, stages, queue_size=queue_size, on_result=report)
+    try:
+        sink.close()
+    except Exception as e:
+        print(f"[ERROR] Final sheet flush failed, {sink.pending()} rows kept in {sink.spill_path} "
+              f"(rerun with --job-id {journal.job_id} to send them): {e}")
+    summary['sheet'] = sink.stats()
+    summary['job_id'] = journal.job_id
+    summary['ai_fallbacks'] = len(journal.ai_fallbacks())
+    if summary['failed'] == 0 and summary['ai_fallbacks'] == 0 and sink.pending() == 0:
+        # Nothing to resume: don't keep every payload of the job around
+        journal.forget()
+    elif summary['ai_fallbacks']:
+        print(f"[JOURNAL] {summary['ai_fallbacks']} listings were written without an AI analysis; "
+              f"rerun with --job-id {journal.job_id} to retry them")
+    journal.close()
+    summary['usage'] = {key: meter.run[key] - run_before[key] for key in run_before}
+
+    print(f"[STATS] {summary['succeeded']}/{len(urls)} properties processed, {summary['failed']} failed")
+    if budget_exhausted:
+        print(f"[COST] Stopped early: {budget_exhausted[0]}. Rerun with --job-id {journal.job_id} once budget is available")
+    print(f"[STATS] Finished in {summary['elapsed_seconds']:.1f}s - {summary['listings_per_minute']:.2f} listings/minute")
+    sheet_stats = summary['sheet']
+    print(f"[STATS] Sheet: {sheet_stats['rows_flushed']} rows in {sheet_stats['flushes']} flushes, "
+          f"avg {sheet_stats['avg_rows_per_flush']:.1f} rows / {sheet_stats['avg_flush_seconds']:.2f}s per flush")
+    usage = summary['usage']
+    analysed = sum(1 for job in summary['results'] if job.get('usage') and job['usage']['calls'])
+    print(f"[COST] Batch: {usage['calls']} AI calls, {usage['prompt_tokens']} prompt + {usage['completion_tokens']} "
+          f"completion tokens ({usage['reasoning_tokens']} reasoning), ${usage['cost_usd']:.2f}"
+          + (f", ${usage['cost_usd'] / analysed:.4f} per analysed listing" if analysed else ''))
+    today = meter.day_totals()
+    print(f"[COST] Today: {today['calls']} AI calls, ${today['cost_usd']:.2f}"
+          + (f" of ${meter.daily_budget:.2f} daily budget" if meter.daily_budget else ''))
+    for model, health in model_health().items():
+        if health['calls'] or health['rejected']:
+            p50 = f"{health['latency_p50']:.1f}s" if health['latency_p50'] is not None else 'n/a'
+            p95 = f"{health['latency_p95']:.1f}s" if health['latency_p95'] is not None else 'n/a'
+            print(f"[STATS] {model}: breaker {health['state']}, {health['calls']} calls, {health['failures']} failed, "
+                  f"{health['rejected']} skipped, p50 {p50}, p95 {p95}")
+    if use_cache:
+        cache_stats = get_property_cache().stats()
+        print(f"[STATS] Idealista cache: {cache_stats['hits']} hits, {cache_stats['misses']} misses")
+        cache_stats = get_analysis_cache().stats()
+        print(f"[STATS] Analysis cache: {cache_stats['hits']} hits, {cache_stats['entries']} stored analyses")
+    return summary
+
 if __name__ == "__main__":
     import argparse
     parser = argparse.ArgumentParser(description='RE Engine: Real Estate Analysis Tool')
-    parser.add_argument('--url', type=str, required=True, help='Property listing URL to process')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--url', type=str, help='Property listing URL to process')
+    source.add_argument('--batch', type=str, metavar='FILE', help="File with one listing URL per line ('-' reads stdin)")
+    parser.add_argument('--fetch-workers', type=int, default=4, help='Concurrent Idealista fetches in batch mode')
+    parser.add_argument('--ai-workers', type=int, default=4, help='Concurrent AI analyses in batch mode')
+    parser.add_argument('--write-workers', type=int, default=1, help='Concurrent sheet writers in batch mode')
+    parser.add_argument('--queue-size', type=int, default=8, help='Capacity of the queue in front of each batch stage')
+    parser.add_argument('--no-cache', action='store_true', help='Bypass the local Idealista and AI analysis caches')
+    parser.add_argument('--job-id', type=str, help='Journal the batch under this ID; rerun with the same ID to resume it')
+    parser.add_argument('--profile', action='store_true', help='Record CPU profiles, flamegraph stacks and allocation snapshots per stage')
+    duplicates = parser.add_mutually_exclusive_group()
+    duplicates.add_argument('--allow-duplicates', action='store_true', help='Analyse listings that are already in the sheet again and append new rows')
+    duplicates.add_argument('--update-existing', action='store_true', help='Re-analyse listings that are already in the sheet and refresh their rows in place')
     args = parser.parse_args()
     gc = get_gsheet_client()
     worksheet = get_worksheet(gc, SHEET_NAME, TAB_NAME)
-    process_property(args.url, worksheet) 
\ No newline at end of file
+    on_duplicate = 'update' if args.update_existing else 'append' if args.allow_duplicates else 'skip'
+    profiler = Profiler('batch' if args.batch else f"listing-{extract_property_code(args.url)}") if args.profile else None
+    if args.batch:
+        process_batch(
+            read_batch_urls(args.batch),
+            worksheet,
+            fetch_workers=args.fetch_workers,
+            ai_workers=args.ai_workers,
+            write_workers=args.write_workers,
+            queue_size=args.queue_size,
+            use_cache=not args.no_cache,
+            on_duplicate=on_duplicate,
+            job_id=args.job_id,
+            profiler=profiler
+        )
+    else:
+        link_index = LinkIndex(worksheet)
+        if on_duplicate == 'skip' and link_index.contains(args.url):
+            print(f"[SKIP] {args.url} is already in the sheet (use --update-existing to refresh it)")
+        else:
+            process_property(
+                args.url, worksheet, use_cache=not args.no_cache,
+                link_index=link_index if on_duplicate == 'update' else None,
+                profiler=profiler
+            )
+    
+    # Where the time went, per span
+    for line in METRICS.report_lines():
+        print(f"[METRICS] {line}")
+    prom_path, json_path = METRICS.export()
+    print(f"[METRICS] Written to {prom_path} and {json_path}")
+    if profiler:
+        summary_path = profiler.write()
+        for line in profiler.report_lines():
+            print(f"[PROFILE] {line}")
+        print(f"[PROFILE] Summary in {summary_path}; pstats and flamegraph stacks (.folded) next to it")
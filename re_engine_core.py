@@ -1,52 +1,41 @@
 from dotenv import load_dotenv
 load_dotenv(override=True)
-import os
-import openai
-import gspread
-import http.client
+import contextlib
 import json as pyjson
-import pandas as pd
+import os
+import re
+from ai_analysis import analyze_with_fallback, model_health
+from api_filter import filter_payload
+from cache import get_analysis_cache, get_property_cache
+from columns import COLUMNS
+from cost_meter import get_cost_meter
+from gazetteer import resolve_location
+from idealista_client import IDEALISTA_API_HOST, get_idealista_client
+from profiling import RE_ENGINE_PROFILE, Profiler
+from prompt_builder import build_analysis_prompt, drop_reform_cost_instructions
+from reform_lookup import load_reform_table, lookup_reform_cost
+from metrics import METRICS, span, timed
+from result_store import get_result_store
+from sheets import (
+    get_cached_link_index, get_cached_replicator, get_cached_worksheet, invalidate_worksheet,
+    service_account_identity
+)
 
 SHEET_NAME = 'Raphael Project Selection 2025'
 TAB_NAME = 'Business Cases 2025'
 REFORM_COST_CSV = 'reform_cost.csv'
 
-# The only columns to fill, in order A-W:
-COLUMNS = [
-    'Location',
-    'Link',
-    'ChatGPT Business Case',
-    'Nota Simple',
-    'Priority',
-    'License Yes/No',
-    'Project purchase price',
-    'Seaview',
-    'Comments',
-    'Total surface (m2) Metros construidos',
-    'Plot size',
-    'Price m2',
-    'Reform cost (m2)',
-    'Aimed Sales Price without Real Estate Agent',
-    'Comparable Houses on the market 1',
-    'Comparable Houses on the market 2',
-    'Comparable Houses on the market 3',
-    'Macro location (1-10)',
-    'Micro location (1-10)',
-    'Sun direction',
-    'View',
-    'Building',
-    'Email Draft'
-]
-
 IDEALISTA_API_KEY = os.getenv('IDEALISTA_API_KEY')
-IDEALISTA_API_HOST = 'idealista2.p.rapidapi.com'
 
+# Part of the analysis cache key - bump whenever the AI prompt changes
+PROMPT_VERSION = 'objective-2025-09'
+
+@timed('reform_costs')
 def load_reform_costs():
-    """Load reform costs from CSV file"""
+    """Load reform costs from CSV file (parsed once per process, re-read when the file changes)"""
     try:
         if os.path.exists(REFORM_COST_CSV):
-            reform_df = pd.read_csv(REFORM_COST_CSV)
-            return reform_df.to_dict('records')
+            return load_reform_table(REFORM_COST_CSV)
         else:
             return []
     except Exception as e:
@@ -55,6 +44,8 @@ def load_reform_costs():
 
 def get_gsheet_client(service_account_info=None):
     """Get Google Sheets client using service account with proper error handling"""
+    # Imported on first use: gspread and google-auth are slow to import and most runs reuse the cached client
+    import gspread
     try:
         if service_account_info:
             # For Streamlit Cloud - use secrets
@@ -90,28 +81,82 @@ def get_worksheet(gc, sheet_name, tab_name):
     except Exception as e:
         raise Exception(f"Failed to access worksheet '{tab_name}' in sheet '{sheet_name}': {str(e)}")
 
+def get_sheet_handle(service_account_info=None):
+    """Process-wide worksheet for these credentials; authentication and lookup happen once"""
+    return get_cached_worksheet(
+        service_account_identity(service_account_info),
+        lambda: get_gsheet_client(service_account_info),
+        SHEET_NAME, TAB_NAME
+    )
+
+def get_link_index(service_account_info=None):
+    """Listings already in the Business Cases tab, read once per process and updated as rows are written"""
+    return get_cached_link_index(
+        service_account_identity(service_account_info), SHEET_NAME, TAB_NAME,
+        get_sheet_handle(service_account_info)
+    )
+
+def get_sheet_replicator(service_account_info=None, store=None):
+    """Process-wide background sync from the result store to the Business Cases tab"""
+    identity = service_account_identity(service_account_info)
+    return get_cached_replicator(
+        identity, SHEET_NAME, TAB_NAME, store or get_result_store(),
+        lambda: (get_sheet_handle(service_account_info), get_link_index(service_account_info)),
+        # The cached handle may be stale (revoked credentials, moved sheet); reopen on the next pass
+        on_error=lambda e: invalidate_worksheet(identity)
+    )
+
 def extract_property_code(url):
     return url.rstrip('/').split('/')[-1]
 
-def fetch_idealista_api(property_code):
+LISTING_URL_RE = re.compile(r'https?://(?:www\.|m\.)?idealista\.com/(?:[a-z]{2}/)?inmueble/(\d+)/?', re.IGNORECASE)
+
+def parse_listing_urls(text):
+    """Idealista listing URLs found in pasted text or an uploaded CSV, de-duplicated by property code.
+
+    Returns (urls, rejected): urls in first-seen order, normalised to
+    https://www.idealista.com/inmueble/<code>/, and the non-empty lines with no listing URL.
+    """
+    urls = []
+    seen = set()
+    rejected = []
+    for line in text.splitlines():
+        matches = LISTING_URL_RE.findall(line)
+        if not matches:
+            if line.strip() and not line.strip().startswith('#'):
+                rejected.append(line.strip())
+            continue
+        for code in matches:
+            if code not in seen:
+                seen.add(code)
+                urls.append(f"https://www.idealista.com/inmueble/{code}/")
+    return urls, rejected
+
+def fetch_idealista_api(property_code, use_cache=True):
+    cache = get_property_cache() if use_cache else None
+    if cache:
+        cached = cache.get(property_code)
+        if cached is not None:
+            METRICS.count('idealista_cache', outcome='hit')
+            return cached
+        METRICS.count('idealista_cache', outcome='miss')
+    
     if not IDEALISTA_API_KEY:
         raise ValueError("IDEALISTA_API_KEY is not set")
     
-    conn = http.client.HTTPSConnection(IDEALISTA_API_HOST)
-    headers = {
-        'x-rapidapi-key': IDEALISTA_API_KEY,
-        'x-rapidapi-host': IDEALISTA_API_HOST
-    }
-    endpoint = f"/properties/detail?country=es&propertyCode={property_code}"
-    conn.request("GET", endpoint, headers=headers)
-    res = conn.getresponse()
-    data = res.read()
+    client = get_idealista_client(IDEALISTA_API_KEY, IDEALISTA_API_HOST)
     try:
-        parsed = pyjson.loads(data.decode("utf-8"))
-        return parsed
-    except Exception as e:
+        with span('idealista_fetch'):
+            parsed = client.fetch_property(property_code)
+    except ValueError as e:
         raise Exception(f"Could not parse Idealista API response: {e}")
+    
+    # Only cache real detail payloads, not quota or error responses
+    if cache and parsed and client.last_call['status'] == 200:
+        cache.set(property_code, parsed)
+    return parsed
 
+@timed('extract')
 def extract_all_idealista_fields(api_data, url):
     """Extract every possible field from Idealista API response"""
     d = {col: 'Info Missing' for col in COLUMNS}
@@ -127,62 +172,8 @@ def extract_all_idealista_fields(api_data, url):
     else:
         d['Project purchase price'] = 'Info Missing'
     
-    # Location - extract neighborhood/municipality for area name
-    location_area = ''
-    if api_data.get('neighborhood'):
-        location_area = api_data['neighborhood']
-    elif api_data.get('district'):
-        location_area = api_data['district']
-    elif api_data.get('municipality'):
-        location_area = api_data['municipality']
-    elif api_data.get('address'):
-        # Try to extract area from address
-        location_area = api_data['address']
-    
-    # Clean up common Mallorca location names
-    location_map = {
-        'calvia': 'Calvià',
-        'santa ponsa': 'Santa Ponsa',
-        'camp de mar': 'Camp de Mar',
-        'port andratx': 'Port Andratx',
-        'andratx': 'Andratx',
-        'portals': 'Portals',
-        'bendinat': 'Bendinat',
-        'son vida': 'Son Vida',
-        'palma': 'Palma',
-        'soller': 'Sóller',
-        'deia': 'Deià',
-        'valldemossa': 'Valldemossa',
-        'costa d\'en blanes': 'Costa d\'en Blanes',
-        'puerto portals': 'Puerto Portals',
-        'palmanova': 'Palmanova',
-        'magaluf': 'Magaluf',
-        'sol de mallorca': 'Sol de Mallorca',
-        'portals nous': 'Portals Nous',
-        'illetes': 'Illetes',
-        'cas catala': 'Cas Català',
-        'genova': 'Génova',
-        'son Espanyolet': 'Son Espanyolet',
-        'sa rapita': 'Sa Ràpita',
-        'es trenc': 'Es Trenc',
-        'santanyi': 'Santanyí',
-        'cala d\'or': 'Cala d\'Or',
-        'porto cristo': 'Porto Cristo',
-        'cala millor': 'Cala Millor',
-        'alcudia': 'Alcúdia',
-        'pollensa': 'Pollença',
-        'puerto pollensa': 'Puerto Pollença',
-        'formentor': 'Formentor'
-    }
-    
-    # Normalize and map location
-    location_lower = location_area.lower()
-    for key, value in location_map.items():
-        if key in location_lower:
-            location_area = value
-            break
-    
-    d['Location'] = location_area if location_area else 'Info Missing'
+    # Location - known Mallorca place named in the location fields, else the listing's coordinates
+    d['Location'] = resolve_location(api_data)
     
     # Size fields
     size = api_data.get('size') or api_data.get('constructedArea') or api_data.get('surface')
@@ -258,70 +249,26 @@ def extract_all_idealista_fields(api_data, url):
     
     return d
 
-def filter_api_data_for_ai(api_data):
-    """Filter API data to remove unnecessary verbose fields before sending to AI"""
+@timed('filter')
+def filter_api_data_for_ai(api_data, stats=None):
+    """Filter API data to remove unnecessary verbose fields before sending to AI.
+    If stats is a dict, it gets the number of entries and bytes removed."""
     if not api_data:
         return {}
-    
-    # Fields to exclude - images, videos, comments, and other verbose data
-    exclude_fields = {
-        'multimedia', 'images', 'videos', 'photos', 'gallery', 'picture', 'image',
-        'description', 'comments', 'detailedDescription', 'longDescription',
-        'suggestedTexts', 'texts', 'content', 'htmlDescription',
-        'videoUrl', 'video', 'videoTour', 'virtualTour', '3dTour',
-        'plan', 'floorPlan', 'blueprint', 'layout',
-        'contact', 'agency', 'agent', 'phone', 'email', 'website',
-        'advertisement', 'marketing', 'promotion', 'featured',
-        'metadata', 'tracking', 'analytics', 'stats'
-    }
-    
-    def clean_dict(data):
-        if isinstance(data, dict):
-            cleaned = {}
-            for key, value in data.items():
-                # Skip fields that contain verbose data
-                if any(exclude in key.lower() for exclude in exclude_fields):
-                    continue
-                
-                # Recursively clean nested dictionaries
-                if isinstance(value, dict):
-                    cleaned_value = clean_dict(value)
-                    if cleaned_value:  # Only add if not empty
-                        cleaned[key] = cleaned_value
-                elif isinstance(value, list):
-                    # Clean lists but skip if they contain media/verbose content
-                    if not any(exclude in key.lower() for exclude in exclude_fields):
-                        cleaned_list = []
-                        for item in value:
-                            if isinstance(item, dict):
-                                cleaned_item = clean_dict(item)
-                                if cleaned_item:
-                                    cleaned_list.append(cleaned_item)
-                            elif isinstance(item, str) and len(item) < 200:  # Skip very long strings
-                                cleaned_list.append(item)
-                            elif not isinstance(item, str):
-                                cleaned_list.append(item)
-                        if cleaned_list:
-                            cleaned[key] = cleaned_list
-                else:
-                    # Keep simple values, but truncate very long strings
-                    if isinstance(value, str) and len(value) > 500:
-                        continue  # Skip very long text fields
-                    cleaned[key] = value
-            return cleaned
-        return data
-    
-    return clean_dict(api_data)
+    return filter_payload(api_data, stats=stats)
 
-def ai_analyze_property(api_data, extracted_data, reform_costs):
-    """Use AI to analyze property and fill remaining fields"""
-    if not os.getenv('OPENAI_API_KEY'):
-        raise ValueError("OPENAI_API_KEY is not set")
-    
-    client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
-    
+def build_analysis_request(api_data, extracted_data, reform_costs):
+    """Build the AI prompt for one property, shared by the sync and batch analysis paths"""
     # Filter API data to remove verbose/unnecessary fields
-    filtered_api_data = filter_api_data_for_ai(api_data)
+    filter_stats = {}
+    filtered_api_data = filter_api_data_for_ai(api_data, stats=filter_stats)
+    METRICS.count('api_filter_bytes', filter_stats.get('removed_bytes', 0), kind='removed')
+    
+    # Reform cost comes from our own table whenever the listing maps onto a row
+    reform_cost = lookup_reform_cost(api_data, reform_costs)
+    if reform_cost:
+        extracted_data = dict(extracted_data)
+        extracted_data['Reform cost (m2)'] = reform_cost
     
     system_message = """You are an experienced Mallorca real estate investment analyst. Your job is to provide objective, realistic, and thorough property evaluations. Apply healthy skepticism while being fair and balanced in your assessments.
 
@@ -367,18 +314,9 @@ BE OBJECTIVE: Evaluate each property on its own merits. Neither overly optimisti
 Return ONLY valid JSON with these exact keys in order:
 Location, Link, ChatGPT Business Case, Nota Simple, Priority, License Yes/No, Project purchase price, Seaview, Comments, Total surface (m2) Metros construidos, Plot size, Price m2, Reform cost (m2), Aimed Sales Price without Real Estate Agent, Comparable Houses on the market 1, Comparable Houses on the market 2, Comparable Houses on the market 3, Macro location (1-10), Micro location (1-10), Sun direction, View, Building, Email Draft"""
 
-    user_message = f"""Analyze this Mallorca property objectively and thoroughly:
-
-Filtered API data (key metrics only):
-{pyjson.dumps(filtered_api_data, indent=2)}
-
-Extracted fields:
-{pyjson.dumps(extracted_data, indent=2)}
-
-Reform cost reference data:
-{pyjson.dumps(reform_costs, indent=2)}
+    intro = "Analyze this Mallorca property objectively and thoroughly:"
 
-Provide a balanced, realistic assessment considering:
+    closing = """Provide a balanced, realistic assessment considering:
 - Market conditions and comparable properties
 - Location advantages and disadvantages
 - Investment potential and risks
@@ -391,106 +329,178 @@ Base your analysis on facts and realistic market expectations.
 
 Return ONLY the JSON object, no markdown, no extra text."""
 
-    try:
-        response = client.chat.completions.create(
-            model="o3-2025-04-16",
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_message}
-            ],
-            max_completion_tokens=2000
+    if reform_cost:
+        system_message, closing = drop_reform_cost_instructions(system_message, closing)
+    
+    with span('prompt_build'):
+        user_message, prompt_stats = build_analysis_prompt(
+            intro, closing, filtered_api_data, extracted_data, reform_costs,
+            include_reform_costs=not reform_cost
         )
-        
-        content = response.choices[0].message.content
-        # Clean potential markdown or extra text
-        if '```json' in content:
-            content = content.split('```json')[1].split('```')[0]
-        elif '```' in content:
-            content = content.split('```')[1].split('```')[0]
-        
-        ai_data = pyjson.loads(content.strip())
-        
-        # Merge with extracted data, preferring AI values for missing fields
-        final_data = {}
-        for col in COLUMNS:
-            if col in ai_data and ai_data[col] != 'Info Missing':
-                final_data[col] = ai_data[col]
-            else:
-                final_data[col] = extracted_data.get(col, 'Info Missing')
-        
-        return final_data
-        
-    except Exception as e:
-        # Fallback: try with gpt-4o
-        try:
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": system_message},
-                    {"role": "user", "content": user_message}
-                ],
-                max_tokens=2000,
-                temperature=0.3
-            )
-            content = response.choices[0].message.content
-            if '```json' in content:
-                content = content.split('```json')[1].split('```')[0]
-            elif '```' in content:
-                content = content.split('```')[1].split('```')[0]
-            
-            ai_data = pyjson.loads(content.strip())
-            
-            final_data = {}
-            for col in COLUMNS:
-                if col in ai_data and ai_data[col] != 'Info Missing':
-                    final_data[col] = ai_data[col]
-                else:
-                    final_data[col] = extracted_data.get(col, 'Info Missing')
-            
-            return final_data
-        except Exception as e2:
-            raise Exception(f"AI analysis failed: {e}, Fallback also failed: {e2}")
-
-def run_job(url, service_account_info=None):
-    """Main function to process a property URL and write to Google Sheets"""
+    return {
+        'system_message': system_message,
+        'user_message': user_message,
+        'extracted_data': extracted_data,
+        'reform_cost': reform_cost,
+        'prompt_stats': prompt_stats,
+        'filter_stats': filter_stats,
+        'key_data': {'filtered_api_data': filtered_api_data, 'extracted_data': extracted_data, 'reform_costs': reform_costs}
+    }
+
+def merge_ai_data(ai_data, request):
+    """Merge AI output with extracted data, preferring AI values for missing fields"""
+    extracted_data = request['extracted_data']
+    final_data = {}
+    for col in COLUMNS:
+        if col in ai_data and ai_data[col] != 'Info Missing':
+            final_data[col] = ai_data[col]
+        else:
+            final_data[col] = extracted_data.get(col, 'Info Missing')
+    if request['reform_cost']:
+        final_data['Reform cost (m2)'] = request['reform_cost']
+    return final_data
+
+@timed('ai_analysis')
+def ai_analyze_property(api_data, extracted_data, reform_costs, use_cache=True, stats=None):
+    """Use AI to analyze property and fill remaining fields (prompt token counts go into stats if given)"""
+    if not os.getenv('OPENAI_API_KEY'):
+        raise ValueError("OPENAI_API_KEY is not set")
+    
+    # Imported on first use, so startup doesn't pay for the SDK
+    import openai
+    client = openai.OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+    request = build_analysis_request(api_data, extracted_data, reform_costs)
+    if stats is not None:
+        stats['prompt'] = request['prompt_stats']
+        stats['filter'] = request['filter_stats']
+    
+    ai_data = analyze_with_fallback(
+        client,
+        request['system_message'],
+        request['user_message'],
+        PROMPT_VERSION,
+        request['key_data'],
+        use_cache=use_cache
+    )
+    return merge_ai_data(ai_data, request)
+
+@timed('listing')
+def run_job(url, service_account_info=None, use_cache=True, sink=None, on_duplicate='skip', store=None,
+            on_stage=None, profile=None):
+    """Main function to process a property URL, save the result and sync it to Google Sheets.
+
+    The result is saved to the result store (the system of record) and copied to the
+    sheet by a background replicator, or queued on `sink` when one is given (a SheetSink
+    created with the same store, so its flushes mark the records replicated).
+    on_duplicate decides what happens to a listing that is already in the sheet:
+    'skip' returns before any API or LLM call, 'append' analyses and appends it again,
+    'update' re-analyses it and rewrites the changed cells of its existing row.
+    on_stage, if given, is called with 'fetch', 'extract', 'ai' and 'write' as each stage starts.
+    profile (default: the RE_ENGINE_PROFILE setting) records a CPU profile and allocation
+    snapshot of every stage; the result's 'profile' is the path of the summary.
+    """
+    def stage(name):
+        if on_stage:
+            on_stage(name)
+
+    profiler = Profiler(f"run_job-{extract_property_code(url)}") if (RE_ENGINE_PROFILE if profile is None else profile) else None
+
+    def profiled(name):
+        return profiler.stage(name) if profiler else contextlib.nullcontext()
+
+    claimed = False
     try:
-        # Load reform costs
-        reform_costs = load_reform_costs()
-        
         # Extract property code
         property_code = extract_property_code(url)
         
+        # Skip listings that are already in the sheet (or being processed right now)
+        link_index = get_link_index(service_account_info)
+        claimed = link_index.claim(url)
+        if not claimed and on_duplicate == 'skip':
+            return {
+                "success": True,
+                "skipped": True,
+                "message": f"Property {property_code} is already in the Google Sheet - skipped.",
+                "property_code": property_code,
+                "row": link_index.row_for(url)
+            }
+        
+        # Load reform costs
+        with profiled('reform_costs'):
+            reform_costs = load_reform_costs()
+        
         # Fetch from API
-        api_data = fetch_idealista_api(property_code)
+        stage('fetch')
+        with profiled('fetch'):
+            api_data = fetch_idealista_api(property_code, use_cache=use_cache)
         if not api_data:
             return {"success": False, "error": "Failed to fetch property data from Idealista API"}
+        if profiler:
+            profiler.note('api_payload_bytes', len(pyjson.dumps(api_data, separators=(',', ':'))))
         
         # Extract all available fields
-        extracted_data = extract_all_idealista_fields(api_data, url)
+        stage('extract')
+        with profiled('extract'):
+            extracted_data = extract_all_idealista_fields(api_data, url)
         
         # Use AI to analyze and fill remaining fields
-        final_data = ai_analyze_property(api_data, extracted_data, reform_costs)
-        
-        # Get Google Sheets client and worksheet
-        gc = get_gsheet_client(service_account_info)
-        worksheet = get_worksheet(gc, SHEET_NAME, TAB_NAME)
+        stage('ai')
+        analysis_stats = {}
+        with profiled('ai'), get_cost_meter().track_listing(property_code) as usage:
+            final_data = ai_analyze_property(api_data, extracted_data, reform_costs, use_cache=use_cache, stats=analysis_stats)
         
         # Build row in exact column order
         row = [final_data.get(col, 'Info Missing') for col in COLUMNS]
         
-        # Write to sheet
-        worksheet.append_row(row, value_input_option='USER_ENTERED')
+        # Save to the result store; the sheet is a replica written in the background
+        stage('write')
+        store = store or get_result_store()
+        update = on_duplicate == 'update' and link_index.contains(url)
+        with profiled('write'):
+            if sink and not update:
+                # Pending until the sink flushes it; a sink created with this store marks it replicated then
+                record_id = store.save(property_code, url, final_data, api_data, PROMPT_VERSION, usage=usage)
+                sink.append(row, record_id)
+                written = "queued it for Google Sheet"
+            else:
+                if sink:
+                    # The listing's row may still be waiting in the sink
+                    sink.flush()
+                record_id = store.save(
+                    property_code, url, final_data, api_data, PROMPT_VERSION,
+                    sheet_action='upsert' if update else 'append', usage=usage
+                )
+                get_sheet_replicator(service_account_info, store).notify()
+                written = "saved it; the Google Sheet is updated in the background"
+        link_index.add(url)
+        claimed = False
         
         # Count filled fields
         filled_count = sum(1 for col in COLUMNS if final_data.get(col) != 'Info Missing')
         
         return {
             "success": True, 
-            "message": f"Successfully processed property and wrote to Google Sheet! Filled {filled_count}/{len(COLUMNS)} fields.",
+            "message": f"Successfully processed property and {written}! Filled {filled_count}/{len(COLUMNS)} fields.",
             "filled_fields": filled_count,
             "total_fields": len(COLUMNS),
-            "property_code": property_code
+            "property_code": property_code,
+            "record_id": record_id,
+            "cost_usd": usage['cost_usd'],
+            "tokens": {key: usage[key] for key in ('prompt_tokens', 'cached_tokens', 'completion_tokens', 'reasoning_tokens')},
+            "prompt_tokens": analysis_stats['prompt']['total_tokens'],
+            "prompt_tokens_saved": analysis_stats['prompt']['saved_tokens'],
+            "api_bytes_filtered": analysis_stats['filter'].get('removed_bytes', 0),
+            "idealista_cache": get_property_cache().stats() if use_cache else None,
+            "analysis_cache": get_analysis_cache().stats() if use_cache else None,
+            "model_health": model_health(),
+            "profile": profiler.summary_path if profiler else None
         }
         
     except Exception as e:
-        return {"success": False, "error": str(e)} 
\ No newline at end of file
+        return {"success": False, "error": str(e)}
+    finally:
+        # Nothing was written, so the listing may be tried again
+        if claimed:
+            link_index.release(url)
+        if profiler:
+            profiler.write() 
\ No newline at end of file
@@ -0,0 +1,168 @@
+import csv
+import datetime
+import os
+import threading
+
+# Idealista condition/status values -> reform_cost.csv condition
+CONDITION_MAP = {
+    'newdevelopment': 'new',
+    'new': 'new',
+    'newconstruction': 'new',
+    'good': 'good',
+    'renew': 'needs_renovation',
+    'torenovate': 'needs_renovation',
+    'needsrenovation': 'needs_renovation',
+    'needs_renovation': 'needs_renovation',
+    'ruin': 'poor',
+    'poor': 'poor'
+}
+
+# Idealista propertyType / extendedPropertyType / subTypology -> reform_cost.csv building_type
+BUILDING_TYPE_MAP = {
+    'chalet': 'villa',
+    'villa': 'villa',
+    'independanthouse': 'villa',
+    'independenthouse': 'villa',
+    'countryhouse': 'villa',
+    'terracedhouse': 'townhouse',
+    'semidetachedhouse': 'townhouse',
+    'townhouse': 'townhouse',
+    'penthouse': 'penthouse',
+    'flat': 'apartment',
+    'apartment': 'apartment',
+    'duplex': 'apartment',
+    'studio': 'apartment',
+    'homes': 'apartment'
+}
+
+_tables = {}
+_tables_lock = threading.Lock()
+
+def _typed(value):
+    """CSV cell as an int or float when it is a number, as pandas.read_csv would give it (None if empty)"""
+    if value is None or not value.strip():
+        return None
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+def load_reform_table(path):
+    """Rows of a reform cost CSV as dicts; parsed once and again only when the file changes"""
+    stat = os.stat(path)
+    version = (stat.st_mtime_ns, stat.st_size)
+    with _tables_lock:
+        cached = _tables.get(path)
+    if cached and cached[0] == version:
+        return cached[1]
+    with open(path, newline='', encoding='utf-8-sig') as f:
+        rows = [{key: _typed(value) for key, value in row.items()} for row in csv.DictReader(f)]
+    with _tables_lock:
+        _tables[path] = (version, rows)
+    return rows
+
+def _normalize(value):
+    return str(value or '').replace(' ', '').replace('-', '').lower()
+
+def _parse_age_range(age_range):
+    """'6-15' -> (6, 15), '30+' -> (30, None)"""
+    text = str(age_range).strip()
+    if text.endswith('+'):
+        return int(text[:-1]), None
+    low, high = text.split('-')
+    return int(low), int(high)
+
+def _age_in_range(age, bounds):
+    low, high = bounds
+    return age >= low and (high is None or age <= high)
+
+class ReformCostIndex:
+    """In-memory index over reform_cost.csv rows for deterministic cost-per-m2 lookups"""
+    def __init__(self, rows):
+        self.rows = rows
+        self._by_condition = {}
+        self._by_type = {}
+        for row in rows:
+            condition = str(row.get('condition', '')).strip()
+            building_type = str(row.get('building_type', '')).strip()
+            try:
+                bounds = _parse_age_range(row.get('age_range', ''))
+            except ValueError:
+                bounds = None
+            entry = (bounds, row)
+            self._by_condition.setdefault((condition, building_type), []).append(entry)
+            self._by_type.setdefault(building_type, []).append(entry)
+
+    def lookup(self, condition, building_type, age=None):
+        """Return the matching row, or None when the listing cannot be placed in the table.
+
+        A known condition picks the row directly (age only breaks ties); without a
+        condition the building age selects the age_range instead.
+        """
+        if condition:
+            candidates = self._by_condition.get((condition, building_type), [])
+        elif age is not None:
+            candidates = self._by_type.get(building_type, [])
+        else:
+            return None
+        if age is not None:
+            for bounds, row in candidates:
+                if bounds and _age_in_range(age, bounds):
+                    return row
+            if not condition:
+                return None
+        return candidates[0][1] if candidates else None
+
+def listing_condition(api_data):
+    if api_data.get('newDevelopment'):
+        return 'new'
+    for field in ('condition', 'status'):
+        condition = CONDITION_MAP.get(_normalize(api_data.get(field)))
+        if condition:
+            return condition
+    return None
+
+def listing_building_type(api_data):
+    detailed = api_data.get('detailedType') or {}
+    for value in (api_data.get('extendedPropertyType'), detailed.get('subTypology'),
+                  detailed.get('typology'), api_data.get('propertyType')):
+        building_type = BUILDING_TYPE_MAP.get(_normalize(value))
+        if building_type:
+            return building_type
+    return None
+
+def listing_age(api_data):
+    characteristics = api_data.get('moreCharacteristics') or {}
+    year = api_data.get('constructionYear') or characteristics.get('constructionYear')
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        return None
+    age = datetime.date.today().year - year
+    return age if age >= 0 else None
+
+_index = None
+
+def get_reform_index(reform_costs):
+    """Index for the given rows, rebuilt only when the reform table changes"""
+    global _index
+    if _index is None or (_index.rows is not reform_costs and _index.rows != reform_costs):
+        _index = ReformCostIndex(reform_costs)
+    return _index
+
+def lookup_reform_cost(api_data, reform_costs):
+    """Reform cost per m2 as '€NUMBER' for an Idealista listing, or None if it cannot be determined locally"""
+    if not api_data or not reform_costs:
+        return None
+    building_type = listing_building_type(api_data)
+    if not building_type:
+        return None
+    row = get_reform_index(reform_costs).lookup(listing_condition(api_data), building_type, listing_age(api_data))
+    if not row:
+        return None
+    try:
+        return f"€{int(float(row['cost_per_m2']))}"
+    except (KeyError, TypeError, ValueError):
+        return None
@@ -0,0 +1,254 @@
+import abc
+import json as pyjson
+import os
+import re
+import sqlite3
+import threading
+import time
+import zlib
+
+from columns import COLUMNS
+
+# The system of record for analyses; the Google Sheet is a replica of it
+RESULT_STORE_BACKEND = os.getenv('RESULT_STORE_BACKEND', 'sqlite')
+RESULT_STORE_PATH = os.getenv('RESULT_STORE_PATH', os.path.join('data', 'results.sqlite3'))
+
+# Typed copies of sheet columns, so they can be filtered and aggregated in SQL
+TYPED_COLUMNS = {
+    'location': ('Location', 'TEXT'),
+    'priority': ('Priority', 'TEXT'),
+    'seaview': ('Seaview', 'INTEGER'),
+    'purchase_price': ('Project purchase price', 'REAL'),
+    'surface_m2': ('Total surface (m2) Metros construidos', 'REAL'),
+    'plot_m2': ('Plot size', 'REAL'),
+    'price_m2': ('Price m2', 'REAL'),
+    'reform_cost_m2': ('Reform cost (m2)', 'REAL'),
+    'aimed_sales_price': ('Aimed Sales Price without Real Estate Agent', 'REAL'),
+    'macro_location': ('Macro location (1-10)', 'INTEGER'),
+    'micro_location': ('Micro location (1-10)', 'INTEGER')
+}
+
+# AI usage of the analysis, from cost_meter's per-listing totals
+USAGE_COLUMNS = {
+    'cost_usd': 'REAL',
+    'prompt_tokens': 'INTEGER',
+    'completion_tokens': 'INTEGER',
+    'reasoning_tokens': 'INTEGER'
+}
+
+def parse_number(value):
+    """First number in a sheet value like '€1.250.000', '350 m2' or '€1,200', or None"""
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return float(value)
+    match = re.search(r'-?\d[\d.,]*', str(value or ''))
+    if not match:
+        return None
+    text = match.group(0).rstrip('.,')
+    # Separators followed by exactly three digits group thousands; a remaining one is decimal
+    text = re.sub(r'[.,](?=\d{3}(?:[.,]|$))', '', text).replace(',', '.')
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+def typed_value(value, sql_type):
+    if value in (None, '', 'Info Missing'):
+        return None
+    if sql_type == 'TEXT':
+        return str(value)
+    if str(value).strip().lower() in ('yes', 'no'):
+        return 1 if str(value).strip().lower() == 'yes' else 0
+    number = parse_number(value)
+    if number is None:
+        return None
+    return int(number) if sql_type == 'INTEGER' else number
+
+class ResultStore(abc.ABC):
+    """Interface every result store backend implements; a backend missing a method can't be created"""
+    @abc.abstractmethod
+    def save(self, property_code, link, fields, api_payload=None, prompt_version=None, sheet_action='append',
+             replicated=False, usage=None):
+        """Record one analysis and return its id; the latest record per property code is current.
+        usage is the listing's token and cost totals (see cost_meter.CostMeter.track_listing)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def latest(self, property_code):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def query(self, where=None, params=(), order_by='analyzed_at DESC', limit=None, latest_only=True):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def api_payload(self, record_id):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pending_replication(self, limit=500):
+        """Records not copied to the sheet yet, oldest first"""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def mark_replicated(self, record_ids):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def stats(self):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+class SQLiteResultStore(ResultStore):
+    """Result store in one SQLite file: typed columns, every sheet field and the raw Idealista payload"""
+    def __init__(self, path=RESULT_STORE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        typed = ''.join(f"{name} {sql_type}, " for name, (_, sql_type) in TYPED_COLUMNS.items())
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS analyses ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, property_code TEXT NOT NULL, link TEXT NOT NULL, "
+            f"analyzed_at REAL NOT NULL, prompt_version TEXT, {typed}"
+            "fields TEXT NOT NULL, api_payload BLOB, sheet_action TEXT NOT NULL DEFAULT 'append', "
+            "replicated_at REAL)"
+        )
+        # Stores created before a column existed get it added
+        existing = {row[1] for row in self._conn.execute("PRAGMA table_info(analyses)")}
+        for name, sql_type in USAGE_COLUMNS.items():
+            if name not in existing:
+                self._conn.execute(f"ALTER TABLE analyses ADD COLUMN {name} {sql_type}")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analyses_code ON analyses (property_code, id)")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS analyses_pending ON analyses (id) WHERE replicated_at IS NULL")
+
+    def save(self, property_code, link, fields, api_payload=None, prompt_version=None, sheet_action='append',
+             replicated=False, usage=None):
+        now = time.time()
+        values = {
+            'property_code': property_code,
+            'link': link,
+            'analyzed_at': now,
+            'prompt_version': prompt_version,
+            'fields': pyjson.dumps({col: fields.get(col, 'Info Missing') for col in COLUMNS}, ensure_ascii=False, default=str),
+            'api_payload': zlib.compress(pyjson.dumps(api_payload, separators=(',', ':')).encode("utf-8"))
+            if api_payload is not None else None,
+            'sheet_action': sheet_action,
+            'replicated_at': now if replicated else None
+        }
+        for name, (col, sql_type) in TYPED_COLUMNS.items():
+            values[name] = typed_value(fields.get(col), sql_type)
+        for name in USAGE_COLUMNS:
+            values[name] = usage.get(name) if usage else None
+        names = ', '.join(values)
+        placeholders = ', '.join('?' for _ in values)
+        with self._lock:
+            cursor = self._conn.execute(f"INSERT INTO analyses ({names}) VALUES ({placeholders})", list(values.values()))
+            return cursor.lastrowid
+
+    def _record(self, row):
+        record = {key: row[key] for key in row.keys() if key not in ('fields', 'api_payload')}
+        record['fields'] = pyjson.loads(row['fields'])
+        return record
+
+    def latest(self, property_code):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT * FROM analyses WHERE property_code = ? ORDER BY id DESC LIMIT 1", (property_code,)
+            ).fetchone()
+        return self._record(row) if row else None
+
+    def query(self, where=None, params=(), order_by='analyzed_at DESC', limit=None, latest_only=True):
+        """Records matching a SQL condition over the typed columns, e.g. query('priority = ? AND seaview = 1', ('A',))"""
+        conditions = []
+        if latest_only:
+            conditions.append("id IN (SELECT MAX(id) FROM analyses GROUP BY property_code)")
+        if where:
+            conditions.append(f"({where})")
+        sql = "SELECT * FROM analyses"
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        if order_by:
+            sql += f" ORDER BY {order_by}"
+        if limit:
+            sql += f" LIMIT {int(limit)}"
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [self._record(row) for row in rows]
+
+    def dataframe(self, latest_only=True):
+        """Typed columns of every (latest) analysis as a pandas DataFrame"""
+        import pandas as pd
+        records = self.query(latest_only=latest_only, order_by='id')
+        return pd.DataFrame([{k: v for k, v in r.items() if k != 'fields'} for r in records])
+
+    def export_parquet(self, path, latest_only=True):
+        """Write the analyses to a Parquet file (needs pyarrow or fastparquet)"""
+        self.dataframe(latest_only=latest_only).to_parquet(path, index=False)
+        return path
+
+    def api_payload(self, record_id):
+        with self._lock:
+            row = self._conn.execute("SELECT api_payload FROM analyses WHERE id = ?", (record_id,)).fetchone()
+        if not row or row[0] is None:
+            return None
+        return pyjson.loads(zlib.decompress(row[0]).decode("utf-8"))
+
+    def pending_replication(self, limit=500):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, property_code, link, fields, sheet_action FROM analyses "
+                "WHERE replicated_at IS NULL ORDER BY id LIMIT ?", (limit,)
+            ).fetchall()
+        return [
+            {
+                'id': row['id'],
+                'property_code': row['property_code'],
+                'link': row['link'],
+                'row': [pyjson.loads(row['fields']).get(col, 'Info Missing') for col in COLUMNS],
+                'sheet_action': row['sheet_action']
+            }
+            for row in rows
+        ]
+
+    def mark_replicated(self, record_ids):
+        if not record_ids:
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE analyses SET replicated_at = ? WHERE id = ?", [(now, i) for i in record_ids])
+
+    def stats(self):
+        with self._lock:
+            records, listings, pending = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT property_code), "
+                "COALESCE(SUM(CASE WHEN replicated_at IS NULL THEN 1 ELSE 0 END), 0) FROM analyses"
+            ).fetchone()
+        return {'records': records, 'listings': listings, 'pending_replication': pending}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+BACKENDS = {
+    'sqlite': SQLiteResultStore
+}
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_result_store():
+    """The process-wide result store selected by RESULT_STORE_BACKEND"""
+    global _store
+    with _store_lock:
+        if _store is None:
+            if RESULT_STORE_BACKEND not in BACKENDS:
+                raise ValueError(f"Unknown RESULT_STORE_BACKEND {RESULT_STORE_BACKEND!r} (choose from {', '.join(BACKENDS)})")
+            _store = BACKENDS[RESULT_STORE_BACKEND]()
+        return _store
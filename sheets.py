@@ -0,0 +1,539 @@
+import json as pyjson
+import os
+import re
+import threading
+import time
+import uuid
+
+from cache import CACHE_DIR
+from columns import COLUMNS
+from metrics import span
+
+SHEET_FLUSH_ROWS = int(os.getenv('SHEET_FLUSH_ROWS', '25'))
+SHEET_FLUSH_SECONDS = float(os.getenv('SHEET_FLUSH_SECONDS', '10'))
+# Write-behind spill files, one per batch job: sheet_spill-<job id>.jsonl
+SHEET_SPILL_DIR = os.getenv('SHEET_SPILL_DIR', CACHE_DIR)
+# Optional spreadsheet key; skips the Drive search that opening by title costs
+SHEET_ID = os.getenv('SHEET_ID')
+# How often the replicator copies new results from the result store to the sheet
+SHEET_REPLICATE_SECONDS = float(os.getenv('SHEET_REPLICATE_SECONDS', '5'))
+# Seconds before a cached LinkIndex re-reads the Link column, picking up rows edited or deleted by hand
+LINK_INDEX_TTL = float(os.getenv('LINK_INDEX_TTL', '60'))
+
+def sheet_spill_path(job_id):
+    return os.path.join(SHEET_SPILL_DIR, f"sheet_spill-{job_id}.jsonl")
+
+class SheetSink:
+    """Write-behind buffer that appends finished rows to a worksheet in batches.
+
+    Rows are flushed with one append_rows call, on a background thread, once max_rows are
+    waiting or the oldest row has waited max_delay seconds. Every buffered row is also written to a spill file
+    first; pass the spill path of a job (sheet_spill_path) so that resuming the job picks
+    up rows that were not flushed before a crash. Without one, the sink gets a file of its
+    own. Delivery is at-least-once: a crash between the Sheets call and rewriting the spill
+    file re-sends that batch. Rows appended with the result store record_id they come from
+    are marked replicated in `store` once flushed.
+    """
+    def __init__(self, worksheet, max_rows=SHEET_FLUSH_ROWS, max_delay=SHEET_FLUSH_SECONDS,
+                 spill_path=None, on_flush=None, store=None):
+        self.worksheet = worksheet
+        self.store = store
+        self.max_rows = max_rows
+        self.max_delay = max_delay
+        self.spill_path = spill_path or sheet_spill_path(f"{os.getpid()}-{uuid.uuid4().hex[:6]}")
+        self.on_flush = on_flush
+        self.flushes = []
+        self.last_error = None
+        self._buffer = []
+        self._record_ids = []
+        self._oldest = None
+        self._lock = threading.Lock()
+        # One append_rows call at a time; _lock is not held during it, so appends go on
+        self._flush_lock = threading.Lock()
+        self._full = threading.Event()
+        self._closed = threading.Event()
+
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.recovered = self._load_spill()
+        self._spill = open(self.spill_path, 'a', encoding='utf-8')
+        self._timer = threading.Thread(target=self._flush_when_due, name='sheet-sink', daemon=True)
+        self._timer.start()
+
+    def _load_spill(self):
+        if not os.path.exists(self.spill_path):
+            return 0
+        with open(self.spill_path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = pyjson.loads(line)
+                except ValueError:
+                    # A torn last line from a crash mid-write
+                    continue
+                # Older spill files hold bare rows
+                if isinstance(entry, dict):
+                    self._buffer.append(entry['row'])
+                    self._record_ids.append(entry.get('record_id'))
+                else:
+                    self._buffer.append(entry)
+                    self._record_ids.append(None)
+        if self._buffer:
+            self._oldest = time.monotonic()
+        return len(self._buffer)
+
+    def _spill_line(self, row, record_id):
+        return pyjson.dumps({'row': row, 'record_id': record_id}, ensure_ascii=False, default=str) + '\n'
+
+    def append(self, row, record_id=None):
+        with self._lock:
+            self._spill.write(self._spill_line(row, record_id))
+            self._spill.flush()
+            os.fsync(self._spill.fileno())
+            self._buffer.append(row)
+            self._record_ids.append(record_id)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            if len(self._buffer) >= self.max_rows:
+                # The timer thread sends them, so the caller never waits on the Sheets API
+                self._full.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._buffer)
+
+    def flush(self):
+        """Send every buffered row in one append_rows call; rows stay buffered if it fails"""
+        with self._flush_lock:
+            return self._flush()
+
+    def _flush(self):
+        with self._lock:
+            if not self._buffer:
+                return None
+            rows = list(self._buffer)
+            record_ids = [i for i in self._record_ids if i is not None]
+        started = time.perf_counter()
+        try:
+            with span('sheet_write', op='append_rows'):
+                self.worksheet.append_rows(rows, value_input_option='USER_ENTERED')
+        except Exception as e:
+            self.last_error = e
+            raise
+        flush = {'rows': len(rows), 'seconds': time.perf_counter() - started}
+        with self._lock:
+            self.flushes.append(flush)
+            # Rows appended during the call stay buffered, and are all the spill file keeps
+            del self._buffer[:len(rows)]
+            del self._record_ids[:len(rows)]
+            self._oldest = time.monotonic() if self._buffer else None
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spill.writelines(self._spill_line(r, i) for r, i in zip(self._buffer, self._record_ids))
+            self._spill.flush()
+            os.fsync(self._spill.fileno())
+        if self.store is not None and record_ids:
+            self.store.mark_replicated(record_ids)
+        if self.on_flush:
+            self.on_flush(flush)
+        return flush
+
+    def _flush_when_due(self):
+        while not self._closed.is_set():
+            self._full.wait(min(1.0, self.max_delay))
+            self._full.clear()
+            with self._lock:
+                due = self._oldest is not None and (
+                    len(self._buffer) >= self.max_rows or time.monotonic() - self._oldest >= self.max_delay
+                )
+            if due and not self._closed.is_set():
+                try:
+                    self.flush()
+                except Exception:
+                    # Kept in the buffer and spill file; the next flush retries them
+                    pass
+
+    def stats(self):
+        sizes = [f['rows'] for f in self.flushes]
+        latencies = [f['seconds'] for f in self.flushes]
+        return {
+            'flushes': len(self.flushes),
+            'rows_flushed': sum(sizes),
+            'rows_pending': self.pending(),
+            'recovered_rows': self.recovered,
+            'avg_rows_per_flush': sum(sizes) / len(sizes) if sizes else 0.0,
+            'avg_flush_seconds': sum(latencies) / len(latencies) if latencies else 0.0,
+            'max_flush_seconds': max(latencies) if latencies else 0.0
+        }
+
+    def close(self):
+        """Stop the timer and flush what is left"""
+        self._closed.set()
+        self._full.set()
+        self._timer.join()
+        try:
+            self.flush()
+        finally:
+            with self._lock:
+                self._spill.close()
+                # Nothing left to recover
+                if not self._buffer:
+                    os.remove(self.spill_path)
+
+def property_code_from_link(link):
+    return str(link).strip().rstrip('/').split('/')[-1]
+
+def appended_row_number(response):
+    """First sheet row written by an append_row(s) call, from its updatedRange ('Tab'!A12:W14)"""
+    try:
+        updated_range = response['updates']['updatedRange']
+    except (KeyError, TypeError):
+        return None
+    match = re.search(r'![A-Z]+(\d+)', updated_range)
+    return int(match.group(1)) if match else None
+
+class LinkIndex:
+    """In-memory set of the listings already in a worksheet, by Link and by property code.
+
+    Loaded with a single read of the Link column, then kept current with add() as rows are
+    written, so duplicate checks never go back to the Sheets API. Also maps each property
+    code to its sheet row when that is known. A reload keeps listings added in the last
+    `keep_added` seconds that the sheet does not show yet (still on their way to it).
+    """
+    def __init__(self, worksheet, link_column=COLUMNS.index('Link') + 1, keep_added=LINK_INDEX_TTL):
+        self.worksheet = worksheet
+        self.link_column = link_column
+        self.keep_added = keep_added
+        self.loaded_at = None
+        self._rows = {}
+        self._links = set()
+        self._claimed = set()
+        self._added = {}
+        self._lock = threading.Lock()
+        self.reload()
+
+    def reload(self):
+        values = self.worksheet.col_values(self.link_column)
+        now = time.monotonic()
+        with self._lock:
+            self._rows = {}
+            self._links = set()
+            for row_number, link in enumerate(values, start=1):
+                link = str(link).strip()
+                # Skip the header and blank cells; anything else in the column is a listing
+                if not link or '/' not in link:
+                    continue
+                self._links.add(link.rstrip('/'))
+                self._rows.setdefault(property_code_from_link(link), row_number)
+            for code, (url, added_at) in list(self._added.items()):
+                if code in self._rows or now - added_at > self.keep_added:
+                    del self._added[code]
+                else:
+                    self._links.add(url)
+                    self._rows[code] = None
+            self.loaded_at = now
+        return len(self._rows)
+
+    def age(self):
+        """Seconds since the Link column was last read"""
+        return time.monotonic() - self.loaded_at
+
+    def __len__(self):
+        with self._lock:
+            return len(self._rows)
+
+    def contains(self, url):
+        with self._lock:
+            return url.strip().rstrip('/') in self._links or property_code_from_link(url) in self._rows
+
+    def row_for(self, url):
+        """Sheet row holding this listing, or None if it is not there (or the row is not known yet)"""
+        with self._lock:
+            return self._rows.get(property_code_from_link(url))
+
+    def claim(self, url):
+        """Reserve a listing for processing; False if it is in the sheet or already being processed"""
+        code = property_code_from_link(url)
+        with self._lock:
+            if code in self._rows or code in self._claimed or url.strip().rstrip('/') in self._links:
+                return False
+            self._claimed.add(code)
+            return True
+
+    def release(self, url):
+        """Give up a claim without writing (the listing failed and may be retried)"""
+        with self._lock:
+            self._claimed.discard(property_code_from_link(url))
+
+    def add(self, url, row_number=None):
+        code = property_code_from_link(url)
+        with self._lock:
+            self._claimed.discard(code)
+            self._links.add(url.strip().rstrip('/'))
+            if row_number is None:
+                self._added[code] = (url.strip().rstrip('/'), time.monotonic())
+            if row_number is not None or code not in self._rows:
+                self._rows[code] = row_number
+
+# A whole-cell number as USER_ENTERED parses it, optionally with a currency sign ('€1250000')
+_NUMBER_CELL = re.compile(r'\s*[€$]?\s*(-?\d+(?:\.\d+)?)\s*')
+
+def _comparable(value):
+    """Cell value in a form where what was written and what the sheet reads back compare equal.
+
+    Rows are written USER_ENTERED, so '€1250000' is stored as the number 1250000 and
+    read back unformatted as such; 'TRUE' comes back as a boolean.
+    """
+    if isinstance(value, bool):
+        return str(value).upper()
+    if isinstance(value, (int, float)):
+        return float(value)
+    text = str(value).strip()
+    match = _NUMBER_CELL.fullmatch(text)
+    if match:
+        return float(match.group(1))
+    if text.upper() in ('TRUE', 'FALSE'):
+        return text.upper()
+    return text
+
+def changed_ranges(row_number, current, row):
+    """A1 ranges covering the cells of `row` that differ from `current`, one per contiguous run.
+    `current` should be read with value_render_option='UNFORMATTED_VALUE'."""
+    # Importing gspread pulls in google-auth; only upserts need it
+    from gspread.utils import rowcol_to_a1
+    current = list(current) + [''] * (len(row) - len(current))
+    data = []
+    run_start = None
+    for col, value in enumerate(list(row) + [None], start=1):
+        changed = value is not None and _comparable(value) != _comparable(current[col - 1])
+        if changed and run_start is None:
+            run_start = col
+        elif not changed and run_start is not None:
+            data.append({
+                'range': f"{rowcol_to_a1(row_number, run_start)}:{rowcol_to_a1(row_number, col - 1)}",
+                'values': [list(row[run_start - 1:col - 1])]
+            })
+            run_start = None
+    return data
+
+def _listing_row(worksheet, link_index, url, row_number):
+    """Unformatted values of row_number if it still holds this listing, else None"""
+    current = worksheet.row_values(row_number, value_render_option='UNFORMATTED_VALUE')
+    link = current[link_index.link_column - 1] if len(current) >= link_index.link_column else ''
+    if property_code_from_link(link) != property_code_from_link(url):
+        return None
+    return current
+
+def upsert_row(worksheet, link_index, url, row):
+    """Rewrite the changed cells of the listing's existing row in one batch_update, or append it.
+
+    The row number from the index is checked against the Link cell first: if the sheet was
+    sorted or rows were inserted or deleted, the index is reloaded and the listing looked up
+    again, so another listing's row is never overwritten.
+    Returns {'action': 'updated' | 'unchanged' | 'appended', 'row': row number, 'cells': cells written}.
+    """
+    row_number = link_index.row_for(url)
+    if row_number is None and link_index.contains(url):
+        # Written earlier in this process but its row number was not known yet
+        link_index.reload()
+        row_number = link_index.row_for(url)
+    current = None
+    if row_number is not None:
+        with span('sheet_write', op='upsert_read'):
+            current = _listing_row(worksheet, link_index, url, row_number)
+            if current is None:
+                # The row moved since the index was loaded
+                link_index.reload()
+                row_number = link_index.row_for(url)
+                if row_number is not None:
+                    current = _listing_row(worksheet, link_index, url, row_number)
+    if current is None:
+        # Not in the sheet (any more)
+        with span('sheet_write', op='append_row'):
+            response = worksheet.append_row(row, value_input_option='USER_ENTERED')
+        row_number = appended_row_number(response)
+        link_index.add(url, row_number)
+        return {'action': 'appended', 'row': row_number, 'cells': len(row)}
+
+    data = changed_ranges(row_number, current, row)
+    if data:
+        with span('sheet_write', op='upsert'):
+            worksheet.batch_update(data, value_input_option='USER_ENTERED')
+    if not data:
+        return {'action': 'unchanged', 'row': row_number, 'cells': 0}
+    return {'action': 'updated', 'row': row_number, 'cells': sum(len(d['values'][0]) for d in data)}
+
+class SheetReplicator:
+    """Background thread that copies new records from a result store into the worksheet.
+
+    The store is the system of record: records stay pending there until the sheet call
+    that carries them succeeds, so a failed or interrupted sync is simply retried on the
+    next pass (or by the next process). New listings go out in one append_rows call per
+    pass; records saved with sheet_action 'upsert' refresh their existing row.
+    `target` returns the (worksheet, link_index) pair to write to; `on_error` is called
+    with the exception when a pass fails.
+    """
+    def __init__(self, store, target, interval=SHEET_REPLICATE_SECONDS, batch_size=200, on_error=None):
+        self.store = store
+        self.target = target
+        self.interval = interval
+        self.batch_size = batch_size
+        self.on_error = on_error
+        self.replicated = 0
+        self.passes = 0
+        self.failures = 0
+        self.last_error = None
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._drain_lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name='sheet-replicator', daemon=True)
+        self._thread.start()
+
+    def notify(self):
+        """New records were saved; sync them now rather than at the next interval"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._closed.is_set():
+            self._wake.wait(self.interval)
+            self._wake.clear()
+            try:
+                self.drain()
+            except Exception:
+                # Recorded by drain(); the records stay pending for the next pass
+                pass
+
+    def drain(self):
+        """Copy every pending record to the sheet; returns how many were replicated"""
+        with self._drain_lock:
+            total = 0
+            while True:
+                records = self.store.pending_replication(self.batch_size)
+                if not records:
+                    return total
+                try:
+                    worksheet, link_index = self.target()
+                    self._replicate(worksheet, link_index, records)
+                except Exception as e:
+                    self.failures += 1
+                    self.last_error = e
+                    if self.on_error:
+                        self.on_error(e)
+                    raise
+                self.passes += 1
+                self.replicated += len(records)
+                total += len(records)
+
+    def _replicate(self, worksheet, link_index, records):
+        appends = []
+
+        def flush_appends():
+            if not appends:
+                return
+            with span('sheet_write', op='append_rows'):
+                response = worksheet.append_rows([r['row'] for r in appends], value_input_option='USER_ENTERED')
+            first_row = appended_row_number(response)
+            for offset, record in enumerate(appends):
+                link_index.add(record['link'], first_row + offset if first_row is not None else None)
+            self.store.mark_replicated([r['id'] for r in appends])
+            appends.clear()
+
+        for record in records:
+            if record['sheet_action'] == 'upsert':
+                # The listing's row may be among the appends still buffered
+                flush_appends()
+                upsert_row(worksheet, link_index, record['link'], record['row'])
+                self.store.mark_replicated([record['id']])
+            else:
+                appends.append(record)
+        flush_appends()
+
+    def stats(self):
+        return {
+            'replicated': self.replicated,
+            'passes': self.passes,
+            'failures': self.failures,
+            'last_error': str(self.last_error) if self.last_error else None,
+            'pending': self.store.stats()['pending_replication']
+        }
+
+    def close(self, timeout=None):
+        """Stop the thread after a final sync"""
+        self._closed.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        self.drain()
+
+_clients = {}
+_spreadsheet_ids = {}
+_worksheets = {}
+_link_indexes = {}
+_replicators = {}
+_handles_lock = threading.Lock()
+
+def service_account_identity(service_account_info=None):
+    """Cache key for a set of credentials: the service account and the key it signs with"""
+    if not service_account_info:
+        return 'file:service_account.json'
+    return f"{service_account_info.get('client_email')}#{service_account_info.get('private_key_id')}"
+
+def get_cached_worksheet(identity, make_client, sheet_name, tab_name, spreadsheet_id=SHEET_ID):
+    """Return the process-wide worksheet handle for these credentials, opening it on first use.
+
+    The gspread client is built once per identity; its authorized session refreshes the
+    access token by itself when it expires. The spreadsheet is resolved by title only
+    once (or never, when spreadsheet_id is given) and reopened by key afterwards.
+    """
+    key = (identity, sheet_name, tab_name)
+    with _handles_lock:
+        worksheet = _worksheets.get(key)
+        if worksheet is not None:
+            return worksheet
+        gc = _clients.get(identity)
+        if gc is None:
+            gc = make_client()
+            _clients[identity] = gc
+        spreadsheet_id = spreadsheet_id or _spreadsheet_ids.get((identity, sheet_name))
+        try:
+            sh = gc.open_by_key(spreadsheet_id) if spreadsheet_id else gc.open(sheet_name)
+            _spreadsheet_ids[(identity, sheet_name)] = sh.id
+            worksheet = sh.worksheet(tab_name)
+        except Exception as e:
+            raise Exception(f"Failed to access worksheet '{tab_name}' in sheet '{sheet_name}': {str(e)}")
+        _worksheets[key] = worksheet
+        return worksheet
+
+def get_cached_link_index(identity, sheet_name, tab_name, worksheet, ttl=LINK_INDEX_TTL):
+    """Process-wide LinkIndex for a cached worksheet, loaded on first use and reloaded every ttl seconds"""
+    key = (identity, sheet_name, tab_name)
+    with _handles_lock:
+        index = _link_indexes.get(key)
+        if index is None:
+            index = LinkIndex(worksheet)
+            _link_indexes[key] = index
+            return index
+    if ttl and index.age() > ttl:
+        # Outside the handles lock: other sheets' handles stay available during the read
+        index.reload()
+    return index
+
+def get_cached_replicator(identity, sheet_name, tab_name, store, target, on_error=None):
+    """Process-wide SheetReplicator for a worksheet and result store, started on first use"""
+    # The replicator keeps its store alive, so id(store) can't be reused while it is cached
+    key = (identity, sheet_name, tab_name, id(store))
+    with _handles_lock:
+        replicator = _replicators.get(key)
+        if replicator is None:
+            replicator = SheetReplicator(store, target, on_error=on_error)
+            _replicators[key] = replicator
+        return replicator
+
+def invalidate_worksheet(identity, sheet_name=None, tab_name=None):
+    """Drop cached handles for an identity (e.g. after a write failed) so the next call reopens them"""
+    with _handles_lock:
+        for handles in (_worksheets, _link_indexes):
+            for key in [k for k in handles if k[0] == identity
+                        and sheet_name in (None, k[1]) and tab_name in (None, k[2])]:
+                del handles[key]
+        if sheet_name is None and tab_name is None:
+            _clients.pop(identity, None)
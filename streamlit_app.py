@@ -1,6 +1,11 @@
 import streamlit as st
+import json as pyjson
 import os
-from re_engine_core import run_job
+import time
+from cost_meter import get_cost_meter
+from job_queue import DONE, FAILED, JobQueue
+from metrics import METRICS
+from re_engine_core import extract_property_code, get_sheet_handle, get_sheet_replicator, parse_listing_urls, run_job
 
 # Page configuration
 st.set_page_config(
@@ -9,6 +14,33 @@ st.set_page_config(
     layout="wide"
 )
 
+@st.cache_resource(show_spinner=False)
+def warm_sheet_handle(client_email):
+    """Authenticate and open the worksheet once per process so the first analysis doesn't pay for it.
+    Also starts the sheet replicator, which syncs results left over from a previous run."""
+    try:
+        get_sheet_handle(dict(st.secrets.gcreds))
+        get_sheet_replicator(dict(st.secrets.gcreds)).notify()
+        return None
+    except Exception as e:
+        return str(e)
+
+@st.cache_resource(show_spinner=False)
+def get_job_queue():
+    """One worker pool for every session, so analyses run in parallel instead of blocking the script"""
+    # Refresh the metrics export after every analysis
+    return JobQueue(run_job, on_finish=lambda job: METRICS.export())
+
+STAGE_LABELS = {'fetch': 'Fetching Idealista data', 'extract': 'Extracting fields', 'ai': 'Running AI analysis',
+                'write': 'Saving results'}
+
+if 'job_ids' not in st.session_state:
+    st.session_state.job_ids = []
+
+# Pre-warm the Google Sheets connection at startup
+if hasattr(st, 'secrets') and 'gcreds' in st.secrets:
+    warm_sheet_handle(st.secrets.gcreds.get('client_email'))
+
 # Custom CSS for better styling
 st.markdown("""
 <style>
@@ -58,8 +90,8 @@ st.markdown("""
 <div class="info-box">
 <strong>How it works:</strong>
 <ol>
-<li>Paste an Idealista property URL from Mallorca</li>
-<li>Click "Analyze Property" to process</li>
+<li>Paste an Idealista property URL from Mallorca - or a whole shortlist in the Bulk tab</li>
+<li>Click "Analyze Property" to queue it - you can queue more URLs while it runs</li>
 <li>The system will extract property data, run AI analysis, and write results to Google Sheets</li>
 <li>Results include investment analysis, reform costs, comparable properties, and more</li>
 </ol>
@@ -68,74 +100,181 @@ st.markdown("""
 
 # Input section
 st.subheader("🔗 Property URL Input")
-url = st.text_input(
-    "Paste Idealista Property URL:", 
-    placeholder="https://www.idealista.com/inmueble/12345678/",
-    help="Enter a valid Idealista property URL for a Mallorca property"
+single_tab, bulk_tab = st.tabs(["Single URL", "Bulk (paste or CSV)"])
+with single_tab:
+    url = st.text_input(
+        "Paste Idealista Property URL:", 
+        placeholder="https://www.idealista.com/inmueble/12345678/",
+        help="Enter a valid Idealista property URL for a Mallorca property"
+    )
+    
+    # Validation
+    if url and "idealista.com" not in url:
+        st.warning("⚠️ Please enter a valid Idealista URL")
+    
+    analyze_single = st.button("🚀 Analyze Property", type="primary", use_container_width=True)
+
+with bulk_tab:
+    bulk_text = st.text_area(
+        "Paste Idealista links:",
+        height=200,
+        placeholder="https://www.idealista.com/inmueble/12345678/\nhttps://www.idealista.com/inmueble/87654321/",
+        help="Any text works - the listing links are picked out of it and duplicates are removed"
+    )
+    bulk_file = st.file_uploader("...or upload a CSV / text file with links", type=['csv', 'txt'])
+    analyze_bulk = st.button("🚀 Analyze All", type="primary", use_container_width=True)
+
+refresh_existing = st.checkbox(
+    "Re-analyse if already in the sheet",
+    help="Refresh the existing row instead of skipping listings that were analysed before"
 )
 
-# Validation
-if url and "idealista.com" not in url:
-    st.warning("⚠️ Please enter a valid Idealista URL")
+@st.cache_data(show_spinner=False)
+def read_profile(path):
+    """Profile report text; read once, not on every rerun of the status table"""
+    with open(path, encoding="utf-8") as f:
+        return f.read()
 
-# Process button and results
-col1, col2, col3 = st.columns([1, 2, 1])
-with col2:
-    if st.button("🚀 Analyze Property", type="primary", use_container_width=True):
-        if not url:
-            st.error("Please enter a property URL first!")
-        elif "idealista.com" not in url:
-            st.error("Please enter a valid Idealista URL!")
-        else:
-            # Show processing message
-            with st.spinner("🔄 Processing property... This may take 30-60 seconds"):
-                # Get service account info from Streamlit secrets
-                service_account_info = None
-                try:
-                    if hasattr(st, 'secrets') and 'gcreds' in st.secrets:
-                        service_account_info = dict(st.secrets.gcreds)
-                        st.write("✅ Service account credentials loaded from secrets")
-                    else:
-                        st.error("❌ No service account credentials found in Streamlit secrets")
-                        st.stop()
-                except Exception as e:
-                    st.error(f"❌ Error loading secrets: {str(e)}")
-                    st.stop()
-                
-
-                
-                # Run the job
-                result = run_job(url, service_account_info)
-                
-            # Display results
-            if result["success"]:
-                st.markdown(f"""
-                <div class="success-box">
-                <strong>✅ Success!</strong><br>
-                {result["message"]}<br>
-                <strong>Property Code:</strong> {result.get("property_code", "N/A")}<br>
-                <strong>Fields Filled:</strong> {result["filled_fields"]}/{result["total_fields"]}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                st.success("Property data has been written to Google Sheets!")
-                st.balloons()
-                
-            else:
-                st.markdown(f"""
-                <div class="error-box">
-                <strong>❌ Error:</strong><br>
-                {result["error"]}
-                </div>
-                """, unsafe_allow_html=True)
-                
-                # Additional debugging info
-                st.write("🔧 **Debug Information:**")
-                st.write(f"- OpenAI API Key: {'✅ Set' if os.getenv('OPENAI_API_KEY') else '❌ Not Set'}")
-                st.write(f"- Idealista API Key: {'✅ Set' if os.getenv('IDEALISTA_API_KEY') else '❌ Not Set'}")
-                if service_account_info:
-                    st.write(f"- Service Account Type: {service_account_info.get('type', 'Unknown')}")
-                    st.write(f"- Project ID: {service_account_info.get('project_id', 'Unknown')}")
+def show_result(result):
+    if result.get("skipped"):
+        st.info(f"ℹ️ {result['message']}" + (f" (row {result['row']})" if result.get("row") else ""))
+    elif result["success"]:
+        st.markdown(f"""
+        <div class="success-box">
+        <strong>✅ Success!</strong><br>
+        {result["message"]}<br>
+        <strong>Property Code:</strong> {result.get("property_code", "N/A")}<br>
+        <strong>Fields Filled:</strong> {result["filled_fields"]}/{result["total_fields"]}
+        </div>
+        """, unsafe_allow_html=True)
+        if result.get("profile"):
+            st.download_button("Download profile", read_profile(result["profile"]), file_name=os.path.basename(result["profile"]))
+    else:
+        st.markdown(f"""
+        <div class="error-box">
+        <strong>❌ Error:</strong><br>
+        {result["error"]}
+        </div>
+        """, unsafe_allow_html=True)
+        
+        # Additional debugging info
+        st.write("🔧 **Debug Information:**")
+        st.write(f"- OpenAI API Key: {'✅ Set' if os.getenv('OPENAI_API_KEY') else '❌ Not Set'}")
+        st.write(f"- Idealista API Key: {'✅ Set' if os.getenv('IDEALISTA_API_KEY') else '❌ Not Set'}")
+
+def job_row(job):
+    """One line of the status table"""
+    now = time.time()
+    result = job['result'] or {}
+    if job['state'] == DONE:
+        status = '⏭️ Skipped' if result.get('skipped') else '✅ Done'
+        detail = result.get('message', '')
+    elif job['state'] == FAILED:
+        status = '❌ Failed'
+        detail = result.get('error', '')
+    else:
+        status = f"🔄 {STAGE_LABELS[job['stage']]}" if job['stage'] in STAGE_LABELS else '⏳ Queued'
+        detail = ''
+    started = job['started_at'] or now
+    timings = job['stages']
+    return {
+        'URL': job['url'],
+        'Status': status,
+        'Waited (s)': round(started - job['submitted_at'], 1),
+        'Fetch (s)': round(timings['fetch']['seconds'], 1) if timings.get('fetch', {}).get('seconds') is not None else None,
+        'AI (s)': round(timings['ai']['seconds'], 1) if timings.get('ai', {}).get('seconds') is not None else None,
+        'Total (s)': round((job['finished_at'] or now) - started, 1),
+        'Cost ($)': round(result['cost_usd'], 4) if result.get('cost_usd') is not None else None,
+        'Result': detail
+    }
+
+def jobs_table(live=False):
+    jobs = get_job_queue().statuses(st.session_state.job_ids)
+    finished = [job for job in jobs if job['state'] in (DONE, FAILED)]
+    if live and len(finished) == len(jobs):
+        # Everything has finished: rerun the page so the table stops polling
+        st.rerun()
+    st.caption(f"{len(finished)}/{len(jobs)} finished - {get_job_queue().workers} analyses run in parallel")
+    st.dataframe([job_row(job) for job in jobs], use_container_width=True, hide_index=True)
+    if finished:
+        urls = [job['url'] for job in reversed(finished)]
+        selected = st.selectbox("Show details for:", urls)
+        show_result(next(job for job in finished if job['url'] == selected)['result'])
+
+if hasattr(st, 'fragment'):
+    polling_jobs_table = st.fragment(run_every=2)(jobs_table)
+    jobs_table = st.fragment(jobs_table)
+
+def show_jobs():
+    """Status table of this session's analyses; re-runs by itself while any of them is queued or running"""
+    jobs = get_job_queue().statuses(st.session_state.job_ids)
+    if hasattr(st, 'fragment') and any(job['state'] not in (DONE, FAILED) for job in jobs):
+        polling_jobs_table(live=True)
+    else:
+        jobs_table()
+
+def load_service_account_info():
+    """Service account info from Streamlit secrets; stops the script if it is missing"""
+    try:
+        if hasattr(st, 'secrets') and 'gcreds' in st.secrets:
+            return dict(st.secrets.gcreds)
+        st.error("❌ No service account credentials found in Streamlit secrets")
+    except Exception as e:
+        st.error(f"❌ Error loading secrets: {str(e)}")
+    st.stop()
+
+def queue_urls(urls):
+    """Queue listings that this session hasn't queued yet; returns how many were queued"""
+    service_account_info = load_service_account_info()
+    queued = {extract_property_code(job['url']) for job in get_job_queue().statuses(st.session_state.job_ids)}
+    count = 0
+    for listing_url in urls:
+        if extract_property_code(listing_url) in queued:
+            continue
+        queued.add(extract_property_code(listing_url))
+        # Each job runs on the worker pool while the page stays responsive
+        st.session_state.job_ids.append(get_job_queue().submit(
+            listing_url,
+            service_account_info=service_account_info,
+            on_duplicate='update' if refresh_existing else 'skip'
+        ))
+        count += 1
+    return count
+
+if analyze_single:
+    if not url:
+        st.error("Please enter a property URL first!")
+    elif "idealista.com" not in url:
+        st.error("Please enter a valid Idealista URL!")
+    elif queue_urls([url]):
+        st.success("Queued! You can add more URLs while it runs.")
+    else:
+        st.info("This property is already in your list below.")
+
+if analyze_bulk:
+    text = bulk_text or ''
+    if bulk_file is not None:
+        text += '\n' + bulk_file.getvalue().decode('utf-8', errors='replace')
+    urls, rejected = parse_listing_urls(text)
+    if rejected:
+        with st.expander(f"⚠️ Ignored {len(rejected)} lines without an Idealista listing link"):
+            st.write(rejected)
+    if not urls:
+        st.error("No Idealista listing links found!")
+    else:
+        count = queue_urls(urls)
+        workers = get_job_queue().workers
+        st.success(
+            f"Queued {count} properties ({len(urls) - count} already in your list). "
+            f"With {workers} parallel workers this takes about {-(-count // workers)} analysis rounds."
+        )
+
+# Results
+if st.session_state.job_ids:
+    st.subheader("📋 Your Analyses")
+    show_jobs()
+    if not hasattr(st, 'fragment'):
+        st.button("🔄 Refresh status")
 
 # Information section
 st.markdown("---")
@@ -192,4 +331,34 @@ with st.expander("🔧 Environment Status"):
         st.write(f"- Client Email: {gcreds.get('client_email', 'Unknown')}")
         st.write(f"- Private Key: {'✅ Present' if gcreds.get('private_key') else '❌ Missing'}")
     else:
-        st.write("- Google Sheets: ❌ Not Configured") 
\ No newline at end of file
+        st.write("- Google Sheets: ❌ Not Configured") 
+# Where the time goes, per pipeline span (all sessions since the app started)
+with st.expander("📈 Performance Metrics"):
+    summary = METRICS.summary()
+    if not summary['spans']:
+        st.write("No analyses have run yet.")
+    else:
+        st.dataframe([
+            {
+                'Span': s['span'] + (' (' + ', '.join(f"{k}={v}" for k, v in s['labels'].items()) + ')' if s['labels'] else ''),
+                'Count': s['count'],
+                'p50 (s)': round(s['p50_seconds'], 2),
+                'p95 (s)': round(s['p95_seconds'], 2),
+                'p99 (s)': round(s['p99_seconds'], 2),
+                'Total (s)': round(s['total_seconds'], 1)
+            }
+            for s in summary['spans']
+        ], use_container_width=True, hide_index=True)
+        for counter in summary['counters']:
+            st.write(f"- {counter['name']} {', '.join(f'{k}={v}' for k, v in counter['labels'].items())}: {counter['value']}")
+        col1, col2 = st.columns(2)
+        with col1:
+            st.download_button("Download Prometheus metrics", METRICS.prometheus_text(), file_name="re_engine.prom")
+        with col2:
+            st.download_button("Download JSON summary", pyjson.dumps(summary, indent=2), file_name="re_engine.json")
+    usage = get_cost_meter().snapshot()
+    st.write(f"**AI cost since start:** ${usage['run']['cost_usd']:.4f} over {usage['run']['calls']} calls "
+             f"({usage['run']['prompt_tokens']} prompt / {usage['run']['completion_tokens']} completion tokens)")
+    st.write(f"**AI cost today:** ${usage['today']['cost_usd']:.4f} over {usage['today']['calls']} calls")
+    for name, share in usage['budget_usage'].items():
+        st.progress(min(share, 1.0), text=f"{name.capitalize()} budget: {share:.0%} used")
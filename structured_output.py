@@ -0,0 +1,176 @@
+import json as pyjson
+
+from columns import COLUMNS
+
+SCORE_VALUES = list(range(1, 11))
+
+# Typed fields; every other column is free text
+COLUMN_TYPES = {
+    'Priority': {'type': 'string', 'enum': ['A', 'B', 'C']},
+    'Seaview': {'type': 'string', 'enum': ['Yes', 'No']},
+    'Macro location (1-10)': {'type': 'integer', 'enum': SCORE_VALUES},
+    'Micro location (1-10)': {'type': 'integer', 'enum': SCORE_VALUES}
+}
+
+def analysis_schema(columns=COLUMNS):
+    """Strict JSON schema with one required property per sheet column"""
+    return {
+        'type': 'object',
+        'properties': {col: COLUMN_TYPES.get(col, {'type': 'string'}) for col in columns},
+        'required': list(columns),
+        'additionalProperties': False
+    }
+
+ANALYSIS_SCHEMA = analysis_schema()
+
+ANALYSIS_RESPONSE_FORMAT = {
+    'type': 'json_schema',
+    'json_schema': {'name': 'property_analysis', 'strict': True, 'schema': ANALYSIS_SCHEMA}
+}
+
+class StreamValidationError(ValueError):
+    """The streamed reply can no longer become a valid analysis object"""
+
+_WHITESPACE = ' \t\r\n'
+_LITERAL_CHARS = set('0123456789+-.eEtruefalsn')
+
+class StreamingJSONValidator:
+    """Incremental parser for a flat JSON object, validated against a schema as chunks arrive.
+
+    feed() raises StreamValidationError as soon as the text goes wrong - prose or a
+    markdown fence instead of '{', an unknown or duplicate key, a value of the wrong
+    type, an enum miss - so the caller can abort the stream instead of paying for the
+    rest of it. finish() checks required keys and returns the parsed object.
+    """
+    def __init__(self, schema=ANALYSIS_SCHEMA):
+        self.properties = schema['properties']
+        self.required = schema.get('required', [])
+        self.allow_extra = schema.get('additionalProperties', True) is not False
+        self.buffer = []
+        self.state = 'start'
+        self.keys = set()
+        self._token = []
+        self._escape = False
+        self._key = None
+
+    def feed(self, chunk):
+        for char in chunk:
+            self.buffer.append(char)
+            self._step(char)
+
+    def _fail(self, message):
+        raise StreamValidationError(f"{message} (after {len(self.buffer)} characters)")
+
+    def _spec(self):
+        return self.properties.get(self._key, {})
+
+    def _step(self, char):
+        state = self.state
+        if state in ('in_key', 'in_string'):
+            if self._escape:
+                self._escape = False
+                self._token.append(char)
+            elif char == '\\':
+                self._escape = True
+                self._token.append(char)
+            elif char == '"':
+                text = pyjson.loads('"' + ''.join(self._token) + '"')
+                self._token = []
+                if state == 'in_key':
+                    self._end_key(text)
+                else:
+                    self._end_value(text)
+            else:
+                self._token.append(char)
+            return
+        if state == 'in_literal':
+            if char in _LITERAL_CHARS:
+                self._token.append(char)
+                return
+            self._end_literal()
+            state = self.state
+        if char in _WHITESPACE:
+            return
+        if state == 'start':
+            if char != '{':
+                self._fail(f"Expected a JSON object, got {char!r}")
+            self.state = 'key_or_end'
+        elif state in ('key_or_end', 'key'):
+            if char == '"':
+                self.state = 'in_key'
+            elif char == '}' and state == 'key_or_end':
+                self.state = 'done'
+            else:
+                self._fail(f"Expected a key, got {char!r}")
+        elif state == 'colon':
+            if char != ':':
+                self._fail(f"Expected ':' after {self._key!r}")
+            self.state = 'value'
+        elif state == 'value':
+            self._start_value(char)
+        elif state == 'after_value':
+            if char == ',':
+                self.state = 'key'
+            elif char == '}':
+                self.state = 'done'
+            else:
+                self._fail(f"Expected ',' or '}}' after {self._key!r}")
+        elif state == 'done':
+            self._fail("Unexpected text after the JSON object")
+
+    def _end_key(self, key):
+        if key in self.keys:
+            self._fail(f"Duplicate key {key!r}")
+        if key not in self.properties and not self.allow_extra:
+            self._fail(f"Unexpected key {key!r}")
+        self.keys.add(key)
+        self._key = key
+        self.state = 'colon'
+
+    def _start_value(self, char):
+        expected = self._spec().get('type')
+        if char == '"':
+            if expected not in (None, 'string'):
+                self._fail(f"{self._key!r} should be {expected}, got a string")
+            self.state = 'in_string'
+        elif char in _LITERAL_CHARS:
+            self._token = [char]
+            self.state = 'in_literal'
+        else:
+            # The analysis object is flat; nested values are never valid here
+            self._fail(f"Unexpected value for {self._key!r}")
+
+    def _end_literal(self):
+        text = ''.join(self._token)
+        self._token = []
+        try:
+            value = pyjson.loads(text)
+        except ValueError:
+            self._fail(f"Invalid literal {text!r} for {self._key!r}")
+        expected = self._spec().get('type')
+        if expected == 'string' or (expected == 'integer' and (isinstance(value, bool) or not isinstance(value, int))):
+            self._fail(f"{self._key!r} should be {expected}, got {text}")
+        self._end_value(value)
+
+    def _end_value(self, value):
+        enum = self._spec().get('enum')
+        if enum is not None and value not in enum:
+            self._fail(f"{value!r} is not an allowed value for {self._key!r}")
+        self.state = 'after_value'
+
+    def finish(self):
+        """Validate the complete reply and return the parsed object"""
+        if self.state == 'in_literal':
+            self._end_literal()
+        if self.state != 'done':
+            self._fail("Reply ended before the JSON object was complete")
+        missing = [key for key in self.required if key not in self.keys]
+        if missing:
+            self._fail(f"Missing keys: {', '.join(missing)}")
+        return pyjson.loads(''.join(self.buffer))
+
+def parse_analysis(content, schema=ANALYSIS_SCHEMA):
+    """Validate a complete (non-streamed) reply with the same rules"""
+    validator = StreamingJSONValidator(schema)
+    validator.feed(content)
+    return validator.finish()